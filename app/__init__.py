@@ -1,23 +1,56 @@
 import os
 
+import click
 from flask import Flask, render_template
 from flask_bootstrap import Bootstrap
 from flask_login import LoginManager
-from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
 
 from config import app_config
+from .audit import AuditLog
+from .cache import Cache
+from .database import SQLAlchemy, dispose_engines, warm_up
+from .fragments import FragmentCache
+from .graph import RelationshipGraph
+from .jobs import JobQueue
+from .metrics import Metrics
+from .passwords import PasswordHasher
+from .ratelimit import RateLimiter
+from .reference import DataVersions, ReferenceData
+from .statistics import Statistics
 
 # initialize db variable
 db = SQLAlchemy()
 # initialize login manager
 login_manager = LoginManager()
+# initialize cache of logged in users
+user_cache = Cache('user')
+# initialize password hashing workers
+password_hasher = PasswordHasher()
+# initialize login attempt limits
+login_limiter = RateLimiter('ratelimit', rates=('LOGIN_IP_PER_MINUTE', 'LOGIN_USERNAME_PER_MINUTE'))
+# initialize request metrics
+metrics = Metrics()
+# initialize data versions of tables and the lookup table cache
+data_versions = DataVersions(db)
+reference_data = ReferenceData(db, data_versions)
+# initialize cache of rendered pages and template fragments
+fragment_cache = FragmentCache(data_versions)
+# initialize change history of the rows written through the app
+audit_log = AuditLog(db)
+# initialize traversal of the STIX relationships
+relationship_graph = RelationshipGraph(db, data_versions)
+# initialize counters of the admin dashboard
+statistics = Statistics(db, data_versions, reference_data)
+# initialize background jobs
+jobs = JobQueue(db)
 
 
 # initialize app with a selected configurations
 def create_app(config_name):
-    if os.getenv('FLASK_CONFIG') == "production":
+    # production settings come from the environment, whether asked for by name (wsgi.py) or by FLASK_CONFIG
+    if config_name == 'production' or os.getenv('FLASK_CONFIG') == "production":
         app = Flask(__name__)
+        app.config.from_object(app_config['production'])
         app.config.update(
             SECRET_KEY=os.getenv('SECRET_KEY'),
             SQLALCHEMY_DATABASE_URI=os.getenv('SQLALCHEMY_DATABASE_URI')
@@ -29,12 +62,29 @@ def create_app(config_name):
 
     Bootstrap(app)
     db.init_app(app)
+    metrics.init_app(app)
     # start login manager
     login_manager.init_app(app)
     login_manager.login_message = 'You must be logged in to access this page.'
     login_manager.login_view = 'auth.login'
-    # migrate models to db
-    migrate = Migrate(app, db)
+    if app.config['WEB_CONCURRENCY'] > 1 and not app.config['CACHE_REDIS_URL']:
+        app.logger.warning('%d web workers without CACHE_REDIS_URL: cached data may lag writes by up to %s seconds '
+                           'and every worker keeps its own login rate limits', app.config['WEB_CONCURRENCY'],
+                           app.config['CACHE_UNSHARED_TTL'])
+    user_cache.init_app(app)
+    password_hasher.init_app(app)
+    login_limiter.init_app(app)
+    data_versions.init_app(app)
+    reference_data.init_app(app)
+    fragment_cache.init_app(app)
+    audit_log.init_app(app)
+    relationship_graph.init_app(app)
+    statistics.init_app(app)
+    jobs.init_app(app)
+    # migrate models to db; alembic takes longer to import than the rest of the app, so only under the flask cli
+    if click.get_current_context(silent=True) is not None:
+        from flask_migrate import Migrate
+        Migrate(app, db)
 
     from app import models
 
@@ -47,6 +97,20 @@ def create_app(config_name):
     from .home import home as home_blueprint
     app.register_blueprint(home_blueprint)
 
+    from .health import health as health_blueprint
+    app.register_blueprint(health_blueprint)
+
+    from .stix import stix as stix_blueprint
+    app.register_blueprint(stix_blueprint, url_prefix='/stix')
+
+    from .api import api as api_blueprint
+    app.register_blueprint(api_blueprint, url_prefix='/api/v1')
+
+    # open pooled connections before the first request
+    if app.config['DATABASE_POOL_WARM_UP']:
+        with app.app_context():
+            warm_up(db.engine, app.config['DATABASE_POOL_WARM_UP'])
+
     @app.errorhandler(403)
     def forbidden(error):
         return render_template('errors/403.html', title='Forbidden'), 403
@@ -60,3 +124,16 @@ def create_app(config_name):
         return render_template('errors/500.html', title='Server error'), 500
 
     return app
+
+
+def before_fork(app):
+    # Run by a server preloading the app before forking its workers: connections opened while loading
+    # (pool warm-up) must not be inherited and shared by several processes
+    dispose_engines(db, app)
+
+
+def after_fork(app):
+    # Run in every forked worker: open its own pooled connections
+    if app.config['DATABASE_POOL_WARM_UP']:
+        with app.app_context():
+            warm_up(db.engine, app.config['DATABASE_POOL_WARM_UP'])
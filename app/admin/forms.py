@@ -1,8 +1,8 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, BooleanField, SubmitField
+from wtforms import StringField, PasswordField, BooleanField, SelectField, SubmitField
 from wtforms.validators import DataRequired, Email, EqualTo, ValidationError
-from wtforms.ext.sqlalchemy.fields import QuerySelectField
 
+from .. import reference_data
 from ..models import User, Role
 
 
@@ -13,10 +13,14 @@ class UserForm(FlaskForm):
     name = StringField('Name', validators=[DataRequired()])
     password = PasswordField('Password', validators=[DataRequired(), EqualTo('confirm_password')])
     confirm_password = PasswordField('Confirm password')
-    role = QuerySelectField(query_factory=lambda: Role.query.all(), get_label='name')
+    role_id = SelectField('Role', coerce=int)
     is_admin = BooleanField('Admin')
     submit = SubmitField('Submit')
 
+    def __init__(self, *args, **kwargs):
+        super(UserForm, self).__init__(*args, **kwargs)
+        self.role_id.choices = reference_data.choices(Role)
+
     def validate_email(self, field):
         if User.query.filter_by(email=field.data).first():
             raise ValidationError('Email is already in use!')
@@ -33,10 +37,14 @@ class UserEditForm(FlaskForm):
     name = StringField('Name', validators=[DataRequired()])
     password = PasswordField('Password', validators=[EqualTo('confirm_password')])
     confirm_password = PasswordField('Confirm password')
-    role = QuerySelectField(query_factory=lambda: Role.query.all(), get_label='name')
+    role_id = SelectField('Role', coerce=int)
     is_admin = BooleanField('Admin')
     submit = SubmitField('Submit')
 
+    def __init__(self, *args, **kwargs):
+        super(UserEditForm, self).__init__(*args, **kwargs)
+        self.role_id.choices = reference_data.choices(Role)
+
 
 class RoleForm(FlaskForm):
     # Form to add roles
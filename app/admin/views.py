@@ -3,8 +3,11 @@ from flask_login import current_user, login_required
 
 from . import admin
 from .forms import UserForm, UserEditForm, RoleForm
-from .. import db
-from ..models import User, Role
+from .. import db, fragment_cache, user_cache
+from ..bulk import bulk_view
+from ..models import User, Role, count_by, eager
+from ..pagination import paginate
+from ..passwords import HashingBusy
 
 
 def check_admin():
@@ -13,13 +16,22 @@ def check_admin():
         abort(403)
 
 
+def role_user_ids(role):
+    # Ids of the users of a role, whose cached snapshots go stale when the role changes
+    return [user_id for user_id, in db.session.query(User.id).filter_by(role_id=role.id)]
+
+
 # User views
 @admin.route('/users')
 @login_required
+@fragment_cache.page('users', 'roles')
 def list_users():
-    # List all users
-    users = User.query.all()
-    return render_template('admin/users/users.html', users=users, title='Users')
+    # List users one page at a time, loading only the columns shown in the table and eager loading roles
+    query = User.query.options(eager(User.role, 'name'))
+    users = paginate(query, User, sort_columns=('id', 'username'), default_sort='id',
+                     filter_columns=('role_id', 'is_admin'),
+                     load_columns=('id', 'username', 'name', 'email', 'is_admin', 'role_id'))
+    return render_template('admin/users/users.html', users=users.items, page=users, title='Users')
 
 
 @admin.route('/users/add', methods=['GET', 'POST'])
@@ -33,8 +45,12 @@ def add_user():
 
     form = UserForm()
     if form.validate_on_submit():
-        user = User(email=form.email.data, username=form.username.data, name=form.name.data,
-                    role=form.role.data, password=form.password.data, is_admin=form.is_admin.data)
+        try:
+            user = User(email=form.email.data, username=form.username.data, name=form.name.data,
+                        role_id=form.role_id.data, password=form.password.data, is_admin=form.is_admin.data)
+        except HashingBusy:
+            flash('The server is busy, please try again in a moment.')
+            return render_template('admin/users/user.html', add_user=add_user, form=form, title='Add user'), 503
         # add user to database
         db.session.add(user)
         db.session.commit()
@@ -62,10 +78,11 @@ def edit_user(id):
         user.username = form.username.data
         user.name = form.name.data
         #user.password = form.password.data
-        user.role = form.role.data
+        user.role_id = form.role_id.data
         user.is_admin = form.is_admin.data
         db.session.add(user)
         db.session.commit()
+        user_cache.delete(user.id)
         flash('The user has been edited successfully!')
 
         # redirect to the users page
@@ -79,13 +96,29 @@ def edit_user(id):
     return render_template('admin/users/user.html', add_user=add_user, form=form, title='Edit user')
 
 
+@admin.route('/users/bulk', methods=['POST'])
+@login_required
+def bulk_users():
+    # Update or delete many users at once, picked by id or by a filter
+    check_admin()
+
+    response, ids = bulk_view(User, fields=('id', 'username', 'email', 'name', 'is_admin', 'role_id'),
+                              writable=('is_admin', 'role_id'))
+    user_cache.delete(*ids)
+    return response
+
+
 # Role views
 @admin.route('/roles')
 @login_required
+@fragment_cache.page('roles', 'users')
 def list_roles():
-    # List all roles
-    roles = Role.query.all()
-    return render_template('admin/roles/roles.html', roles=roles, title='Roles')
+    # List roles one page at a time
+    roles = paginate(Role.query, Role, sort_columns=('id', 'name'), default_sort='id',
+                     load_columns=('id', 'name', 'description'))
+    user_counts = count_by(User.role_id, [role.id for role in roles])
+    return render_template('admin/roles/roles.html', roles=roles.items, page=roles, user_counts=user_counts,
+                           title='Roles')
 
 
 @admin.route('/roles/add', methods=['GET', 'POST'])
@@ -131,6 +164,7 @@ def edit_role(id):
         role.description = form.description.data
         db.session.add(role)
         db.session.commit()
+        user_cache.delete(*role_user_ids(role))
         flash('The role has been edited successfully!')
 
         # redirect to the roles page
@@ -148,11 +182,26 @@ def delete_role(id):
     check_admin()
 
     role = Role.query.get_or_404(id)
+    user_ids = role_user_ids(role)
     db.session.delete(role)
     db.session.commit()
+    user_cache.delete(*user_ids)
     flash('The role has been deleted successfully!')
 
     # redirect to the roles page
     return redirect(url_for('admin.list_roles'))
 
     return render_template(title='Delete role')
+
+
+@admin.route('/roles/bulk', methods=['POST'])
+@login_required
+def bulk_roles():
+    # Update or delete many roles at once; the users of deleted roles are left without a role
+    check_admin()
+
+    response, ids = bulk_view(Role, fields=('id', 'name'), writable=('description',))
+    if ids:
+        # cached users carry the name of their role
+        user_cache.clear()
+    return response
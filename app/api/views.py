@@ -0,0 +1,449 @@
+import datetime
+import hashlib
+import json
+import uuid
+
+from flask import abort, current_app, jsonify, make_response, request, send_file, stream_with_context, url_for, \
+    Response
+from flask_login import current_user, login_required
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import is_resource_modified
+
+from . import api
+from .. import audit_log, data_versions, db, jobs, relationship_graph, statistics
+from ..graph import DIRECTIONS
+from ..models import UserAccount, Identity, Post, IdentityClass, IdentityRole, Relationship, Change, Job, \
+    ObjectVersion, StixId
+from ..pagination import paginate
+from ..stix import feed
+from ..stix.bundle import _is_ref, format_timestamp, parse_timestamp
+from ..stix.tasks import job_file
+
+# Collections of the API and the tables behind them
+RESOURCES = {
+    'user-accounts': UserAccount,
+    'identities': Identity,
+    'posts': Post,
+    'relationships': Relationship,
+    'identity-classes': IdentityClass,
+    'identity-roles': IdentityRole,
+}
+# STIX type of the objects of a collection, used to build the ids of created objects
+STIX_TYPES = {UserAccount: 'user-account', Identity: 'identity', Post: 'post', Relationship: 'relationship'}
+# Columns maintained by the API itself
+READ_ONLY = ('id', 'type', 'created', 'modified')
+
+
+def check_admin():
+    # Writes are reserved to admins, like the HTML views
+    if not current_user.is_admin:
+        abort(403)
+
+
+def get_model(collection):
+    model = RESOURCES.get(collection)
+    if model is None:
+        abort(404)
+    return model
+
+
+def get_id(model, id):
+    # Primary key from the url, converted for the integer ids of the vocabulary tables
+    try:
+        return model.__table__.columns['id'].type.python_type(id)
+    except ValueError:
+        abort(404)
+
+
+def get_fields(model):
+    # Sparse fieldset from ?fields=a,b; the id is always included
+    columns = model.__table__.columns
+    if not request.args.get('fields'):
+        return None
+    fields = set(request.args['fields'].split(','))
+    if not fields.issubset(columns.keys()):
+        abort(400)
+    return sorted(fields | {'id'})
+
+
+def serialize(model, row, fields=None):
+    data = {}
+    for column in model.__table__.columns:
+        if fields is None or column.key in fields:
+            value = getattr(row, column.key)
+            data[column.key] = format_timestamp(value) if isinstance(value, datetime.datetime) else value
+    return data
+
+
+def deserialize(model, data, partial):
+    # Column values of a JSON object sent by a client, aborting on unknown, read only or malformed fields
+    if not isinstance(data, dict):
+        abort(400)
+    columns = model.__table__.columns
+    values = {}
+    for key, value in data.items():
+        if key not in columns or key in READ_ONLY:
+            abort(400)
+        column = columns[key]
+        try:
+            if value is None:
+                if not column.nullable:
+                    raise ValueError(key)
+            elif isinstance(column.type, db.DateTime):
+                value = parse_timestamp(value)
+            elif isinstance(column.type, db.Boolean) and not isinstance(value, bool):
+                raise ValueError(key)
+            elif isinstance(column.type, StixId) and not _is_ref(value):
+                raise ValueError(key)
+            elif isinstance(column.type, db.String) and (not isinstance(value, str)
+                                                         or not (value or column.nullable)):
+                raise ValueError(key)
+        except (TypeError, ValueError):
+            abort(400)
+        values[key] = value
+    if not partial:
+        # complete objects have a name, relationships their type and both refs
+        required = [column.key for column in columns if not column.nullable and column.default is None
+                    and column.key not in READ_ONLY]
+        if ('name' in columns and not values.get('name')) or any(key not in values for key in required):
+            abort(400)
+    return values
+
+
+def make_etag(*parts):
+    return hashlib.md5(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def object_validators(model, id, fields):
+    # ETag and Last-Modified of an object without loading it: STIX objects from their modified column,
+    # vocabulary entries from the data version of their table
+    if 'modified' in model.__table__.columns:
+        row = db.session.query(model.modified).filter(model.id == id).first()
+        if row is None:
+            abort(404)
+        return make_etag(id, row.modified.isoformat() if row.modified else None, fields), row.modified
+    return make_etag(id, data_versions.get(model.__tablename__), fields), None
+
+
+def not_modified(etag):
+    response = make_response('', 304)
+    response.set_etag(etag)
+    return response
+
+
+def respond(data, etag=None, last_modified=None, status=200):
+    response = jsonify(data)
+    response.status_code = status
+    if etag:
+        response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    # clients may keep the response but have to revalidate it on every use
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def check_precondition(model, id):
+    # Optimistic concurrency: a write carrying If-Match only applies to the version the client has seen
+    if request.if_match:
+        etag, _ = object_validators(model, id, None)
+        if not request.if_match.contains(etag):
+            abort(412)
+
+
+@api.errorhandler(HTTPException)
+def api_error(error):
+    return jsonify(error=error.name, status=error.code), error.code
+
+
+def history_page(query):
+    # One page of recorded changes, newest first, between the since and until timestamps
+    try:
+        if request.args.get('since'):
+            query = query.filter(Change.created >= parse_timestamp(request.args['since']))
+        if request.args.get('until'):
+            query = query.filter(Change.created < parse_timestamp(request.args['until']))
+    except ValueError:
+        abort(400)
+    page = paginate(query, Change, sort_columns=('created', 'id'), default_sort='-created',
+                    filter_columns=('object_type', 'object_id', 'action', 'user_id'))
+    data = []
+    for change in page.items:
+        entry = serialize(Change, change)
+        entry['changes'] = json.loads(change.changes) if change.changes else None
+        data.append(entry)
+    return jsonify(data=data, next=page.next_url(), prev=page.prev_url())
+
+
+@api.route('/history')
+@login_required
+def history():
+    # Change history of every table, filtered by object_type, object_id, action, user_id, since and until
+    check_admin()
+    audit_log.flush()
+    return history_page(Change.query)
+
+
+@api.route('/<collection>/<id>/history')
+@login_required
+def object_history(collection, id):
+    # Change history of one object
+    check_admin()
+    model = get_model(collection)
+    audit_log.flush()
+    return history_page(Change.query.filter(Change.object_type == model.__tablename__,
+                                            Change.object_id == str(get_id(model, id))))
+
+
+@api.route('/<collection>/<id>/versions')
+@login_required
+def object_versions(collection, id):
+    # Earlier versions of a STIX object replaced by imports (STIX_VERSION_HISTORY), newest first
+    check_admin()
+    model = get_model(collection)
+    if model not in STIX_TYPES:
+        abort(404)
+    page = paginate(ObjectVersion.query.filter(ObjectVersion.object_id == id), ObjectVersion,
+                    sort_columns=('modified', 'id'), default_sort='-modified')
+    data = []
+    for version in page.items:
+        entry = serialize(ObjectVersion, version)
+        entry['data'] = json.loads(version.data)
+        data.append(entry)
+    return jsonify(data=data, next=page.next_url(), prev=page.prev_url())
+
+
+@api.route('/<collection>/<id>/graph')
+@login_required
+def object_graph(collection, id):
+    # Objects linked to an object through relationships, up to depth hops away and limit objects in all,
+    # along relationships of the given types (type=..., repeated) in the given direction (out, in or both).
+    # Linked ids may belong to objects that are not stored. Revalidated against the data versions of the tables.
+    model = get_model(collection)
+    if model not in STIX_TYPES:
+        abort(404)
+    depth = request.args.get('depth', 1, type=int)
+    limit = request.args.get('limit', current_app.config['GRAPH_MAX_NODES'], type=int)
+    direction = request.args.get('direction', 'both')
+    if not 1 <= depth <= current_app.config['GRAPH_MAX_DEPTH'] or \
+            not 1 <= limit <= current_app.config['GRAPH_MAX_NODES'] or direction not in DIRECTIONS:
+        abort(400)
+    etag = make_etag(id, data_versions.get(model.__tablename__), data_versions.get(Relationship.__tablename__),
+                     sorted(request.args.items(multi=True)))
+    if not is_resource_modified(request.environ, etag=etag):
+        return not_modified(etag)
+    if db.session.query(model.id).filter(model.id == id).first() is None:
+        abort(404)
+
+    subgraph = relationship_graph.traverse([id], depth=depth, limit=limit, types=request.args.getlist('type'),
+                                           direction=direction)
+    return respond(subgraph.to_dict(), etag=etag)
+
+
+@api.route('/statistics')
+@login_required
+def dashboard_statistics():
+    # Counters of the admin dashboard, read from the materialized counters
+    check_admin()
+    report = statistics.report(days=request.args.get('days', 30, type=int))
+    return respond({'data': dict((name, {
+        'total': statistic['total'],
+        'entries': [{'key': key, 'label': label, 'count': count} for key, label, count in statistic['entries']],
+    }) for name, statistic in report.items())})
+
+
+def serialize_job(job):
+    data = serialize(Job, job)
+    data['arguments'] = json.loads(job.arguments) if job.arguments else None
+    data['result'] = json.loads(job.result) if job.result else None
+    return data
+
+
+@api.route('/jobs')
+@login_required
+def list_jobs():
+    # Background jobs, newest first, filtered by task and status
+    check_admin()
+    page = paginate(Job.query, Job, sort_columns=('created', 'id'), default_sort='-created',
+                    filter_columns=('task', 'status'))
+    return jsonify(data=[serialize_job(job) for job in page.items], next=page.next_url(), prev=page.prev_url())
+
+
+@api.route('/jobs', methods=['POST'])
+@login_required
+def create_job():
+    # Queue a job: {"task": "stix.reindex", "arguments": {...}}; imports are queued by the import view
+    check_admin()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('task'), str) or data['task'] == 'stix.import' or \
+            not isinstance(data.get('arguments', {}), dict):
+        abort(400)
+    try:
+        id = jobs.enqueue(data['task'], data.get('arguments'))
+    except KeyError:
+        abort(400)
+    response = respond({'data': serialize_job(Job.query.get(id))}, status=202)
+    response.headers['Location'] = url_for('api.get_job', id=id)
+    return response
+
+
+@api.route('/jobs/<int:id>')
+@login_required
+def get_job(id):
+    # Status and progress of a job, polled by clients waiting for it
+    check_admin()
+    return respond({'data': serialize_job(Job.query.get_or_404(id))})
+
+
+@api.route('/jobs/<int:id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(id):
+    # Cancel a queued job, or ask a running one to stop; 409 once it finished
+    check_admin()
+    Job.query.get_or_404(id)
+    if not jobs.cancel(id):
+        abort(409)
+    db.session.expire_all()
+    return respond({'data': serialize_job(Job.query.get(id))}, status=202)
+
+
+@api.route('/jobs/<int:id>/download')
+@login_required
+def download_job_file(id):
+    # File written by a job that succeeded (exports)
+    check_admin()
+    job = Job.query.get_or_404(id)
+    result = json.loads(job.result) if job.result else None
+    if job.status != 'succeeded' or not isinstance(result, dict) or 'file' not in result:
+        abort(404)
+    return send_file(job_file(jobs.folder(), result['file']), mimetype='application/stix+json', as_attachment=True,
+                     attachment_filename=result['file'])
+
+
+@api.route('/feed')
+@login_required
+def change_feed():
+    # Objects of the given types written after the cursor since, oldest first, with tombstones for deleted
+    # objects. Each page ends with the cursor to ask the next one from; stream=1 sends every change as
+    # newline delimited json instead, fetched limit entries at a time.
+    since = request.args.get('since', 0, type=int)
+    types = request.args.getlist('type')
+    if since < 0 or any(type_name not in feed.MODELS for type_name in types):
+        abort(400)
+    limit = max(1, min(request.args.get('limit', current_app.config['PAGE_SIZE'], type=int),
+                       current_app.config['MAX_PAGE_SIZE']))
+
+    if request.args.get('stream'):
+        def generate(since):
+            while True:
+                entries = feed.entries(since, types, limit).all()
+                for item in feed.changes(entries):
+                    yield json.dumps(item, separators=(',', ':')) + '\n'
+                if len(entries) < limit:
+                    return
+                since = entries[-1].seq
+        return Response(stream_with_context(generate(since)), mimetype='application/x-ndjson')
+
+    entries = feed.entries(since, types, limit + 1).all()
+    has_more, entries = len(entries) > limit, entries[:limit]
+    return jsonify(data=list(feed.changes(entries)), cursor=entries[-1].seq if entries else since,
+                   has_more=has_more)
+
+
+@api.route('/<collection>')
+@login_required
+def list_objects(collection):
+    # List a collection one page at a time. The ETag comes from the data version of the table, so a client
+    # polling an unchanged collection gets a 304 after the one read of the data versions.
+    model = get_model(collection)
+    fields = get_fields(model)
+    etag = make_etag(data_versions.get(model.__tablename__), sorted(request.args.items(multi=True)))
+    if not is_resource_modified(request.environ, etag=etag):
+        return not_modified(etag)
+
+    columns = model.__table__.columns
+    sort_columns = ('id',) + tuple(key for key in ('created', 'modified') if key in columns)
+    page = paginate(model.query, model, sort_columns=sort_columns, default_sort='id', load_columns=fields or ())
+    return respond({'data': [serialize(model, row, fields) for row in page.items],
+                    'next': page.next_url(), 'prev': page.prev_url()}, etag=etag)
+
+
+@api.route('/<collection>/<id>')
+@login_required
+def get_object(collection, id):
+    # One object; If-None-Match and If-Modified-Since are checked against its modified column alone
+    model = get_model(collection)
+    id = get_id(model, id)
+    fields = get_fields(model)
+    etag, last_modified = object_validators(model, id, fields)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return not_modified(etag)
+
+    query = model.query.filter(model.id == id)
+    if fields:
+        query = query.options(load_only(*fields))
+    row = query.first_or_404()
+    return respond({'data': serialize(model, row, fields)}, etag=etag, last_modified=last_modified)
+
+
+@api.route('/<collection>', methods=['POST'])
+@login_required
+def create_object(collection):
+    check_admin()
+    model = get_model(collection)
+    values = deserialize(model, request.get_json(silent=True), partial=False)
+    if model in STIX_TYPES:
+        values['id'] = '{}--{}'.format(STIX_TYPES[model], uuid.uuid4())
+        values['created'] = values['modified'] = datetime.datetime.utcnow()
+    row = model(**values)
+    db.session.add(row)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        abort(409)
+
+    etag, last_modified = object_validators(model, row.id, None)
+    response = respond({'data': serialize(model, row)}, etag=etag, last_modified=last_modified, status=201)
+    response.headers['Location'] = url_for('api.get_object', collection=collection, id=row.id)
+    return response
+
+
+@api.route('/<collection>/<id>', methods=['PUT', 'PATCH'])
+@login_required
+def update_object(collection, id):
+    # PUT and PATCH both update the fields sent, PUT requires the complete writable object
+    check_admin()
+    model = get_model(collection)
+    id = get_id(model, id)
+    check_precondition(model, id)
+    values = deserialize(model, request.get_json(silent=True), partial=request.method == 'PATCH')
+    row = model.query.filter(model.id == id).first_or_404()
+    for key, value in values.items():
+        setattr(row, key, value)
+    if 'modified' in model.__table__.columns:
+        row.modified = datetime.datetime.utcnow()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        abort(409)
+
+    etag, last_modified = object_validators(model, id, None)
+    return respond({'data': serialize(model, row)}, etag=etag, last_modified=last_modified)
+
+
+@api.route('/<collection>/<id>', methods=['DELETE'])
+@login_required
+def delete_object(collection, id):
+    check_admin()
+    model = get_model(collection)
+    id = get_id(model, id)
+    check_precondition(model, id)
+    row = model.query.filter(model.id == id).first_or_404()
+    db.session.delete(row)
+    db.session.commit()
+    return '', 204
@@ -0,0 +1,183 @@
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+
+from flask import has_request_context
+from flask_login import current_user
+from sqlalchemy import event, inspect
+
+from .replicas import RoutingSession
+
+logger = logging.getLogger(__name__)
+
+# column values never copied into the history
+REDACTED = ('password_hash',)
+
+
+def _user_id():
+    if has_request_context() and current_user.is_authenticated:
+        return int(current_user.get_id())
+    return None
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, (datetime.date, datetime.datetime)) else value
+
+
+def _diff(state, action):
+    # {column: [old, new]} of the column attributes of an instance
+    changes = {}
+    for attr in state.mapper.column_attrs:
+        if action == 'update':
+            history = state.attrs[attr.key].history
+            if not history.has_changes():
+                continue
+            old = history.deleted[0] if history.deleted else None
+            new = history.added[0] if history.added else None
+        else:
+            # only what is loaded, deleted rows cannot be read any more
+            value = state.dict.get(attr.key)
+            old, new = (None, value) if action == 'insert' else (value, None)
+        if attr.key in REDACTED:
+            old, new = old and '***', new and '***'
+        changes[attr.key] = [_value(old), _value(new)]
+    return changes
+
+
+class AuditLog(object):
+    # Records who changed what: diffs of the rows flushed by a session are kept with the session and
+    # handed over on commit to a buffer that a background thread appends to the changes table in batches,
+    # off the request path. AUDIT_ASYNC = False writes them on commit instead (tests, in-memory databases).
+
+    def __init__(self, db):
+        self.db = db
+        self.app = None
+        self.written = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def init_app(self, app):
+        from . import bulk
+        self.app = app
+        self._queue = queue.Queue(maxsize=app.config['AUDIT_QUEUE_SIZE'])
+        if not event.contains(RoutingSession, 'after_flush', self._after_flush):
+            event.listen(RoutingSession, 'after_flush', self._after_flush)
+            event.listen(RoutingSession, 'after_commit', self._after_commit)
+            event.listen(RoutingSession, 'after_soft_rollback', self._after_rollback)
+            bulk.after_bulk_update.append(self._after_bulk_update)
+            bulk.after_bulk_delete.append(self._after_bulk_delete)
+            atexit.register(self.flush)
+
+    @property
+    def enabled(self):
+        return self.app is not None and self.app.config['AUDIT_ENABLED']
+
+    def add(self, session, object_type, object_id, action, changes=None):
+        # Record a change made without the unit of work (bulk statements); written when session commits
+        if self.enabled:
+            session.info.setdefault('audit', []).append({
+                'object_type': object_type,
+                'object_id': str(object_id),
+                'action': action,
+                'changes': json.dumps(changes, sort_keys=True, default=str) if changes is not None else None,
+                'user_id': _user_id(),
+                'created': datetime.datetime.utcnow(),
+            })
+
+    def _after_flush(self, session, flush_context):
+        if not self.enabled:
+            return
+        for action, instances in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+            for instance in instances:
+                if instance.__tablename__ == 'changes':
+                    continue
+                state = inspect(instance)
+                changes = _diff(state, action)
+                if action == 'update' and not changes:
+                    continue
+                key = state.identity or state.mapper.primary_key_from_instance(instance)
+                self.add(session, instance.__tablename__, ':'.join(str(part) for part in key), action, changes)
+
+    def _after_bulk_update(self, model, ids, values):
+        changes = dict((key, [None, _value(value)]) for key, value in values.items())
+        for id in ids:
+            self.add(self.db.session, model.__tablename__, id, 'update', changes)
+
+    def _after_bulk_delete(self, model, ids):
+        for id in ids:
+            self.add(self.db.session, model.__tablename__, id, 'delete')
+
+    def _after_commit(self, session):
+        records = session.info.pop('audit', None)
+        if records:
+            self.write(records)
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop('audit', None)
+
+    def write(self, records):
+        if not self.app.config['AUDIT_ASYNC']:
+            self._insert(records)
+            return
+        self._start()
+        for i, record in enumerate(records):
+            try:
+                self._queue.put_nowait(record)
+            except queue.Full:
+                # the writer fell behind: write the rest from the calling thread rather than lose them
+                self._insert(records[i:])
+                break
+
+    def _start(self):
+        # The writer thread is started on first use in each process, so forked server workers get their own
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='audit-log', daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.app.config['AUDIT_FLUSH_INTERVAL'])
+            except queue.Empty:
+                continue
+            self._drain([first])
+
+    def _drain(self, batch):
+        batch_size = self.app.config['AUDIT_BATCH_SIZE']
+        while True:
+            while len(batch) < batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            try:
+                self._insert(batch)
+            except Exception:
+                logger.exception('Could not write %d audit records', len(batch))
+            batch = []
+
+    def _insert(self, records):
+        from .models import Change
+        with self._write_lock:
+            with self.db.get_engine(self.app).begin() as connection:
+                connection.execute(Change.__table__.insert(), records)
+            self.written += len(records)
+
+    def flush(self):
+        # Write the buffered records now, before reading the history
+        if self.app is not None:
+            self._drain([])
+
+    def stats(self):
+        return {'written': self.written, 'buffered': self._queue.qsize()}
@@ -1,10 +1,11 @@
-from flask import flash, redirect, render_template, url_for
+from flask import current_app, flash, redirect, render_template, request, url_for
 from flask_login import login_required, login_user, logout_user
 
 from . import auth
 from .forms import LoginForm, RegistrationForm
-from .. import db
+from .. import db, login_limiter
 from ..models import User
+from ..passwords import HashingBusy
 
 
 @auth.route('/register', methods=['GET', 'POST'])
@@ -12,7 +13,12 @@ def register():
     # Handle requests to register url
     form = RegistrationForm()
     if form.validate_on_submit():
-        user = User(email=form.email.data, username=form.username.data, name=form.name.data, password=form.password.data)
+        try:
+            user = User(email=form.email.data, username=form.username.data, name=form.name.data,
+                        password=form.password.data)
+        except HashingBusy:
+            flash('The server is busy, please try again in a moment.')
+            return render_template('auth/register.html', form=form, title='Register'), 503
         #add user to database
         db.session.add(user)
         db.session.commit()
@@ -25,14 +31,52 @@ def register():
     return render_template('auth/register.html', form=form, title='Register')
 
 
+def login_retry_after(username):
+    # Seconds to wait before another login attempt, 0 when the attempt may go ahead. Checked before any query
+    # or password hash so that credential stuffing costs neither.
+    config = current_app.config
+    if not config['LOGIN_RATE_LIMIT_ENABLED']:
+        return 0
+    return max(
+        login_limiter.take('ip', request.remote_addr, config['LOGIN_IP_PER_MINUTE'] / 60.0, config['LOGIN_IP_BURST']),
+        login_limiter.take('username', username.lower(), config['LOGIN_USERNAME_PER_MINUTE'] / 60.0,
+                           config['LOGIN_USERNAME_BURST']))
+
+
 @auth.route('/login', methods=['GET', 'POST'])
 def login():
     # Handle requests to login url
     form = LoginForm()
     if form.validate_on_submit():
+        retry_after = login_retry_after(form.username.data)
+        if retry_after:
+            flash('Too many login attempts, please try again later.')
+            response = current_app.make_response((render_template('auth/login.html', form=form, title='Login'), 429))
+            response.headers['Retry-After'] = str(int(retry_after) + 1)
+            return response
+
         #check if user exists in database and password matches
         user = User.query.filter_by(username=form.username.data).first()
-        if user is not None and user.verify_password(form.password.data):
+        try:
+            verified = user is not None and user.verify_password(form.password.data)
+        except HashingBusy:
+            flash('The server is busy, please try again in a moment.')
+            return render_template('auth/login.html', form=form, title='Login'), 503
+
+        if verified:
+            # failed attempts before the right password no longer count against the username; the address
+            # keeps its count, one known password must not lift the limit for guessing the others
+            if current_app.config['LOGIN_RATE_LIMIT_ENABLED']:
+                login_limiter.reset('username', form.username.data.lower())
+
+            # upgrade the stored hash when the hashing parameters changed, at a later login when busy
+            if user.password_needs_rehash():
+                try:
+                    user.password = form.password.data
+                    db.session.commit()
+                except HashingBusy:
+                    pass
+
             # log the user in
             login_user(user)
 
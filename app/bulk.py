@@ -0,0 +1,171 @@
+import datetime
+
+from flask import abort, current_app, jsonify, request
+from . import data_versions, db
+from .pagination import coerce
+
+# filter operators of the bulk endpoints, as field__op keys
+OPERATORS = {
+    'eq': lambda column, value: column == value,
+    'ne': lambda column, value: column != value,
+    'lt': lambda column, value: column < value,
+    'le': lambda column, value: column <= value,
+    'gt': lambda column, value: column > value,
+    'ge': lambda column, value: column >= value,
+    'in': lambda column, value: column.in_(value),
+    'isnull': lambda column, value: column.is_(None) if value else column.isnot(None),
+}
+
+# functions called inside the transaction of every updated chunk with (model, ids, values) and of every deleted
+# chunk with (model, ids), for data derived from the rows and kept elsewhere (search index, audit log);
+# bulk statements do not go through the flush events
+after_bulk_delete = []
+after_bulk_update = []
+
+
+class DependentRows(Exception):
+    # Rows of other tables still reference rows to delete, with counts per referencing column
+
+    def __init__(self, counts):
+        super(DependentRows, self).__init__(counts)
+        self.counts = counts
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def build_filter(model, expression, fields):
+    # Conditions of a filter expression such as {"account_type": "unix", "modified__lt": "2020-01-01T00:00:00"}
+    conditions = []
+    for key, value in expression.items():
+        name, _, op = key.partition('__')
+        op = op or 'eq'
+        if name not in fields or op not in OPERATORS:
+            raise ValueError(key)
+        column = getattr(model, name)
+        if op == 'in':
+            if not isinstance(value, list):
+                raise ValueError(key)
+            value = [coerce(column, item, strict=True) for item in value]
+        elif op != 'isnull':
+            value = coerce(column, value, strict=True)
+        conditions.append(OPERATORS[op](column, value))
+    return conditions
+
+
+def select_ids(model, ids=None, conditions=None):
+    # Primary keys of the rows picked by an id list or by filter conditions, read once before the chunks
+    # are written so that rows changed by an earlier chunk are not picked up again
+    query = db.session.query(model.id).order_by(model.id)
+    if ids is not None:
+        query = query.filter(model.id.in_(ids))
+    if conditions:
+        query = query.filter(*conditions)
+    return [row.id for row in query]
+
+
+def dependents(model):
+    # Foreign key columns of other tables referencing the primary key of model
+    for table in db.Model.metadata.sorted_tables:
+        for key in table.foreign_keys:
+            if key.column.table is model.__table__ and table is not model.__table__:
+                yield key.parent
+
+
+def bulk_update(model, ids, values, chunk_size=None):
+    # UPDATE ... WHERE id IN (chunk) per chunk of ids, one transaction per chunk; returns the rows updated
+    chunk_size = chunk_size or current_app.config['BULK_CHUNK_SIZE']
+    count = 0
+    for chunk in chunks(ids, chunk_size):
+        try:
+            count += model.query.filter(model.id.in_(chunk)).update(values, synchronize_session=False)
+            for listener in after_bulk_update:
+                listener(model, chunk, values)
+            data_versions.bump(model.__tablename__)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    db.session.expire_all()
+    return count
+
+
+def bulk_delete(model, ids, nullify=True, chunk_size=None):
+    # DELETE ... WHERE id IN (chunk) per chunk of ids, one transaction per chunk. References from other tables
+    # are set to NULL first, or with nullify=False DependentRows is raised before anything is deleted.
+    chunk_size = chunk_size or current_app.config['BULK_CHUNK_SIZE']
+    columns = list(dependents(model))
+    if not nullify:
+        counts = {}
+        for column in columns:
+            referencing = sum(db.session.query(db.func.count()).filter(column.in_(chunk)).scalar()
+                              for chunk in chunks(ids, chunk_size))
+            if referencing:
+                counts['{}.{}'.format(column.table.name, column.name)] = referencing
+        if counts:
+            raise DependentRows(counts)
+
+    count = 0
+    for chunk in chunks(ids, chunk_size):
+        try:
+            for column in columns:
+                db.session.execute(column.table.update().where(column.in_(chunk)).values({column.name: None}))
+            for listener in after_bulk_delete:
+                listener(model, chunk)
+            count += model.query.filter(model.id.in_(chunk)).delete(synchronize_session=False)
+            data_versions.bump(model.__tablename__, *set(column.table.name for column in columns))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    db.session.expire_all()
+    return count
+
+
+def bulk_view(model, fields, writable):
+    # Run a bulk operation posted as JSON and return the affected count:
+    #   {"action": "update", "ids": [...] or "filter": {...}, "values": {...}}
+    #   {"action": "delete", "ids": [...] or "filter": {...}, "dependents": "nullify" or "restrict"}
+    # Returns the response and the ids of the affected rows.
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or data.get('action') not in ('update', 'delete'):
+        abort(400)
+    ids, expression = data.get('ids'), data.get('filter')
+    # an empty filter would pick every row, ask for it explicitly with {"id__isnull": false}
+    if (ids is None) == (expression is None) or (ids is not None and not isinstance(ids, list)) \
+            or (expression is not None and (not isinstance(expression, dict) or not expression)):
+        abort(400)
+
+    try:
+        if ids is not None:
+            ids = [coerce(model.id, id, strict=True) for id in ids]
+        conditions = build_filter(model, expression, fields) if expression else None
+        values = {}
+        if data['action'] == 'update':
+            if not isinstance(data.get('values'), dict) or not data['values']:
+                abort(400)
+            for key, value in data['values'].items():
+                if key not in writable:
+                    abort(400)
+                values[key] = coerce(getattr(model, key), value, strict=True)
+    except (TypeError, ValueError):
+        abort(400)
+
+    ids = select_ids(model, ids, conditions)
+    if data['action'] == 'update':
+        if 'modified' in model.__table__.columns:
+            values['modified'] = datetime.datetime.utcnow()
+        count = bulk_update(model, ids, values)
+        return jsonify(action='update', matched=len(ids), updated=count), ids
+
+    if data.get('dependents', 'nullify') not in ('nullify', 'restrict'):
+        abort(400)
+    try:
+        count = bulk_delete(model, ids, nullify=data.get('dependents', 'nullify') == 'nullify')
+    except DependentRows as e:
+        response = jsonify(error='Rows are still referenced', dependents=e.counts)
+        response.status_code = 409
+        return response, []
+    return jsonify(action='delete', matched=len(ids), deleted=count), ids
@@ -0,0 +1,178 @@
+import fnmatch
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryCache(object):
+    # In-process LRU cache with a time to live per entry
+
+    def __init__(self, max_size=1024, ttl=300, max_ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_ttl = max_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if self.max_ttl is not None:
+            ttl = min(ttl, self.max_ttl)
+        expires = time.time() + ttl
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class LocalClient(object):
+    # In-process stand-in for a redis client, for development and tests
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.time()):
+                self._data.pop(key, None)
+                return None
+            return entry[1]
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (time.time() + ex if ex else None, value)
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return len([self._data.pop(key) for key in keys if key in self._data])
+
+    def scan_iter(self, match='*'):
+        with self._lock:
+            keys = list(self._data)
+        return iter([key for key in keys if fnmatch.fnmatchcase(key, match)])
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SharedCache(object):
+    # Cache kept in a shared key-value server (any redis-py compatible client) so every worker sees one copy
+
+    def __init__(self, client, prefix, ttl=300):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return '{}:{}'.format(self.prefix, key)
+
+    def get(self, key, default=None):
+        data = self.client.get(self._key(key))
+        if data is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self._key(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                        ex=self.ttl if ttl is None else ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self._key(key) for key in keys])
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self._key('*')))
+        if keys:
+            self.client.delete(*keys)
+
+    def __len__(self):
+        return len(list(self.client.scan_iter(match=self._key('*'))))
+
+
+# process-wide stand-in used when CACHE_REDIS_URL is 'local'
+local_client = LocalClient()
+
+
+def shared_client(url):
+    # Return the client of the shared cache server at url
+    if url == 'local':
+        return local_client
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError('CACHE_REDIS_URL is set but the redis package is not installed')
+    return redis.Redis.from_url(url)
+
+
+class Cache(object):
+    # Named cache configured by the app: <NAME>_CACHE_SIZE and <NAME>_CACHE_TTL, shared when CACHE_REDIS_URL is set.
+    # A cache of database data (follows_writes) kept in process while several web workers run holds its entries
+    # for CACHE_UNSHARED_TTL seconds at most, since writes served by the other workers never reach it.
+
+    def __init__(self, name, follows_writes=True):
+        self.name = name
+        self.follows_writes = follows_writes
+        self.backend = MemoryCache()
+
+    def init_app(self, app):
+        option = self.name.upper() + '_CACHE_'
+        ttl = app.config.get(option + 'TTL', 300)
+        url = app.config.get('CACHE_REDIS_URL')
+        if url:
+            self.backend = SharedCache(shared_client(url), prefix=self.name, ttl=ttl)
+        else:
+            max_ttl = None
+            if self.follows_writes and app.config.get('WEB_CONCURRENCY', 1) > 1:
+                max_ttl = app.config['CACHE_UNSHARED_TTL']
+            self.backend = MemoryCache(max_size=app.config.get(option + 'SIZE', 1024), ttl=ttl, max_ttl=max_ttl)
+        app.extensions.setdefault('caches', {})[self.name] = self
+
+    def get(self, key, default=None):
+        return self.backend.get(str(key), default)
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(str(key), value, ttl)
+
+    def delete(self, *keys):
+        self.backend.delete(*[str(key) for key in keys])
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return {'hits': self.backend.hits, 'misses': self.backend.misses, 'size': len(self.backend)}
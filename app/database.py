@@ -0,0 +1,132 @@
+import os
+import time
+
+import flask_sqlalchemy
+from sqlalchemy import event, exc, orm, text
+from sqlalchemy.pool import QueuePool
+
+from .replicas import RoutingSession, reset_routing
+
+
+class MeteredQueuePool(QueuePool):
+    # QueuePool that records how long checkouts wait for a free connection
+
+    def __init__(self, *args, **kwargs):
+        super(MeteredQueuePool, self).__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(MeteredQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.time() - start
+            self.checkouts += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+
+
+def engine_options(config, url):
+    # Engine options built from the DATABASE_* settings; SQLite keeps the pool Flask-SQLAlchemy picks for it
+    backend = url.get_backend_name()
+    if backend == 'sqlite':
+        return {}
+
+    options = {
+        'poolclass': MeteredQueuePool,
+        'pool_size': config['DATABASE_POOL_SIZE'],
+        'max_overflow': config['DATABASE_POOL_MAX_OVERFLOW'],
+        'pool_timeout': config['DATABASE_POOL_TIMEOUT'],
+        'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+        'pool_pre_ping': config['DATABASE_POOL_PRE_PING'],
+    }
+    # executemany of INSERTs (imports) sent as pages of multi-row VALUES instead of a round trip per row
+    if backend == 'postgresql' and url.get_driver_name() == 'psycopg2':
+        options['executemany_mode'] = 'values'
+
+    timeout = config['DATABASE_STATEMENT_TIMEOUT']
+    if timeout:
+        if backend == 'postgresql':
+            options['connect_args'] = {'options': '-c statement_timeout={:d}'.format(timeout)}
+        elif backend == 'mysql':
+            options['connect_args'] = {'init_command': 'SET SESSION max_execution_time={:d}'.format(timeout)}
+    return options
+
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    # Flask-SQLAlchemy with the pool settings applied to every engine (SQLALCHEMY_ENGINE_OPTIONS still win)
+    # and a session that can send reads to replicas
+
+    def init_app(self, app):
+        super(SQLAlchemy, self).init_app(app)
+
+        @app.before_request
+        def route_request():
+            if self.session.registry.has():
+                reset_routing(self.session())
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(SQLAlchemy, self).create_engine(sa_url, engine_opts)
+        event.listen(engine, 'connect', _record_pid)
+        event.listen(engine, 'checkout', _check_pid)
+        return engine
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super(SQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        options.update(engine_options(app.config, sa_url))
+
+
+def _record_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    # A pooled connection inherited by a forked process (job workers) is dropped without being closed, the
+    # parent keeps using its socket; the pool then opens a new connection for the child
+    pid = connection_record.info.get('pid')
+    if pid is not None and pid != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError('Connection opened by process {}, checked out by {}'.format(pid, os.getpid()))
+
+
+def warm_up(engine, connections):
+    # Open connections up front so the first requests do not pay for connecting
+    opened = [engine.connect() for _ in range(connections)]
+    for connection in opened:
+        connection.close()
+
+
+def dispose_engines(db, app):
+    # Close the pooled connections of every engine of the app, primary and binds
+    for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or ()):
+        db.get_engine(app, bind).dispose()
+
+
+def pool_stats(engine):
+    # Usage of the connection pool of an engine
+    pool = engine.pool
+    stats = {'class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_in=pool.checkedin(), checked_out=pool.checkedout(),
+                     overflow=max(0, pool.overflow()))
+    if isinstance(pool, MeteredQueuePool):
+        stats.update(checkouts=pool.checkouts, timeouts=pool.timeouts,
+                     wait_time=round(pool.wait_time, 6), max_wait_time=round(pool.max_wait_time, 6))
+    return stats
+
+
+def ping(engine):
+    # Run a trivial query and return its latency in seconds, raise if the database is unreachable
+    start = time.time()
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+    return time.time() - start
@@ -0,0 +1,89 @@
+import functools
+import threading
+import time
+
+from flask import current_app, request, session
+from flask_login import current_user
+from markupsafe import Markup
+
+from .cache import Cache
+
+
+def variant(vary):
+    # Part of a cache key telling apart the users a page or fragment looks different for:
+    # None for everybody alike, 'auth' per kind of visitor (anonymous, user, admin), 'user' per user
+    if vary is None:
+        return '*'
+    if not current_user.is_authenticated:
+        return 'anonymous'
+    if vary == 'auth':
+        return 'admin' if current_user.is_admin else 'user'
+    return 'user:{}'.format(current_user.get_id())
+
+
+class FragmentCache(object):
+    # Rendered pages and template fragments keyed on the data version of the tables they show, so a write to
+    # one of the tables makes them stale without explicit invalidation. Kept in the shared cache when configured.
+
+    # tables shown by the layout of every page, the navbar greeting the user
+    layout_tables = ('users', 'roles')
+
+    def __init__(self, versions):
+        self.versions = versions
+        self.cache = Cache('fragment')
+        self.saved = 0.0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.cache.init_app(app)
+        self.saved = 0.0
+        app.add_template_global(self.fragment, 'cache_fragment')
+
+    def key(self, name, tables, vary):
+        parts = [name, variant(vary)]
+        parts.extend('{}={}'.format(table, self.versions.get(table)) for table in sorted(tables))
+        return '|'.join(parts)
+
+    def _hit(self, entry):
+        # entries carry the time it took to build them, counted as saved on every hit
+        with self._lock:
+            self.saved += entry[1]
+        return entry[0]
+
+    def fragment(self, name, *tables, vary='auth', ttl=None, caller=None):
+        # Template global for call blocks: {% call cache_fragment('navbar', vary='user') %}...{% endcall %}
+        if not current_app.config['FRAGMENT_CACHE_ENABLED']:
+            return caller()
+        key = self.key('fragment:' + name, tables, vary)
+        entry = self.cache.get(key)
+        if entry is not None:
+            return Markup(self._hit(entry))
+        start = time.time()
+        html = caller()
+        self.cache.set(key, (str(html), time.time() - start), ttl)
+        return html
+
+    def page(self, *tables, vary='user', ttl=None):
+        # View decorator caching successful GET responses per url; pages with flashed messages pending are
+        # rendered as usual, the messages are shown once
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                if not current_app.config['FRAGMENT_CACHE_ENABLED'] or request.method != 'GET' \
+                        or session.get('_flashes'):
+                    return view(*args, **kwargs)
+                key = self.key('page:' + request.full_path, set(tables + self.layout_tables), vary)
+                entry = self.cache.get(key)
+                if entry is not None:
+                    body, mimetype = self._hit(entry)
+                    return current_app.response_class(body, mimetype=mimetype)
+                start = time.time()
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code == 200 and not response.direct_passthrough:
+                    self.cache.set(key, ((response.get_data(), response.mimetype), time.time() - start), ttl)
+                return response
+            return wrapper
+        return decorator
+
+    def stats(self):
+        return dict(self.cache.stats(), saved_seconds=self.saved)
@@ -0,0 +1,111 @@
+from flask import current_app
+
+from .cache import Cache
+
+DIRECTIONS = ('out', 'in', 'both')
+
+
+class Subgraph(object):
+    # Result of a traversal: hops from the start per node, the relationships between the nodes reached,
+    # and whether the node limit cut the expansion short
+
+    def __init__(self):
+        self.nodes = {}
+        self.edges = {}
+        self.truncated = False
+
+    def to_dict(self):
+        return {
+            'nodes': [{'id': node, 'type': node.split('--', 1)[0], 'depth': depth}
+                      for node, depth in sorted(self.nodes.items(), key=lambda item: (item[1], item[0]))],
+            'edges': [{'id': id, 'relationship_type': relationship_type, 'source_ref': source, 'target_ref': target}
+                      for id, relationship_type, source, target in sorted(self.edges.values())],
+            'truncated': self.truncated,
+        }
+
+
+class RelationshipGraph(object):
+    # Breadth first traversal of the relationships table. Every hop expands the whole frontier with one query
+    # per GRAPH_BATCH_SIZE nodes on the source and target indexes, never one query per node. The adjacency
+    # lists read are cached per node, keyed on the data version of the table, so hot subgraphs are walked
+    # without queries until a relationship is written.
+
+    def __init__(self, db, versions):
+        self.db = db
+        self.versions = versions
+        self.cache = Cache('graph')
+        self.model = None
+        self.chunks = None
+
+    def init_app(self, app):
+        # imported here, both need the app package to be loaded
+        from .bulk import chunks
+        from .models import Relationship
+        self.model, self.chunks = Relationship, chunks
+        self.cache.init_app(app)
+
+    def adjacency(self, nodes):
+        # {node: [(relationship id, relationship type, source, target)]} of every relationship touching nodes
+        table = self.model.__table__
+        use_cache = current_app.config['GRAPH_CACHE_ENABLED']
+        version = self.versions.get(table.name) if use_cache else None
+        result, missing = {}, []
+        for node in nodes:
+            edges = self.cache.get('{}:{}'.format(version, node)) if use_cache else None
+            if edges is None:
+                missing.append(node)
+            else:
+                result[node] = edges
+
+        columns = [table.c.id, table.c.relationship_type, table.c.source_ref, table.c.target_ref]
+        for chunk in self.chunks(missing, current_app.config['GRAPH_BATCH_SIZE']):
+            loaded = dict((node, {}) for node in chunk)
+            query = self.db.select(columns).where(table.c.source_ref.in_(chunk)).union_all(
+                self.db.select(columns).where(table.c.target_ref.in_(chunk)))
+            for id, relationship_type, source, target in self.db.session.execute(query):
+                for node in (source, target):
+                    if node in loaded:
+                        loaded[node][id] = (id, relationship_type, source, target)
+            for node, edges in loaded.items():
+                result[node] = list(edges.values())
+                if use_cache:
+                    self.cache.set('{}:{}'.format(version, node), result[node])
+        return result
+
+    def traverse(self, start, depth=1, limit=None, types=None, direction='both'):
+        # Nodes within depth hops of the start ids along relationships of the given types, following them
+        # from source to target (out), backwards (in) or both ways, and at most limit nodes in all
+        limit = limit or current_app.config['GRAPH_MAX_NODES']
+        subgraph = Subgraph()
+        frontier = []
+        for node in start:
+            if node not in subgraph.nodes:
+                subgraph.nodes[node] = 0
+                frontier.append(node)
+
+        for hop in range(1, depth + 1):
+            if not frontier:
+                break
+            if len(subgraph.nodes) >= limit:
+                # no room for the neighbors of the frontier, do not read their adjacency
+                subgraph.truncated = True
+                break
+            adjacency = self.adjacency(frontier)
+            reached = []
+            for node in frontier:
+                for edge in adjacency[node]:
+                    id, relationship_type, source, target = edge
+                    if types and relationship_type not in types:
+                        continue
+                    if direction == 'out' and source != node or direction == 'in' and target != node:
+                        continue
+                    neighbor = target if source == node else source
+                    if neighbor not in subgraph.nodes:
+                        if len(subgraph.nodes) >= limit:
+                            subgraph.truncated = True
+                            continue
+                        subgraph.nodes[neighbor] = hop
+                        reached.append(neighbor)
+                    subgraph.edges[id] = edge
+            frontier = reached
+        return subgraph
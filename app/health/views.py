@@ -0,0 +1,69 @@
+import ipaddress
+
+from flask import Response, abort, current_app, jsonify, request
+
+from . import health
+from .. import audit_log, db, fragment_cache, login_limiter, metrics, password_hasher
+from ..database import ping, pool_stats
+
+
+@health.before_request
+def check_network():
+    # Monitoring endpoints only answer clients of MONITORING_NETWORKS
+    try:
+        address = ipaddress.ip_address(request.remote_addr or '')
+    except ValueError:
+        abort(404)
+    if not any(address in ipaddress.ip_network(network) for network in current_app.config['MONITORING_NETWORKS']):
+        abort(404)
+
+
+@health.route('/health')
+def check():
+    # Report database reachability and connection pool usage, for load balancers and monitoring
+    engine = db.engine
+    try:
+        latency = ping(engine)
+    except Exception as e:
+        return jsonify(status='error', database={'ok': False, 'error': str(e)}, pool=pool_stats(engine)), 503
+
+    return jsonify(status='ok', database={'ok': True, 'latency': round(latency, 6)}, pool=pool_stats(engine))
+
+
+def resource_metrics():
+    # Metric families of the connection pool, caches and password hashing
+    pool = pool_stats(db.engine)
+    yield ('db_pool_connections', 'gauge', 'Connections of the pool by state',
+           [({'state': state}, pool[state]) for state in ('size', 'checked_in', 'checked_out', 'overflow')
+            if state in pool])
+    if 'checkouts' in pool:
+        yield 'db_pool_checkouts_total', 'counter', 'Connection checkouts', [({}, pool['checkouts'])]
+        yield 'db_pool_timeouts_total', 'counter', 'Checkouts that timed out', [({}, pool['timeouts'])]
+        yield 'db_pool_wait_seconds_total', 'counter', 'Time spent waiting for a connection', [({}, pool['wait_time'])]
+
+    caches = current_app.extensions.get('caches', {})
+    for name, kind in (('hits', 'counter'), ('misses', 'counter'), ('size', 'gauge')):
+        yield ('cache_{}{}'.format(name, '_total' if kind == 'counter' else ''), kind, 'Cache {}'.format(name),
+               [({'cache': cache_name}, cache.stats()[name]) for cache_name, cache in caches.items()])
+
+    yield 'fragment_cache_saved_seconds_total', 'counter', 'Render time saved by cached pages and fragments', \
+        [({}, fragment_cache.stats()['saved_seconds'])]
+
+    yield 'login_rate_limited_total', 'counter', 'Login attempts rejected by the rate limits', \
+        [({'limit': kind}, count) for kind, count in login_limiter.stats().items()]
+
+    audit = audit_log.stats()
+    yield 'audit_records_written_total', 'counter', 'Change history records written', [({}, audit['written'])]
+    yield 'audit_records_buffered', 'gauge', 'Change history records waiting to be written', \
+        [({}, audit['buffered'])]
+
+    hasher = password_hasher.stats()
+    yield 'password_hashes_total', 'counter', 'Passwords hashed or checked', [({}, hasher['hashed'])]
+    yield 'password_hashes_rejected_total', 'counter', 'Logins turned away by a full hashing queue', \
+        [({}, hasher['rejected'])]
+
+
+@health.route('/metrics')
+def prometheus_metrics():
+    # Expose request, database, cache and hashing metrics in the Prometheus text format
+    return Response(metrics.render(resource_metrics()), mimetype='text/plain; version=0.0.4')
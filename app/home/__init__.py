@@ -2,4 +2,4 @@ from flask import Blueprint
 
 home = Blueprint('home', __name__)
 
-from . import views
\ No newline at end of file
+from . import views, commands, tasks
@@ -0,0 +1,13 @@
+import click
+
+from . import home
+from .. import statistics
+
+
+@home.cli.command('statistics')
+def statistics_command():
+    # Recount the counters of the admin dashboard from the tables: flask home statistics
+    statistics.reconcile()
+    for name, counters in sorted(statistics.counts().items()):
+        click.echo('{}: {}'.format(name, ', '.join('{}={}'.format(key or 'none', value)
+                                                  for key, value in sorted(counters.items()))))
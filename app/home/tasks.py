@@ -0,0 +1,8 @@
+from .. import jobs, statistics
+
+
+@jobs.task('statistics.reconcile')
+def reconcile_task(job):
+    # Recount the counters of the admin dashboard
+    statistics.reconcile()
+    return statistics.counts()
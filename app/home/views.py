@@ -2,9 +2,11 @@ from flask import abort, render_template
 from flask_login import current_user, login_required
 
 from . import home
+from .. import fragment_cache, statistics
 
 
 @home.route('/')
+@fragment_cache.page()
 def homepage():
     # handle the request to home page
     return render_template('home/index.html', title="Home page")
@@ -12,6 +14,7 @@ def homepage():
 
 @home.route('/dashboard')
 @login_required
+@fragment_cache.page()
 def dashboard():
     # handle the request to dashboard url
     return render_template('home/dashboard.html', title="Dashboard")
@@ -19,9 +22,11 @@ def dashboard():
 
 @home.route('/admin/dashboard')
 @login_required
+@fragment_cache.page('users', 'roles', 'user_accounts', 'identities', 'identityclasses', 'posts')
 def admin_dashboard():
     # only admins will access this page
     if not current_user.is_admin:
         abort(403)
 
-    return render_template('home/admin_dashboard.html', title="Admin Dashboard")
+    # counts come from the materialized counters, not from the tables
+    return render_template('home/admin_dashboard.html', title="Admin Dashboard", statistics=statistics.report())
@@ -0,0 +1,280 @@
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import click
+from flask import current_app, has_request_context
+from flask.cli import AppGroup
+from flask_login import current_user
+
+logger = logging.getLogger(__name__)
+
+jobs_cli = AppGroup('jobs', help='Background jobs.')
+
+
+class JobCancelled(Exception):
+    # Raised by a progress report of a job whose cancellation was requested
+    pass
+
+
+class JobFailed(Exception):
+    # Raised by a task that would fail the same way on every attempt: the job fails without further retries
+    pass
+
+
+class JobContext(object):
+    # Handed to a task as its first argument: progress reports, which also end the task when it was cancelled,
+    # the folder where the job files are kept and whether a failure of this attempt is final
+
+    def __init__(self, queue, id, attempts=1, max_attempts=1):
+        self.queue = queue
+        self.id = id
+        self.last_attempt = attempts >= max_attempts
+
+    @property
+    def folder(self):
+        return self.queue.folder()
+
+    def progress(self, done, total=None):
+        self.queue.report(self.id, done, total)
+
+
+def _now():
+    return datetime.datetime.utcnow()
+
+
+class JobQueue(object):
+    # Jobs kept in the jobs table and claimed by worker processes without a message broker. Claiming is a
+    # compare-and-set update of a queued row, so any number of workers can poll the same table. Status updates
+    # go through their own connection and commit at once, whatever the transaction of the task.
+
+    def __init__(self, db):
+        self.db = db
+        self.tasks = {}
+        self.app = None
+
+    def init_app(self, app):
+        self.app = app
+        if jobs_cli.name not in app.cli.commands:
+            app.cli.add_command(jobs_cli)
+
+    @property
+    def table(self):
+        return self.db.metadata.tables['jobs']
+
+    def folder(self):
+        # Folder of uploaded bundles and export files, JOBS_FOLDER or instance/jobs
+        folder = current_app.config['JOBS_FOLDER'] or os.path.join(current_app.instance_path, 'jobs')
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def task(self, name):
+        # Decorator registering a function as the task name: function(job, **arguments), returning a json value
+        def decorator(function):
+            self.tasks[name] = function
+            return function
+        return decorator
+
+    def enqueue(self, task, arguments=None, max_attempts=None):
+        # Queue a job and return its id; KeyError for unknown tasks
+        if task not in self.tasks:
+            raise KeyError(task)
+        now = _now()
+        user_id = None
+        if has_request_context() and current_user.is_authenticated:
+            user_id = int(current_user.get_id())
+        result = self.db.session.execute(self.table.insert().values(
+            task=task, arguments=json.dumps(arguments or {}), status='queued', attempts=0,
+            max_attempts=max_attempts or current_app.config['JOBS_MAX_ATTEMPTS'], cancel_requested=False,
+            progress=0, user_id=user_id, created=now, run_after=now))
+        self.db.session.commit()
+        return result.inserted_primary_key[0]
+
+    def _update(self, id, condition=None, **values):
+        table = self.table
+        statement = table.update().where(table.c.id == id)
+        if condition is not None:
+            statement = statement.where(condition)
+        with self.db.engine.begin() as connection:
+            return connection.execute(statement.values(**values)).rowcount
+
+    def cancel(self, id):
+        # Cancel a queued job at once, ask a running one to stop at its next progress report.
+        # False when the job already finished.
+        table = self.table
+        if self._update(id, table.c.status == 'queued', status='cancelled', finished=_now()):
+            return True
+        return bool(self._update(id, table.c.status == 'running', cancel_requested=True))
+
+    def report(self, id, done, total=None):
+        table = self.table
+        values = {'progress': done, 'heartbeat': _now()}
+        if total is not None:
+            values['total'] = total
+        self._update(id, **values)
+        with self.db.engine.connect() as connection:
+            if connection.execute(self.db.select([table.c.cancel_requested]).where(table.c.id == id)).scalar():
+                raise JobCancelled()
+
+    def claim(self, worker):
+        # Take the next job due, or None; a job another worker took in between is skipped
+        table = self.table
+        while True:
+            now = _now()
+            with self.db.engine.connect() as connection:
+                id = connection.execute(self.db.select([table.c.id])
+                                        .where(table.c.status == 'queued').where(table.c.run_after <= now)
+                                        .order_by(table.c.run_after, table.c.id).limit(1)).scalar()
+            if id is None:
+                return None
+            if self._update(id, table.c.status == 'queued', status='running', worker=worker,
+                            attempts=table.c.attempts + 1, started=now, heartbeat=now, error=None):
+                return id
+
+    def heartbeat(self, worker):
+        # Mark the jobs of a worker as alive
+        table = self.table
+        with self.db.engine.begin() as connection:
+            connection.execute(table.update().where(table.c.worker == worker).where(table.c.status == 'running')
+                               .values(heartbeat=_now()))
+
+    def recover(self):
+        # Jobs of workers that stopped sending heartbeats for JOBS_TIMEOUT seconds are retried or failed
+        table = self.table
+        limit = _now() - datetime.timedelta(seconds=current_app.config['JOBS_TIMEOUT'])
+        with self.db.engine.connect() as connection:
+            lost = list(connection.execute(self.db.select([table.c.id]).where(table.c.status == 'running')
+                                           .where(table.c.heartbeat < limit)))
+        for row in lost:
+            self.fail(row.id, 'Worker lost', condition=table.c.heartbeat < limit)
+        return len(lost)
+
+    def fail(self, id, error, condition=None):
+        # End an attempt that failed: queued again after a delay doubling with every attempt, or failed
+        table = self.table
+        with self.db.engine.connect() as connection:
+            job = connection.execute(self.db.select([
+                table.c.attempts, table.c.max_attempts, table.c.cancel_requested]).where(table.c.id == id)).first()
+        running = table.c.status == 'running'
+        condition = running if condition is None else running & condition
+        if job.attempts < job.max_attempts and not job.cancel_requested:
+            delay = current_app.config['JOBS_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+            self._update(id, condition, status='queued', worker=None, error=error,
+                         run_after=_now() + datetime.timedelta(seconds=delay))
+        else:
+            self._update(id, condition, status='cancelled' if job.cancel_requested else 'failed', error=error,
+                         finished=_now())
+
+    def run(self, id):
+        # Run a claimed job in the current app context
+        table = self.table
+        with self.db.engine.connect() as connection:
+            job = connection.execute(self.db.select([table.c.task, table.c.arguments, table.c.attempts,
+                                                     table.c.max_attempts]).where(table.c.id == id)).first()
+        try:
+            task = self.tasks[job.task]
+            result = task(JobContext(self, id, job.attempts, job.max_attempts), **json.loads(job.arguments or '{}'))
+        except JobCancelled:
+            self.db.session.rollback()
+            self._update(id, status='cancelled', finished=_now())
+        except JobFailed as e:
+            self.db.session.rollback()
+            logger.error('Job %s (%s) failed: %s', id, job.task, e)
+            self._update(id, status='failed', error=str(e), finished=_now())
+        except Exception:
+            self.db.session.rollback()
+            logger.exception('Job %s (%s) failed', id, job.task)
+            self.fail(id, traceback.format_exc(limit=-3))
+        else:
+            self._update(id, status='succeeded', result=json.dumps(result), finished=_now())
+        finally:
+            self.db.session.remove()
+
+    def work(self, processes=None, once=False):
+        # Claim and run jobs until interrupted, in a pool of forked worker processes while this one keeps the
+        # heartbeats of their jobs; 0 processes runs the jobs here, where only progress reports are heartbeats.
+        # With once, stop when no job is due.
+        global _app
+        processes = current_app.config['JOBS_WORKER_PROCESSES'] if processes is None else processes
+        worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+        interval = current_app.config['JOBS_POLL_INTERVAL']
+        pool = None
+        if processes:
+            _app = current_app._get_current_object()
+            pool = _pool(processes)
+        running = {}
+        table = self.table
+        try:
+            while True:
+                self.recover()
+                while len(running) < max(processes, 1):
+                    id = self.claim(worker)
+                    if id is None:
+                        break
+                    if pool is None:
+                        self.run(id)
+                        continue
+                    try:
+                        running[pool.submit(_run_in_process, id)] = id
+                    except BrokenProcessPool:
+                        # a process of the pool died since the last round: the job never started, put it back
+                        self._update(id, table.c.status == 'running', status='queued', worker=None,
+                                     attempts=table.c.attempts - 1)
+                        pool = _replace(pool, processes)
+                if not running:
+                    if once:
+                        return
+                    time.sleep(interval)
+                    continue
+                done, _ = wait(running, timeout=interval, return_when=FIRST_COMPLETED)
+                if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                    # a process running a job died, and with it the pool: every job the pool was running fails
+                    # this attempt, at once, and a new pool takes the next ones
+                    done, _ = wait(running)
+                    pool = _replace(pool, processes)
+                for future in done:
+                    id = running.pop(future)
+                    if future.exception() is not None:
+                        self.fail(id, repr(future.exception()))
+                self.heartbeat(worker)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True)
+
+
+def _pool(processes):
+    # the forked processes inherit the pooled connections of this one, which keeps using them for claims and
+    # heartbeats; the pool drops them in a child at its first checkout (database._check_pid)
+    return ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'))
+
+
+def _replace(pool, processes):
+    # A new pool in place of a broken one
+    pool.shutdown(wait=False)
+    return _pool(processes)
+
+
+# app of the worker command, inherited by the processes of its pool
+_app = None
+
+
+def _run_in_process(id):
+    from . import jobs
+    with _app.app_context():
+        jobs.run(id)
+
+
+@jobs_cli.command('worker')
+@click.option('--processes', type=int, default=None, help='Worker processes, 0 runs jobs in this process.')
+@click.option('--once', is_flag=True, help='Stop when no job is due.')
+def worker_command(processes, once):
+    # Run queued jobs: flask jobs worker
+    from . import jobs
+    jobs.work(processes, once)
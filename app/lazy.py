@@ -0,0 +1,24 @@
+from werkzeug.utils import cached_property, import_string
+
+
+class LazyView(object):
+    # View function imported on its first call, so a blueprint can register its urls without importing
+    # its views, forms and their dependencies at startup
+
+    def __init__(self, import_name):
+        self.import_name = import_name
+        self.__module__, self.__name__ = import_name.rsplit('.', 1)
+
+    @cached_property
+    def view(self):
+        return import_string(self.import_name)
+
+    def __call__(self, *args, **kwargs):
+        return self.view(*args, **kwargs)
+
+
+def add_lazy_routes(blueprint, module, routes):
+    # Register (rule, view name, methods) routes of views living in module
+    for rule, name, methods in routes:
+        blueprint.add_url_rule(rule, endpoint=name, view_func=LazyView('{}.{}'.format(module, name)),
+                               methods=methods)
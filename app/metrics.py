@@ -0,0 +1,175 @@
+import bisect
+import itertools
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import g, has_app_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram(object):
+    # Prometheus style histogram: counts per upper bound, sum and count of the observations
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            yield name + '_bucket', dict(labels, le=le), cumulative
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in sorted(labels.items())) + '}'
+
+
+class TimedTemplate(Template):
+    # Jinja template adding its render time to the metrics of the current request
+
+    def render(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            if has_app_context() and getattr(g, 'request_metrics', None) is not None:
+                g.request_metrics['template_time'] += time.time() - start
+
+
+# the start time is kept on the execution context, which goes away with the statement whether it succeeds or
+# fails; after_cursor_execute does not fire for a statement that raises
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start = time.time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.time() - context._query_start
+    if has_app_context() and getattr(g, 'request_metrics', None) is not None:
+        g.request_metrics['queries'] += 1
+        g.request_metrics['sql_time'] += elapsed
+        g.request_metrics['statements'][statement] += 1
+        if elapsed >= g.request_metrics['slow_query_seconds']:
+            g.request_metrics['slow'].append((elapsed, statement))
+
+
+class Metrics(object):
+    # Per endpoint request latency, SQL and template timings, slow queries and N+1 patterns,
+    # rendered in the Prometheus text format
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.requests = Counter()
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.query_count = defaultdict(lambda: Histogram(QUERY_COUNT_BUCKETS))
+        self.sql_time = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.template_time = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.slow_queries = Counter()
+        self.n_plus_one = Counter()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.reset()
+        self.app = app
+        app.jinja_env.template_class = TimedTemplate
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+
+    def _start_request(self):
+        g.request_metrics = {
+            'start': time.time(),
+            'queries': 0,
+            'sql_time': 0.0,
+            'template_time': 0.0,
+            'statements': Counter(),
+            'slow': [],
+            'slow_query_seconds': self.app.config['METRICS_SLOW_QUERY_SECONDS'],
+        }
+
+    def _finish_request(self, response):
+        self._record(response.status_code)
+        return response
+
+    def _teardown_request(self, error):
+        # requests ending with an unhandled exception skip after_request
+        if getattr(g, 'request_metrics', None) is not None:
+            self._record(500)
+
+    def _record(self, status):
+        data, g.request_metrics = g.request_metrics, None
+        endpoint = request.endpoint or 'unmatched'
+        elapsed = time.time() - data['start']
+
+        threshold = self.app.config['METRICS_N_PLUS_ONE_THRESHOLD']
+        repeated = [(statement, count) for statement, count in data['statements'].items()
+                    if count >= threshold and statement.lstrip().upper().startswith('SELECT')]
+        for duration, statement in data['slow']:
+            logger.warning('Slow query (%.3fs) in %s: %s', duration, endpoint, statement)
+        for statement, count in repeated:
+            logger.warning('Possible N+1 query in %s, run %d times: %s', endpoint, count, statement)
+
+        with self._lock:
+            self.requests[(endpoint, request.method, status)] += 1
+            self.latency[endpoint].observe(elapsed)
+            self.query_count[endpoint].observe(data['queries'])
+            self.sql_time[endpoint].observe(data['sql_time'])
+            self.template_time[endpoint].observe(data['template_time'])
+            self.slow_queries[endpoint] += len(data['slow'])
+            self.n_plus_one[endpoint] += len(repeated)
+
+    def _families(self):
+        with self._lock:
+            yield ('http_requests_total', 'counter', 'Requests by endpoint, method and status',
+                   [({'endpoint': e, 'method': m, 'status': s}, n) for (e, m, s), n in self.requests.items()])
+            for name, help, histograms in (
+                    ('http_request_duration_seconds', 'Request latency', self.latency),
+                    ('db_queries_per_request', 'SQL queries run by a request', self.query_count),
+                    ('db_query_seconds_per_request', 'Time a request spent in SQL', self.sql_time),
+                    ('template_render_seconds', 'Time a request spent rendering templates', self.template_time)):
+                yield (name, 'histogram', help,
+                       [sample for endpoint, histogram in histograms.items()
+                        for sample in histogram.samples(name, {'endpoint': endpoint})])
+            yield ('db_slow_queries_total', 'counter', 'Queries slower than METRICS_SLOW_QUERY_SECONDS',
+                   [({'endpoint': e}, n) for e, n in self.slow_queries.items()])
+            yield ('db_n_plus_one_total', 'counter',
+                   'SELECT statements repeated METRICS_N_PLUS_ONE_THRESHOLD times in a request',
+                   [({'endpoint': e}, n) for e, n in self.n_plus_one.items()])
+
+    def render(self, extra=()):
+        # Exposition in the Prometheus text format; extra holds more (name, type, help, samples) families.
+        # Samples are (labels, value), histogram samples carry their own name: (name, labels, value).
+        lines = []
+        for name, kind, help, samples in itertools.chain(self._families(), extra):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for sample in samples:
+                sample_name, labels, value = sample if len(sample) == 3 else (name,) + tuple(sample)
+                lines.append('{}{} {}'.format(sample_name, _format_labels(labels), repr(float(value))))
+        return '\n'.join(lines) + '\n'
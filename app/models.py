@@ -1,8 +1,97 @@
+from flask import current_app
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import joinedload, selectinload, subqueryload
+from sqlalchemy.sql.functions import FunctionElement
 import datetime
+import re
+import string
+
+from app import db, login_manager, password_hasher, user_cache
+
+
+# STIX types of the ids stored in StixId columns holding any type, by their one byte code (position + 1).
+# The codes are stored in the database: new types are appended, never inserted or reordered.
+STIX_TYPE_CODES = (
+    'identity', 'user-account', 'post', 'relationship', 'attack-pattern', 'campaign', 'course-of-action',
+    'grouping', 'indicator', 'infrastructure', 'intrusion-set', 'location', 'malware', 'malware-analysis',
+    'note', 'observed-data', 'opinion', 'report', 'threat-actor', 'tool', 'vulnerability', 'sighting',
+    'marking-definition', 'extension-definition', 'language-content', 'artifact', 'autonomous-system',
+    'directory', 'domain-name', 'email-addr', 'email-message', 'file', 'ipv4-addr', 'ipv6-addr', 'mac-addr',
+    'mutex', 'network-traffic', 'process', 'software', 'url', 'windows-registry-key', 'x509-certificate',
+)
+_stix_type_code = dict((name, code) for code, name in enumerate(STIX_TYPE_CODES, 1))
+# uuid in its canonical form, the only one stored compactly since any other would not read back the same
+_canonical_uuid = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\Z')
+
+
+class StixId(db.TypeDecorator):
+    # STIX id ("type--uuid") stored as the 16 bytes of its uuid when the column holds one type, or as a type
+    # code and the uuid when it holds any (relationship refs). Ids that do not end in a canonical uuid, or whose
+    # type has no code, are stored as their text behind a zero byte, at a length a compact id never has, so
+    # that every id round-trips unchanged. The python side only ever sees the id strings.
+
+    impl = db.LargeBinary
+    # longest id accepted, as for the String(64) columns the ids were kept in before
+    length = 64
+
+    def __init__(self, type_name=None):
+        # type_name of the ids of a column holding one type, None for any
+        super(StixId, self).__init__()
+        self.type_name = type_name
 
-from app import db, login_manager
+    @property
+    def python_type(self):
+        return str
+
+    def encode(self, value):
+        type_name, separator, suffix = value.partition('--')
+        if separator and _canonical_uuid.match(suffix) and (type_name == self.type_name if self.type_name
+                                                             else type_name in _stix_type_code):
+            compact = bytes.fromhex(suffix.replace('-', ''))
+            return compact if self.type_name else bytes([_stix_type_code[type_name]]) + compact
+        # a zero byte starts the text, a second one keeps it from being 16 bytes long like a uuid
+        text = b'\x00' + value.encode('utf-8')
+        return b'\x00' + text if self.type_name and len(text) == 16 else text
+
+    def decode(self, value):
+        value = bytes(value)
+        if self.type_name and len(value) == 16:
+            type_name = self.type_name
+        elif not self.type_name and value[:1] != b'\x00':
+            type_name, value = STIX_TYPE_CODES[value[0] - 1], value[1:]
+        else:
+            return value.lstrip(b'\x00').decode('utf-8')
+        digits = value.hex()
+        return '{}--{}-{}-{}-{}-{}'.format(type_name, digits[:8], digits[8:12], digits[12:16], digits[16:20],
+                                          digits[20:])
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, str):
+            raise ValueError('STIX id must be a string: {!r}'.format(value))
+        return self.encode(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else self.decode(value)
+
+
+class lower_ascii(FunctionElement):
+    # lower() of the ASCII letters only, the way SQLite folds them and normalize_name does; PostgreSQL folds by
+    # the collation of its argument, which the "C" collation limits to ASCII
+    name = 'lower_ascii'
+    type = db.String()
+
+
+@compiles(lower_ascii)
+def _compile_lower_ascii(element, compiler, **kw):
+    return 'lower({})'.format(compiler.process(element.clauses, **kw))
+
+
+@compiles(lower_ascii, 'postgresql')
+def _compile_lower_ascii_postgresql(element, compiler, **kw):
+    return 'lower({} COLLATE "C")'.format(compiler.process(element.clauses, **kw))
 
 
 class User(UserMixin, db.Model):
@@ -17,6 +106,7 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(128))
     role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
     is_admin = db.Column(db.Boolean, default=False)
+    role = db.relationship('Role', back_populates='users')
 
     @property
     def password(self):
@@ -26,20 +116,52 @@ class User(UserMixin, db.Model):
     @password.setter
     def password(self, password):
         # Set a hashed password
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def verify_password(self, password):
         # Check if password matches the hashed password
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        # Check if the password was hashed with outdated parameters
+        return password_hasher.needs_rehash(self.password_hash)
 
     def __repr__(self):
         return '<User: {}>'.format(self.username)
 
 
-# Load user with user id
+class CachedUser(UserMixin):
+    # Snapshot of a user kept in the user cache and used as current_user
+
+    def __init__(self, id, username, name, email, is_admin, role_id, role_name):
+        self.id = id
+        self.username = username
+        self.name = name
+        self.email = email
+        self.is_admin = is_admin
+        self.role_id = role_id
+        self.role_name = role_name
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.name, user.email, bool(user.is_admin), user.role_id,
+                   user.role.name if user.role else None)
+
+    def __repr__(self):
+        return '<CachedUser: {}>'.format(self.username)
+
+
+# Load user with user id, from the user cache when possible
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user = user_cache.get(user_id)
+    if user is None:
+        user = User.query.get(int(user_id))
+        if user is None:
+            return None
+        user = CachedUser.from_user(user)
+        user_cache.set(user_id, user)
+    return user
 
 
 class Role(db.Model):
@@ -50,7 +172,7 @@ class Role(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(60), unique=True)
     description = db.Column(db.String(200))
-    users = db.relationship('User', backref='role', lazy='dynamic')
+    users = db.relationship('User', back_populates='role', lazy='dynamic')
 
     def __repr__(self):
         return '<Role: {}>'.format(self.name)
@@ -60,13 +182,17 @@ class UserAccount(db.Model):
     # UserAccount table for STIX format
 
     __tablename__ = 'user_accounts'
+    __table_args__ = (
+        # names are unique regardless of case; the index also serves the name lookups of the forms
+        db.Index('ix_user_accounts_name_lower', lower_ascii(db.text('name')), unique=True),
+    )
 
-    id = db.Column(db.String(64), primary_key=True)
+    id = db.Column(StixId('user-account'), primary_key=True)
     name = db.Column(db.String(64))
     description = db.Column(db.Text, nullable=True)
     type = db.Column(db.String(64), default="user-account")
-    created = db.Column(db.DateTime, default=datetime.datetime.now)
-    modified = db.Column(db.DateTime, default=datetime.datetime.now)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
+    modified = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, index=True)
     account_type = db.Column(db.String(32), nullable=True)
     account_created = db.Column(db.DateTime, nullable=True)
     account_is_disabled = db.Column(db.Boolean, default=False)
@@ -79,17 +205,22 @@ class Identity(db.Model):
     # Identity table for STIX format
 
     __tablename__ = 'identities'
+    __table_args__ = (
+        db.Index('ix_identities_name_lower', lower_ascii(db.text('name')), unique=True),
+    )
 
-    id = db.Column(db.String(64), primary_key=True)
+    id = db.Column(StixId('identity'), primary_key=True)
     name = db.Column(db.String(64))
     description = db.Column(db.Text, nullable=True)
     type = db.Column(db.String(64), default="identity")
-    created = db.Column(db.DateTime, default=datetime.datetime.now)
-    modified = db.Column(db.DateTime, default=datetime.datetime.now)
-    identity_role = db.Column(db.Integer, db.ForeignKey('identityroles.id', ondelete=db.null), nullable=True)
-    identity_class = db.Column(db.Integer, db.ForeignKey('identityclasses.id', ondelete=db.null), nullable=True)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
+    modified = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, index=True)
+    identity_role = db.Column(db.Integer, db.ForeignKey('identityroles.id', ondelete='SET NULL'), nullable=True)
+    identity_class = db.Column(db.Integer, db.ForeignKey('identityclasses.id', ondelete='SET NULL'), nullable=True)
     contact_information = db.Column(db.String(128), nullable=True)
     location = db.Column(db.String(128), nullable=True)
+    identity_role_entry = db.relationship('IdentityRole', back_populates='identities')
+    identity_class_entry = db.relationship('IdentityClass', back_populates='identities')
 
     def __repr__(self):
         return '<Identity: {}>'.format(self.name)
@@ -101,12 +232,12 @@ class Post(db.Model):
 
     __tablename__ = 'posts'
 
-    id = db.Column(db.String(64), primary_key=True)
+    id = db.Column(StixId('post'), primary_key=True)
     text = db.Column(db.String(64), nullable=True)
     description = db.Column(db.Text, nullable=True)
     type = db.Column(db.String(64), default="post")
-    created = db.Column(db.DateTime, default=datetime.datetime.now)
-    modified = db.Column(db.DateTime, default=datetime.datetime.now)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
+    modified = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, index=True)
     post_type = db.Column(db.String(64), nullable=True)
     post_url = db.Column(db.String(64), nullable=True)
 
@@ -114,6 +245,31 @@ class Post(db.Model):
         return '<Post: {}>'.format(self.text)
 
 
+class Relationship(db.Model):
+    # STIX relationship objects, and the links held by *_ref properties of the other objects (derived).
+    # The refs are STIX ids of any type, any of them may point to an object that is not stored here.
+
+    __tablename__ = 'relationships'
+    __table_args__ = (
+        # adjacency of a node in either direction, optionally of one relationship type, from the index alone
+        db.Index('ix_relationships_source', 'source_ref', 'relationship_type', 'target_ref'),
+        db.Index('ix_relationships_target', 'target_ref', 'relationship_type', 'source_ref'),
+    )
+
+    id = db.Column(StixId('relationship'), primary_key=True)
+    type = db.Column(db.String(64), default="relationship")
+    relationship_type = db.Column(db.String(64), nullable=False)
+    source_ref = db.Column(StixId(), nullable=False)
+    target_ref = db.Column(StixId(), nullable=False)
+    description = db.Column(db.Text, nullable=True)
+    derived = db.Column(db.Boolean, nullable=False, default=False)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
+    modified = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return '<Relationship: {} {} {}>'.format(self.source_ref, self.relationship_type, self.target_ref)
+
+
 
 class IdentityClass(db.Model):
     # Identity Class OV table
@@ -123,6 +279,7 @@ class IdentityClass(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64))
     description = db.Column(db.Text, nullable=True)
+    identities = db.relationship('Identity', back_populates='identity_class_entry', lazy='dynamic')
 
 
 class IdentityRole(db.Model):
@@ -133,3 +290,164 @@ class IdentityRole(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64))
     description = db.Column(db.Text, nullable=True)
+    identities = db.relationship('Identity', back_populates='identity_role_entry', lazy='dynamic')
+
+
+class Change(db.Model):
+    # Append-only history of the rows changed through the app, written by the audit log
+
+    __tablename__ = 'changes'
+    __table_args__ = (
+        db.Index('ix_changes_object', 'object_id', 'created'),
+        db.Index('ix_changes_created', 'created'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    object_type = db.Column(db.String(64), nullable=False)
+    object_id = db.Column(db.String(64), nullable=False)
+    action = db.Column(db.String(16), nullable=False)
+    # json object of the changed columns: {"column": [old value, new value]}
+    changes = db.Column(db.Text, nullable=True)
+    user_id = db.Column(db.Integer, nullable=True)
+    created = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<Change: {} {} {}>'.format(self.action, self.object_type, self.object_id)
+
+
+class FeedEntry(db.Model):
+    # Change feed of the STIX objects: one entry per object, moved to a new sequence number by every write
+    # and kept as a tombstone when the object is deleted
+
+    __tablename__ = 'feed'
+
+    seq = db.Column(db.Integer, primary_key=True)
+    object_type = db.Column(db.String(64), nullable=False)
+    object_id = db.Column(db.String(64), nullable=False, unique=True)
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    created = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<FeedEntry: {} {}>'.format(self.seq, self.object_id)
+
+
+class ObjectVersion(db.Model):
+    # Versions of STIX objects replaced by newer ones in imports, kept when STIX_VERSION_HISTORY is set
+
+    __tablename__ = 'object_versions'
+    __table_args__ = (
+        db.Index('ix_object_versions_object', 'object_id', 'modified'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    object_type = db.Column(db.String(64), nullable=False)
+    object_id = db.Column(StixId(), nullable=False)
+    modified = db.Column(db.DateTime, nullable=True)
+    # json object of the column values of the version
+    data = db.Column(db.Text, nullable=False)
+    # when the version was replaced
+    created = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<ObjectVersion: {} {}>'.format(self.object_id, self.modified)
+
+
+class Statistic(db.Model):
+    # Materialized counters of the admin dashboard: rows per value of a column, kept up to date by the
+    # statistics subsystem on every write
+
+    __tablename__ = 'statistics'
+
+    name = db.Column(db.String(64), primary_key=True)
+    key = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<Statistic: {} {}={}>'.format(self.name, self.key, self.value)
+
+
+class DataVersion(db.Model):
+    # Version of the rows of each table, incremented by the data versions in the transaction of every write
+
+    __tablename__ = 'data_versions'
+
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<DataVersion: {}={}>'.format(self.name, self.version)
+
+
+class Job(db.Model):
+    # Background job queue: jobs are claimed by the workers of `flask jobs worker`, run with progress reports
+    # and retried with a growing delay until max_attempts
+
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        # the next job to claim
+        db.Index('ix_jobs_queue', 'status', 'run_after'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    task = db.Column(db.String(64), nullable=False)
+    # json object of the keyword arguments of the task
+    arguments = db.Column(db.Text, nullable=True)
+    # queued, running, succeeded, failed or cancelled
+    status = db.Column(db.String(16), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=1)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=True)
+    # json value returned by the task, or the error of the last attempt
+    result = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    user_id = db.Column(db.Integer, nullable=True)
+    worker = db.Column(db.String(64), nullable=True)
+    created = db.Column(db.DateTime, nullable=False)
+    run_after = db.Column(db.DateTime, nullable=False)
+    started = db.Column(db.DateTime, nullable=True)
+    heartbeat = db.Column(db.DateTime, nullable=True)
+    finished = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return '<Job: {} {} {}>'.format(self.id, self.task, self.status)
+
+
+loader_strategies = {
+    'joined': joinedload,
+    'selectin': selectinload,
+    'subquery': subqueryload,
+}
+
+
+def eager(relationship, *columns):
+    # Loader option eager loading a relationship with the EAGER_LOADING strategy, limited to some columns
+    option = loader_strategies[current_app.config['EAGER_LOADING']](relationship)
+    return option.load_only(*columns) if columns else option
+
+
+def count_by(column, ids):
+    # Number of rows per value of a foreign key column, for the given values, in one query
+    if not ids:
+        return {}
+    return dict(db.session.query(column, db.func.count()).filter(column.in_(ids)).group_by(column))
+
+
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def normalize_name(name):
+    # Form of a name compared by the case insensitive unique indexes: only ASCII letters are folded, as
+    # lower_ascii does in the database
+    return name.translate(_ASCII_LOWER) if name else name
+
+
+def names_in_use(model, names):
+    # Map of the normalized names already taken in the table of model to the id of the row holding them,
+    # checked for any number of candidate names in one indexed query
+    keys = set(normalize_name(name) for name in names if name)
+    if not keys:
+        return {}
+    key = lower_ascii(model.name)
+    return dict((row.key, row.id) for row in db.session.query(key.label('key'), model.id).filter(key.in_(keys)))
@@ -0,0 +1,161 @@
+import base64
+import datetime
+import json
+
+from flask import abort, current_app, request, url_for
+from sqlalchemy import and_, or_, types
+from sqlalchemy.orm import load_only
+
+
+class KeysetPage(object):
+    # One page of rows fetched with keyset (cursor) pagination
+
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def url(self, **cursor):
+        # Build the url of the current view with the same sort/filter arguments and a new cursor
+        args = request.args.to_dict()
+        args.pop('after', None)
+        args.pop('before', None)
+        args.update(request.view_args or {})
+        args.update(cursor)
+        return url_for(request.endpoint, **args)
+
+    def next_url(self):
+        return self.url(after=self.next_cursor) if self.has_next else None
+
+    def prev_url(self):
+        return self.url(before=self.prev_cursor) if self.has_prev else None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(values):
+    # Encode the key values of a row into an opaque url-safe cursor
+    values = [v.isoformat() if isinstance(v, datetime.datetime) else v for v in values]
+    payload = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, keys):
+    # Decode a cursor back into values typed like the key columns, raise ValueError if it is malformed
+    try:
+        payload = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii'))
+        values = json.loads(payload.decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+    return [coerce(key, value) for key, value in zip(keys, values)]
+
+
+def coerce(key, value, strict=False):
+    # Convert a json or query string value to the python type of a column, ValueError if it has none. Times
+    # with an offset are converted to naive UTC like the stored ones. Strict, for json bodies: booleans must be
+    # true or false, and text columns take strings only.
+    if value is None:
+        return None
+    column_type = key.property.columns[0].type
+    if isinstance(column_type, types.Boolean):
+        if isinstance(value, bool):
+            return value
+        if strict:
+            raise ValueError(value)
+        return str(value).lower() in ('1', 'true', 'yes', 'y', 'on')
+    if isinstance(column_type, types.Integer):
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError(value)
+        return int(value)
+    if not isinstance(value, str):
+        if strict or isinstance(column_type, types.DateTime):
+            raise ValueError(value)
+        value = str(value)
+    if isinstance(column_type, types.DateTime):
+        value = datetime.datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _after(keys, values, descending):
+    # (k1, k2, ...) > (v1, v2, ...) spelled out so every backend can use the index on k1
+    clauses = []
+    for i, key in enumerate(keys):
+        past = key < values[i] if descending else key > values[i]
+        clauses.append(and_(*[keys[j] == values[j] for j in range(i)] + [past]))
+    return or_(*clauses)
+
+
+def keyset_paginate(query, keys, per_page, after=None, before=None, descending=False):
+    # Fetch one page of query ordered by keys, starting after (or ending before) a cursor
+    if before is not None:
+        values = decode_cursor(before, keys)
+        order = [key.asc() if descending else key.desc() for key in keys]
+        rows = query.filter(_after(keys, values, not descending)).order_by(*order).limit(per_page + 1).all()
+        items = rows[:per_page][::-1]
+        has_prev, has_next = len(rows) > per_page, True
+    else:
+        order = [key.desc() if descending else key.asc() for key in keys]
+        if after is not None:
+            query = query.filter(_after(keys, decode_cursor(after, keys), descending))
+        rows = query.order_by(*order).limit(per_page + 1).all()
+        items = rows[:per_page]
+        has_prev, has_next = after is not None, len(rows) > per_page
+
+    def cursor(item):
+        return encode_cursor([getattr(item, key.key) for key in keys])
+
+    return KeysetPage(items, per_page,
+                      next_cursor=cursor(items[-1]) if items and has_next else None,
+                      prev_cursor=cursor(items[0]) if items and has_prev else None)
+
+
+def paginate(query, model, sort_columns, default_sort, filter_columns=(), load_columns=()):
+    # Paginate a list view from the sort, filter, per_page and cursor arguments of the request
+    args = request.args
+    sort = args.get('sort', default_sort)
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort not in sort_columns:
+        abort(400)
+
+    per_page = args.get('per_page', current_app.config['PAGE_SIZE'], type=int)
+    per_page = max(1, min(per_page, current_app.config['MAX_PAGE_SIZE']))
+
+    try:
+        for name in filter_columns:
+            if name in args:
+                column = getattr(model, name)
+                query = query.filter(column == coerce(column, args[name]))
+    except ValueError:
+        abort(400)
+
+    # the primary key breaks ties so the sort order is total and no row is skipped or repeated
+    primary_key = model.__mapper__.primary_key[0].key
+    names = [sort] if sort == primary_key else [sort, primary_key]
+    keys = [getattr(model, name) for name in names]
+
+    if load_columns:
+        query = query.options(load_only(*set(load_columns).union(names)))
+
+    try:
+        return keyset_paginate(query, keys, per_page, after=args.get('after'), before=args.get('before'),
+                               descending=descending)
+    except ValueError:
+        abort(400)
@@ -0,0 +1,94 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+
+class HashingBusy(Exception):
+    # Raised when too many password hashes are already waiting for a worker
+    pass
+
+
+def _normalize_method(method):
+    # Spell out the pbkdf2 iterations werkzeug would use, so stored hashes can be compared with the setting
+    parts = method.split(':')
+    if parts[0] == 'pbkdf2' and len(parts) == 2:
+        parts.append(str(DEFAULT_PBKDF2_ITERATIONS))
+    return ':'.join(parts)
+
+
+class PasswordHasher(object):
+    # Hashes and checks passwords in a bounded pool of worker processes so the CPU work does not hold
+    # request threads; PASSWORD_HASH_WORKERS = 0 hashes inline in the calling thread
+
+    def __init__(self):
+        self.method = _normalize_method('pbkdf2:sha256')
+        self.salt_length = 8
+        self.workers = 0
+        self.timeout = None
+        self.hashed = 0
+        self.rejected = 0
+        self._executor = None
+        self._pid = None
+        self._slots = threading.BoundedSemaphore(32)
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.configure(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_SALT_LENGTH'],
+                       app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE_SIZE'],
+                       app.config['PASSWORD_HASH_QUEUE_TIMEOUT'])
+
+    def configure(self, method, salt_length=8, workers=0, queue_size=32, timeout=None):
+        self.shutdown()
+        self.method = _normalize_method(method)
+        self.salt_length = salt_length
+        self.workers = workers
+        self.timeout = timeout
+        # hashes running or waiting, beyond that logins are turned away instead of piling up
+        self._slots = threading.BoundedSemaphore(max(1, workers) + queue_size)
+
+    def _get_executor(self):
+        # The pool is started on first use in each process, so it is never inherited by forked server workers
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            self.rejected += 1
+            raise HashingBusy()
+        try:
+            if self.workers:
+                result = self._get_executor().submit(func, *args).result()
+            else:
+                result = func(*args)
+            self.hashed += 1
+            return result
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # Check if a stored hash was made with other parameters than the configured ones: method$salt$hash,
+        # plain passwords have no salt
+        parts = pwhash.split('$')
+        if len(parts) != 3 or parts[0] != self.method:
+            return True
+        return self.method != 'plain' and len(parts[1]) != self.salt_length
+
+    def stats(self):
+        return {'workers': self.workers, 'hashed': self.hashed, 'rejected': self.rejected}
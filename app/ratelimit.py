@@ -0,0 +1,51 @@
+import math
+import threading
+import time
+from collections import Counter
+
+from .cache import Cache
+
+
+class RateLimiter(object):
+    # Token buckets kept in a named cache: in process by default, shared between workers when CACHE_REDIS_URL
+    # is set. A bucket holds up to burst tokens and gains rate tokens per second; every attempt takes one.
+    # With the shared backend two workers can take the same token at once, which lets a few extra attempts
+    # through but never blocks a legitimate one.
+
+    def __init__(self, name, rates=()):
+        # rates: config options holding the rates of the limits, checked at startup
+        self.cache = Cache(name, follows_writes=False)
+        self.rates = rates
+        self.rejected = Counter()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        for option in self.rates:
+            if not app.config[option] > 0:
+                raise ValueError('{} must be greater than 0, not {!r}'.format(option, app.config[option]))
+        self.cache.init_app(app)
+        self.rejected = Counter()
+
+    def take(self, kind, key, rate, burst):
+        # Take a token from the bucket of key; returns 0 when allowed, else the seconds until the next token
+        name = '{}:{}'.format(kind, key)
+        now = time.time()
+        with self._lock:
+            tokens, updated = self.cache.get(name, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            # a bucket left alone refills completely, it can expire by then
+            self.cache.set(name, (tokens, now), ttl=int(math.ceil((burst - tokens) / rate)) + 1)
+        if allowed:
+            return 0
+        self.rejected[kind] += 1
+        return (1 - tokens) / rate
+
+    def reset(self, kind, key):
+        # Refill the bucket of key, e.g. after an attempt that proved legitimate
+        self.cache.delete('{}:{}'.format(kind, key))
+
+    def stats(self):
+        return dict(self.rejected)
@@ -0,0 +1,115 @@
+from flask import g, has_app_context, has_request_context
+from sqlalchemy import event, text
+
+from .cache import Cache
+from .replicas import RoutingSession
+
+
+class DataVersions(object):
+    # Version counter per table, kept in the data_versions table and incremented in the transaction of every
+    # commit that wrote rows of the table; cached data and ETags keyed on the versions of the tables they were
+    # built from go stale by themselves, whichever process wrote (web workers, job workers, the cli). The
+    # versions are read from the primary in one query, once per request.
+
+    def __init__(self, db):
+        self.db = db
+
+    def init_app(self, app):
+        if not event.contains(RoutingSession, 'after_flush', self._after_flush):
+            event.listen(RoutingSession, 'after_flush', self._after_flush)
+            event.listen(RoutingSession, 'before_commit', self._before_commit)
+            event.listen(RoutingSession, 'after_commit', self._after_commit)
+            event.listen(RoutingSession, 'after_soft_rollback', self._after_rollback)
+        app.teardown_request(self._forget)
+
+    @property
+    def table(self):
+        return self.db.metadata.tables['data_versions']
+
+    def get(self, table):
+        return str(self._read().get(table, 0))
+
+    def _read(self):
+        if has_request_context() and 'data_versions' in g:
+            return g.data_versions
+        table = self.table
+        versions = dict(self.db.session.execute(self.db.select([table.c.name, table.c.version]),
+                                                bind=self.db.engine).fetchall())
+        if has_request_context():
+            g.data_versions = versions
+        return versions
+
+    def bump(self, *tables):
+        # Mark tables written by code that bypasses the ORM unit of work (bulk operations); their versions are
+        # incremented when the session commits, so call it before the commit
+        self.db.session().info.setdefault('changed_tables', set()).update(tables)
+
+    def _increment(self, session, tables):
+        # One statement for all tables, in a fixed order so concurrent writers lock the rows alike
+        from .stix import upsert
+        rows = [{'name': name} for name in sorted(tables)]
+        if upsert.supported(self.db.engine.dialect):
+            session.execute(text('INSERT INTO data_versions (name, version) VALUES (:name, 1) ON CONFLICT (name) '
+                                 'DO UPDATE SET version = data_versions.version + 1'), rows, bind=self.db.engine)
+            return
+        table = self.table
+        for row in rows:
+            result = session.execute(table.update().where(table.c.name == row['name'])
+                                     .values(version=table.c.version + 1), bind=self.db.engine)
+            if result.rowcount == 0:
+                session.execute(table.insert().values(name=row['name'], version=1), bind=self.db.engine)
+
+    def _after_flush(self, session, flush_context):
+        tables = session.info.setdefault('changed_tables', set())
+        for instance in session.new | session.dirty | session.deleted:
+            tables.add(instance.__table__.name)
+
+    def _before_commit(self, session):
+        # the commit flushes after this hook, flush first so its tables are counted
+        session.flush()
+        tables = session.info.pop('changed_tables', None)
+        if tables:
+            self._increment(session, tables)
+
+    def _after_commit(self, session):
+        self._forget()
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop('changed_tables', None)
+
+    def _forget(self, exception=None):
+        # versions read before a commit of this process are out of date
+        if has_app_context():
+            g.pop('data_versions', None)
+
+
+class ReferenceData(object):
+    # Small lookup tables (roles, STIX open vocabularies) cached as (id, name) pairs for the forms,
+    # keyed on the data version of their table
+
+    def __init__(self, db, versions):
+        self.db = db
+        self.versions = versions
+        self.cache = Cache('reference')
+
+    def init_app(self, app):
+        self.cache.init_app(app)
+
+    def entries(self, model):
+        table = model.__tablename__
+        key = '{}:{}'.format(table, self.versions.get(table))
+        entries = self.cache.get(key)
+        if entries is None:
+            # read from the primary even in a request routed to a replica: the entries are cached under the
+            # version of the primary's writes, a lagging replica would be served until the next write
+            query = self.db.select([model.id, model.name]).order_by(model.name, model.id)
+            entries = [(row.id, row.name) for row in self.db.session.execute(query, bind=self.db.engine)]
+            self.cache.set(key, entries)
+        return entries
+
+    def choices(self, model):
+        # Choices of a SelectField(coerce=int)
+        return list(self.entries(model))
+
+    def name(self, model, id):
+        return dict(self.entries(model)).get(id)
@@ -0,0 +1,142 @@
+import itertools
+import threading
+import time
+
+from flask import current_app, has_request_context, request, session as cookie_session
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, text
+from sqlalchemy.sql.dml import UpdateBase
+
+# cookie session key holding the time until which reads of a client stay on the primary
+STICKY_KEY = '_db_primary_until'
+
+
+def replica_lag(engine):
+    # Replication delay of a replica in seconds, 0 for backends without replication (SQLite stand-ins)
+    with engine.connect() as connection:
+        if engine.dialect.name == 'postgresql':
+            lag = connection.execute(text(
+                'SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())')).scalar()
+            return float(lag or 0)
+        if engine.dialect.name == 'mysql':
+            status = connection.execute(text('SHOW SLAVE STATUS')).first()
+            if status is None or status['Seconds_Behind_Master'] is None:
+                return float('inf')
+            return float(status['Seconds_Behind_Master'])
+    return 0.0
+
+
+class ReplicaRouter(object):
+    # Picks a read replica round robin, skipping replicas lagging more than DATABASE_REPLICA_MAX_LAG seconds
+
+    def __init__(self, db, app):
+        self.db = db
+        self.app = app
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        self.keys = []
+        for i, uri in enumerate(app.config['DATABASE_REPLICAS']):
+            key = 'replica-{}'.format(i)
+            binds[key] = uri
+            self.keys.append(key)
+        app.config['SQLALCHEMY_BINDS'] = binds
+        self._status = {}
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    def healthy(self, key):
+        # Lag checks are cached for DATABASE_REPLICA_CHECK_INTERVAL seconds
+        now = time.time()
+        checked, ok = self._status.get(key, (0, False))
+        if now - checked >= self.app.config['DATABASE_REPLICA_CHECK_INTERVAL']:
+            try:
+                ok = replica_lag(self.db.get_engine(self.app, key)) <= self.app.config['DATABASE_REPLICA_MAX_LAG']
+            except Exception:
+                ok = False
+            with self._lock:
+                self._status[key] = (now, ok)
+        return ok
+
+    def choose(self):
+        # Engine of the next healthy replica, None to read from the primary
+        if not self.keys:
+            return None
+        start = next(self._next)
+        for i in range(len(self.keys)):
+            key = self.keys[(start + i) % len(self.keys)]
+            if self.healthy(key):
+                return self.db.get_engine(self.app, key)
+        return None
+
+
+def get_router(db, app):
+    router = app.extensions.get('replicas')
+    if router is None:
+        router = app.extensions['replicas'] = ReplicaRouter(db, app)
+    return router
+
+
+def routed_to_replica():
+    # Whether the current request may read from a replica: a GET of a view listed in DATABASE_REPLICA_ROUTES
+    # by a client that has not written recently
+    if not has_request_context() or request.method not in ('GET', 'HEAD') or request.endpoint is None:
+        return False
+    routes = current_app.config['DATABASE_REPLICA_ROUTES'].get(request.blueprint)
+    if not routes or (routes is not True and request.endpoint.rsplit('.', 1)[-1] not in routes):
+        return False
+    return cookie_session.get(STICKY_KEY, 0) < time.time()
+
+
+class RoutingSession(SignallingSession):
+    # Session sending the reads of replica-routed views to a replica; writes, flushes and everything read after
+    # a write in the same session go to the primary
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and not self.info.get('wrote') and not isinstance(clause, UpdateBase):
+            bind_key = None
+            if mapper is not None:
+                bind_key = mapper.persist_selectable.info.get('bind_key')
+            if bind_key is None:
+                engine = self._replica()
+                if engine is not None:
+                    return engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def _replica(self):
+        # chosen once per session so a request reads from a single replica
+        if 'replica' not in self.info:
+            replica = None
+            if self.app.config['DATABASE_REPLICAS'] and routed_to_replica():
+                replica = get_router(self.db, self.app).choose()
+            self.info['replica'] = replica
+        return self.info['replica']
+
+
+def reset_routing(session):
+    # Route the next request afresh when a session outlives a request (tests share one app context)
+    session.info.pop('replica', None)
+    session.info.pop('wrote', None)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_bulk_update')
+@event.listens_for(RoutingSession, 'after_bulk_delete')
+def _after_bulk(context):
+    context.session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _after_commit(session):
+    # Read your writes: keep the client on the primary until the replicas caught up with this commit.
+    # Bulk inserts do not flush, so any commit of a POST counts as a write.
+    if not has_request_context() or not session.app.config['DATABASE_REPLICAS']:
+        return
+    if session.info.get('wrote') or request.method not in ('GET', 'HEAD'):
+        cookie_session[STICKY_KEY] = time.time() + session.app.config['DATABASE_REPLICA_STICKY_SECONDS']
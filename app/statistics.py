@@ -0,0 +1,291 @@
+import datetime
+import time
+from collections import Counter
+
+from flask import current_app
+from sqlalchemy import event, exc, inspect, text
+
+from .cache import Cache
+from .replicas import RoutingSession
+
+# Counters of the admin dashboard: name, table and the column whose rows are counted per value.
+# Date and time columns are counted per day.
+STATISTICS = (
+    ('users_per_role', 'users', 'role_id'),
+    ('accounts_per_type', 'user_accounts', 'account_type'),
+    ('accounts_per_status', 'user_accounts', 'account_is_disabled'),
+    ('identities_per_class', 'identities', 'identity_class'),
+    ('posts_per_day', 'posts', 'created'),
+)
+# row of the statistics table holding the time of the last full reconciliation
+RECONCILED = ('reconciled', '')
+_unknown = object()
+
+
+def key(value):
+    # Counter key of a column value
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, datetime.datetime):
+        return value.date().isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value)
+
+
+class Statistics(object):
+    # Materialized counters maintained in the transaction of every write: flushes add and remove the rows
+    # written, bulk imports and deletes count the rows they insert, replace or delete, and bulk updates, which
+    # do not know the values they overwrite, recount the statistics of their table with one GROUP BY. Reading the
+    # counters is one query on a small table, cached on the data versions of the counted tables. A full
+    # recount, queued as a background job every STATISTICS_RECONCILE_INTERVAL seconds, heals any drift.
+
+    def __init__(self, db, versions, reference):
+        self.db = db
+        self.versions = versions
+        self.reference = reference
+        self.cache = Cache('statistics')
+        self.app = None
+        self.labels = {}
+
+    def init_app(self, app):
+        # imported here, both need the app package to be loaded
+        from . import bulk
+        from .models import IdentityClass, Role
+        self.app = app
+        # lookup tables naming the keys of the statistics counted on a foreign key
+        self.labels = {'users_per_role': Role, 'identities_per_class': IdentityClass}
+        self.cache.init_app(app)
+        if not event.contains(RoutingSession, 'after_flush', self._after_flush):
+            event.listen(RoutingSession, 'after_flush', self._after_flush)
+            bulk.after_bulk_update.append(self._after_bulk_update)
+            bulk.after_bulk_delete.append(self._after_bulk_delete)
+
+    @property
+    def enabled(self):
+        return self.app is not None and self.app.config['STATISTICS_ENABLED']
+
+    @property
+    def table(self):
+        return self.db.metadata.tables['statistics']
+
+    @staticmethod
+    def of(table):
+        return [(name, column) for name, counted, column in STATISTICS if counted == table]
+
+    def referencing(self, table):
+        # Statistics counted on a foreign key to table
+        return [name for name, counted, column in STATISTICS
+                if any(foreign_key.column.table.name == table
+                       for foreign_key in self.db.metadata.tables[counted].c[column].foreign_keys)]
+
+    def apply(self, connection, deltas):
+        # Add {(name, key): delta} to the counters, in one statement creating the counters missing
+        rows = [{'name': name, 'key': counter, 'value': delta}
+                for (name, counter), delta in sorted(deltas.items()) if delta]
+        if not rows:
+            return
+        from .stix import upsert
+        if upsert.supported(connection.dialect):
+            connection.execute(self._upsert(connection.dialect), rows)
+            return
+        table = self.table
+        for row in rows:
+            result = connection.execute(table.update().where(table.c.name == row['name'])
+                                        .where(table.c.key == row['key']).values(value=table.c.value + row['value']))
+            if result.rowcount == 0:
+                connection.execute(table.insert().values(**row))
+
+    def _upsert(self, dialect):
+        quote = dialect.identifier_preparer.quote
+        table, name, counter, value = (quote(identifier) for identifier in ('statistics', 'name', 'key', 'value'))
+        return text('INSERT INTO {table} ({name}, {key}, {value}) VALUES (:name, :key, :value) '
+                    'ON CONFLICT ({name}, {key}) DO UPDATE SET {value} = {table}.{value} + excluded.{value}'.format(
+                        table=table, name=name, key=counter, value=value))
+
+    def recount(self, connection, names):
+        # Replace the counters of the given statistics with counts from their tables
+        table = self.table
+        for name, counted, column in STATISTICS:
+            if name not in names:
+                continue
+            column = self.db.metadata.tables[counted].c[column]
+            group = self.db.func.date(column) if isinstance(column.type, self.db.DateTime) else column
+            rows = connection.execute(self.db.select([group, self.db.func.count()]).group_by(group))
+            counters = [{'name': name, 'key': key(value), 'value': count} for value, count in rows]
+            connection.execute(table.delete().where(table.c.name == name))
+            if counters:
+                connection.execute(table.insert(), counters)
+
+    def reconcile(self):
+        # Recount every statistic, in one transaction on the primary even in a request reading from a replica
+        self.db.session.info['wrote'] = True
+        connection = self.db.session.connection()
+        self.recount(connection, [name for name, _, _ in STATISTICS])
+        table = self.table
+        connection.execute(table.delete().where(table.c.name == RECONCILED[0]))
+        connection.execute(table.insert().values(name=RECONCILED[0], key=RECONCILED[1], value=int(time.time())))
+        self.versions.bump(*set(counted for _, counted, _ in STATISTICS))
+        self.db.session.commit()
+
+    def counts(self):
+        # {statistic: {key: count}}; a recount is queued when the last reconciliation is older than the interval
+        # (or never happened, on a database that had rows before the counters existed)
+        tables = sorted(set(counted for _, counted, _ in STATISTICS))
+        version = ':'.join(self.versions.get(table) for table in tables)
+        counts = self.cache.get(version)
+        if counts is None:
+            counts, reconciled = self._read()
+            interval = current_app.config['STATISTICS_RECONCILE_INTERVAL']
+            if interval and time.time() - reconciled > interval:
+                self.schedule(reconciled)
+            self.cache.set(version, counts)
+        return counts
+
+    def schedule(self, reconciled):
+        # Queue a statistics.reconcile job, unless another reader already did since the reconciliation at
+        # time reconciled: the time is moved forward by a compare-and-set, only one reader wins it
+        from . import jobs
+        table = self.table
+        marker = (table.c.name == RECONCILED[0]) & (table.c.key == RECONCILED[1])
+        with self.db.engine.begin() as connection:
+            if reconciled:
+                claimed = connection.execute(table.update().where(marker).where(table.c.value == reconciled)
+                                             .values(value=int(time.time()))).rowcount
+            else:
+                claimed = not connection.execute(self.db.select([table.c.value]).where(marker)).first()
+                if claimed:
+                    try:
+                        connection.execute(table.insert().values(name=RECONCILED[0], key=RECONCILED[1],
+                                                                 value=int(time.time())))
+                    except exc.IntegrityError:
+                        claimed = False
+        if claimed:
+            jobs.enqueue('statistics.reconcile')
+        return bool(claimed)
+
+    def _read(self):
+        # from the primary even in a request routed to a replica, the counts are cached under the data versions
+        # of the primary's writes
+        table = self.table
+        counts = dict((name, {}) for name, _, _ in STATISTICS)
+        reconciled = 0
+        query = self.db.select([table.c.name, table.c.key, table.c.value])
+        for name, counter, value in self.db.session.execute(query, bind=self.db.engine):
+            if (name, counter) == RECONCILED:
+                reconciled = value
+            elif name in counts and value:
+                counts[name][counter] = value
+        return counts, reconciled
+
+    def report(self, days=30):
+        # {statistic: {'total': rows, 'entries': [(key, label, count)]}} for display, largest counts first and
+        # the posts of the last days, newest first; rows without a value have the empty key and no label
+        report = {}
+        for name, counters in self.counts().items():
+            names = dict(self.reference.entries(self.labels[name])) if name in self.labels else None
+            entries = []
+            for counter, value in counters.items():
+                label = counter or None
+                if label and names is not None:
+                    label = names.get(int(counter), counter)
+                entries.append((counter, label, value))
+            if name == 'posts_per_day':
+                entries = sorted(entries, reverse=True)[:days]
+            else:
+                entries.sort(key=lambda entry: (-entry[2], entry[0]))
+            report[name] = {'total': sum(counters.values()), 'entries': entries}
+        return report
+
+    def _values(self, state, column, action):
+        # Counted value of an instance before (delete) or after (insert) the flush, and on update the
+        # (old, new) pair; _unknown when the old value was never loaded
+        attr = state.attrs[column]
+        if action == 'insert':
+            return attr.value
+        if action == 'delete':
+            return state.dict.get(column, _unknown)
+        history = attr.history
+        if not history.has_changes():
+            return None
+        return (history.deleted[0] if history.deleted else _unknown,
+                history.added[0] if history.added else None)
+
+    def _after_flush(self, session, flush_context):
+        if not self.enabled:
+            return
+        deltas, stale = Counter(), set()
+        for action, instances in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+            for instance in instances:
+                if action == 'delete':
+                    # rows referencing a deleted row may have been updated by the flush itself (SET NULL)
+                    stale.update(self.referencing(instance.__table__.name))
+                statistics = self.of(instance.__table__.name)
+                if not statistics:
+                    continue
+                state = inspect(instance)
+                for name, column in statistics:
+                    value = self._values(state, column, action)
+                    if action == 'update':
+                        if value is None:
+                            continue
+                        old, value = value
+                        if old is _unknown:
+                            stale.add(name)
+                            continue
+                        deltas[(name, key(old))] -= 1
+                        deltas[(name, key(value))] += 1
+                    elif value is _unknown:
+                        stale.add(name)
+                    else:
+                        deltas[(name, key(value))] += 1 if action == 'insert' else -1
+        if deltas or stale:
+            connection = session.connection()
+            self.apply(connection, dict((counter, delta) for counter, delta in deltas.items()
+                                        if counter[0] not in stale))
+            self.recount(connection, stale)
+
+    def bulk_write(self, connection, model, inserts, updates):
+        # Count rows about to be written by bulk inserts and updates (imports), reading the values replaced
+        statistics = self.of(model.__tablename__)
+        if not self.enabled or not statistics:
+            return
+        deltas = Counter()
+        for row in inserts:
+            for name, column in statistics:
+                deltas[(name, key(row.get(column)))] += 1
+        if updates:
+            from .bulk import chunks
+            rows = dict((row['id'], row) for row in updates)
+            columns = [model.__table__.c.id] + [model.__table__.c[column] for _, column in statistics]
+            for chunk in chunks(list(rows), 500):
+                for old in connection.execute(self.db.select(columns).where(model.__table__.c.id.in_(chunk))):
+                    for name, column in statistics:
+                        new = rows[old.id].get(column, old[column])
+                        deltas[(name, key(old[column]))] -= 1
+                        deltas[(name, key(new))] += 1
+        self.apply(connection, deltas)
+
+    def _after_bulk_update(self, model, ids, values):
+        names = [name for name, column in self.of(model.__tablename__) if column in values]
+        if self.enabled and names:
+            self.recount(self.db.session.connection(), names)
+
+    def _after_bulk_delete(self, model, ids):
+        # Called before the rows are deleted, their values are still there to be subtracted; rows referencing
+        # them were already set to NULL
+        if not self.enabled:
+            return
+        connection = self.db.session.connection()
+        statistics = self.of(model.__tablename__)
+        if statistics:
+            table = model.__table__
+            deltas = Counter()
+            query = self.db.select([table.c[column] for _, column in statistics]).where(table.c.id.in_(ids))
+            for row in connection.execute(query):
+                for (name, column), value in zip(statistics, row):
+                    deltas[(name, key(value))] -= 1
+            self.apply(connection, deltas)
+        self.recount(connection, self.referencing(model.__tablename__))
@@ -1,5 +1,26 @@
 from flask import Blueprint
 
+from ..lazy import add_lazy_routes
+
 stix = Blueprint('stix', __name__)
 
-from . import views
\ No newline at end of file
+# the views (and their forms, importer and exporter) are imported by the first request to one of them
+add_lazy_routes(stix, __name__ + '.views', [
+    ('/user-accounts', 'list_user_accounts', ['GET']),
+    ('/user-accounts/add', 'add_user_account', ['GET', 'POST']),
+    ('/user-accounts/bulk', 'bulk_user_accounts', ['POST']),
+    ('/users/edit/<int:id>', 'edit_user', ['GET', 'POST']),
+    ('/roles', 'list_roles', ['GET']),
+    ('/roles/add', 'add_role', ['GET', 'POST']),
+    ('/roles/edit/<int:id>', 'edit_role', ['GET', 'POST']),
+    ('/roles/delete/<int:id>', 'delete_role', ['GET', 'POST']),
+    ('/roles/bulk', 'bulk_roles', ['POST']),
+    ('/bundles/import', 'import_bundle_view', ['POST']),
+    ('/bundles/export', 'export_bundle_view', ['GET']),
+    ('/names/validate', 'validate_names_view', ['POST']),
+    ('/search', 'search_view', ['GET']),
+])
+
+# the search index and the change feed follow every write and the job tasks must be known to the workers,
+# they are loaded with the app
+from . import search, feed, commands, tasks
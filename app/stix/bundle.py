@@ -0,0 +1,245 @@
+import codecs
+import datetime
+import json
+import uuid
+
+from sqlalchemy import types
+
+from ..models import UserAccount, Identity, Post, IdentityClass, IdentityRole, Relationship, StixId
+
+# STIX object types stored in the database, by the "type" property
+MODELS = {
+    'user-account': UserAccount,
+    'identity': Identity,
+    'post': Post,
+    'relationship': Relationship,
+}
+# Namespace of the ids given to the links held by *_ref properties, the same link always gets the same id
+LINK_NAMESPACE = uuid.UUID('b5d3c2a4-3f5e-4e8f-9a57-0c6a1f0e2d71')
+
+_decoder = json.JSONDecoder()
+_whitespace = ' \t\n\r'
+
+
+class _Reader(object):
+    # Buffered reader that decodes json values from a stream one at a time
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.text = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        # Read the next chunk, dropping what was already consumed so memory stays bounded by one object
+        chunk = self.stream.read(self.chunk_size)
+        if isinstance(chunk, bytes):
+            chunk = self.text.decode(chunk, final=not chunk)
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        # Skip whitespace and return the next character
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                raise ValueError('Unexpected end of bundle')
+            self.fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected {!r} in bundle, found {!r}'.format(char, self.buffer[self.pos]))
+        self.pos += 1
+
+    def decode(self):
+        # Decode the next complete json value, reading more of the stream while it is truncated
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise ValueError('Malformed bundle')
+                self.fill()
+                continue
+            if end == len(self.buffer) and not self.eof:
+                # a number at the end of the buffer may continue in the next chunk
+                self.fill()
+                continue
+            self.pos = end
+            return value
+
+
+def iter_bundle_objects(stream, chunk_size=65536):
+    # Yield the objects of a STIX bundle one by one without loading the whole document
+    reader = _Reader(stream, chunk_size)
+    reader.expect('{')
+    while True:
+        char = reader.peek()
+        if char == '}':
+            return
+        if char == ',':
+            reader.pos += 1
+            continue
+        key = reader.decode()
+        reader.expect(':')
+        if key != 'objects':
+            reader.decode()
+            continue
+        reader.expect('[')
+        while True:
+            char = reader.peek()
+            if char == ']':
+                reader.pos += 1
+                break
+            if char == ',':
+                reader.pos += 1
+                continue
+            yield reader.decode()
+
+
+def parse_timestamp(value):
+    # Parse a STIX timestamp (RFC 3339, UTC) into a naive datetime
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise ValueError('Invalid timestamp: {!r}'.format(value))
+    value = value.rstrip('Zz')
+    if '.' in value:
+        value, fraction = value.split('.', 1)
+        value = '{}.{}'.format(value, fraction[:6])
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+def format_timestamp(value):
+    # Format a datetime as a STIX timestamp with millisecond precision
+    if value is None:
+        return None
+    return '{}.{:03d}Z'.format(value.strftime('%Y-%m-%dT%H:%M:%S'), value.microsecond // 1000)
+
+
+def _check_lengths(model, row):
+    # Reject values that do not fit their String (and id) columns instead of failing the whole chunk in the database
+    for column in model.__table__.columns:
+        value = row.get(column.key)
+        if isinstance(column.type, (types.String, StixId)) and not isinstance(value, (str, type(None))):
+            raise ValueError('{} is not a string: {!r}'.format(column.key, value))
+        if isinstance(column.type, (types.String, StixId)) and column.type.length and isinstance(value, str) \
+                and len(value) > column.type.length:
+            raise ValueError('{} is longer than {} characters'.format(column.key, column.type.length))
+
+
+def _is_ref(value):
+    return isinstance(value, str) and '--' in value and len(value) <= 64
+
+
+def ref_links(obj):
+    # Relationship rows of the links held by the *_ref and *_refs properties of an object,
+    # created_by_ref becoming a "created-by" relationship; refs that are not STIX ids are skipped
+    links = []
+    for key, value in sorted(obj.items()):
+        if key.endswith('_ref'):
+            name, refs = key[:-4], [value]
+        elif key.endswith('_refs') and isinstance(value, list):
+            name, refs = key[:-5], value
+        else:
+            continue
+        relationship_type = name.replace('_', '-')
+        for ref in refs:
+            if _is_ref(ref):
+                links.append({
+                    'id': 'relationship--{}'.format(uuid.uuid5(LINK_NAMESPACE, ' '.join((obj['id'], key, ref)))),
+                    'type': 'relationship',
+                    'relationship_type': relationship_type,
+                    'source_ref': obj['id'],
+                    'target_ref': ref,
+                    'derived': True,
+                })
+    return links
+
+
+def from_stix(obj):
+    # Validate a STIX object and map it to (model, column values), raise ValueError if it is invalid.
+    # Identity vocabulary columns hold the names here, the importer resolves them to ids.
+    if not isinstance(obj, dict):
+        raise ValueError('Object is not a json object')
+    if not isinstance(obj.get('type'), str):
+        raise ValueError('Invalid type: {!r}'.format(obj.get('type')))
+    model = MODELS.get(obj['type'])
+    if model is None:
+        raise KeyError(obj.get('type'))
+    stix_id = obj.get('id')
+    if not isinstance(stix_id, str) or not stix_id.startswith(obj['type'] + '--'):
+        raise ValueError('Invalid id: {!r}'.format(stix_id))
+
+    created = parse_timestamp(obj.get('created')) or datetime.datetime.utcnow()
+    row = dict(id=stix_id, type=obj['type'], created=created,
+               modified=parse_timestamp(obj.get('modified')) or created,
+               description=obj.get('description'))
+
+    if model is UserAccount:
+        if not isinstance(obj.get('is_disabled', False), bool):
+            raise ValueError('Invalid is_disabled: {!r}'.format(obj.get('is_disabled')))
+        row.update(name=obj.get('display_name') or obj.get('account_login') or obj.get('name'),
+                   account_type=obj.get('account_type'),
+                   account_created=parse_timestamp(obj.get('account_created')),
+                   account_is_disabled=obj.get('is_disabled', False))
+    elif model is Identity:
+        roles = obj.get('roles') or []
+        if not isinstance(roles, list) or not all(isinstance(role, str) for role in roles):
+            raise ValueError('Invalid roles: {!r}'.format(roles))
+        if not isinstance(obj.get('identity_class'), (str, type(None))):
+            raise ValueError('Invalid identity_class: {!r}'.format(obj.get('identity_class')))
+        row.update(name=obj.get('name'),
+                   contact_information=obj.get('contact_information'),
+                   location=obj.get('location'),
+                   identity_class=obj.get('identity_class'),
+                   identity_role=roles[0] if roles else None)
+        if not row['name']:
+            raise ValueError('Identity has no name')
+    elif model is Relationship:
+        row.update(relationship_type=obj.get('relationship_type'), source_ref=obj.get('source_ref'),
+                   target_ref=obj.get('target_ref'), derived=False)
+        if not isinstance(row['relationship_type'], str) or not row['relationship_type']:
+            raise ValueError('Relationship has no relationship_type')
+        for key in ('source_ref', 'target_ref'):
+            if not _is_ref(row[key]):
+                raise ValueError('Invalid {}: {!r}'.format(key, row[key]))
+    else:
+        row.update(text=obj.get('text'), post_type=obj.get('post_type'), post_url=obj.get('post_url'))
+
+    _check_lengths(model, row)
+    return model, row
+
+
+def to_stix(model, row, vocabularies):
+    # Serialize a row of a STIX table to a STIX object, vocabularies maps (model, id) to names
+    obj = {
+        'type': row.type,
+        'spec_version': '2.1',
+        'id': row.id,
+        'created': format_timestamp(row.created),
+        'modified': format_timestamp(row.modified),
+        'description': row.description,
+    }
+    if model is UserAccount:
+        obj.update(display_name=row.name, account_type=row.account_type,
+                   account_created=format_timestamp(row.account_created), is_disabled=row.account_is_disabled)
+    elif model is Identity:
+        role = vocabularies.get((IdentityRole, row.identity_role))
+        obj.update(name=row.name, contact_information=row.contact_information, location=row.location,
+                   identity_class=vocabularies.get((IdentityClass, row.identity_class)),
+                   roles=[role] if role else None)
+    elif model is Relationship:
+        obj.update(relationship_type=row.relationship_type, source_ref=row.source_ref, target_ref=row.target_ref)
+    else:
+        obj.update(text=row.text, post_type=row.post_type, post_url=row.post_url)
+    return dict((key, value) for key, value in obj.items() if value is not None)
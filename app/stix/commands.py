@@ -0,0 +1,50 @@
+import click
+
+from . import stix
+from .bundle import MODELS
+from .feed import rebuild
+from .search import reindex
+
+
+@stix.cli.command('import')
+@click.argument('bundle', type=click.File('rb'))
+@click.option('--batch-size', type=int, default=None, help='Objects per transaction.')
+def import_command(bundle, batch_size):
+    # Import a STIX 2.1 bundle file: flask stix import bundle.json
+    from .importer import import_bundle
+    result = import_bundle(bundle, batch_size=batch_size)
+    click.echo('Imported {} objects in {:.1f}s ({:.0f} objects/s): {} inserted, {} updated, {} skipped, {} invalid, '
+               '{} ignored'.format(result.objects, result.elapsed, result.objects_per_second, result.inserted,
+                                   result.updated, result.skipped, result.invalid, result.ignored))
+    for error in result.errors:
+        click.echo('{id}: {error}'.format(**error), err=True)
+
+
+@stix.cli.command('export')
+@click.argument('output', type=click.File('wb'), default='-')
+@click.option('--type', 'types', multiple=True, type=click.Choice(sorted(MODELS)), help='Object types to export.')
+@click.option('--gzip', 'compress', is_flag=True, help='Gzip compress the bundle.')
+@click.option('--batch-size', type=int, default=None, help='Rows fetched per database round trip.')
+def export_command(output, types, compress, batch_size):
+    # Export the stored objects as a STIX 2.1 bundle: flask stix export bundle.json
+    from .exporter import iter_bundle, gzip_chunks
+    chunks = iter_bundle(types, batch_size=batch_size)
+    if compress:
+        for data in gzip_chunks(chunks):
+            output.write(data)
+    else:
+        for chunk in chunks:
+            output.write(chunk.encode('utf-8'))
+
+
+@stix.cli.command('reindex')
+@click.option('--batch-size', type=int, default=1000, help='Rows indexed per statement.')
+def reindex_command(batch_size):
+    # Rebuild the full-text search index: flask stix reindex
+    click.echo('Indexed {} objects'.format(reindex(batch_size)))
+
+
+@stix.cli.command('feed-rebuild')
+def feed_rebuild_command():
+    # Put every stored object in the change feed: flask stix feed-rebuild
+    click.echo('Added {} objects to the feed'.format(rebuild()))
@@ -0,0 +1,58 @@
+import json
+import uuid
+import zlib
+
+from flask import current_app
+
+from .bundle import MODELS, to_stix
+from .. import db
+from ..models import IdentityClass, IdentityRole
+
+
+def iter_objects(types=None, batch_size=None):
+    # Yield every stored object as STIX, reading each table through a server-side cursor in batches
+    batch_size = batch_size or current_app.config['STIX_EXPORT_BATCH_SIZE']
+    vocabularies = {}
+    for model in (IdentityClass, IdentityRole):
+        vocabularies.update(((model, row.id), row.name) for row in db.session.query(model.id, model.name))
+
+    for type_name, model in MODELS.items():
+        if types and type_name not in types:
+            continue
+        # plain column tuples skip the ORM identity map so memory does not grow with the table
+        query = db.session.query(*model.__table__.columns).order_by(model.id).yield_per(batch_size)
+        for row in query:
+            yield to_stix(model, row, vocabularies)
+
+
+def iter_bundle(types=None, batch_size=None, progress=None):
+    # Yield a STIX bundle as json text, one chunk per batch of objects;
+    # progress is called with the number of objects yielded so far after every chunk
+    batch_size = batch_size or current_app.config['STIX_EXPORT_BATCH_SIZE']
+    yield '{{"type":"bundle","id":"bundle--{}","objects":['.format(uuid.uuid4())
+
+    separator, batch, count = '', [], 0
+    for obj in iter_objects(types, batch_size):
+        batch.append(json.dumps(obj, separators=(',', ':')))
+        if len(batch) >= batch_size:
+            yield separator + ','.join(batch)
+            count += len(batch)
+            separator, batch = ',', []
+            if progress is not None:
+                progress(count)
+    if batch:
+        yield separator + ','.join(batch)
+    yield ']}'
+
+
+def gzip_chunks(chunks, level=6, sync=False):
+    # Compress a stream of text chunks into a gzip stream; with sync, every chunk is flushed (Z_SYNC_FLUSH) so a
+    # client streaming the response can decompress each batch as it arrives instead of when zlib's buffer fills
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if sync:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,127 @@
+import datetime
+
+from sqlalchemy import bindparam, event, text
+
+from . import upsert
+from .bundle import to_stix
+from .. import bulk, db, reference_data
+from ..models import UserAccount, Identity, Post, Relationship, IdentityClass, IdentityRole, FeedEntry
+from ..replicas import RoutingSession
+
+# STIX type of the objects followed by the feed
+FEED_MODELS = {UserAccount: 'user-account', Identity: 'identity', Post: 'post', Relationship: 'relationship'}
+MODELS = dict((type_name, model) for model, type_name in FEED_MODELS.items())
+# key of the PostgreSQL advisory lock serializing the transactions that write the feed
+FEED_LOCK = 0x66656564
+
+
+def record(connection, model, ids, deleted=False):
+    # Move objects to the head of the feed, in the transaction that wrote them
+    ids = list(ids)
+    if not ids:
+        return
+    table = FeedEntry.__table__
+    now = datetime.datetime.utcnow()
+    rows = [{'object_type': FEED_MODELS[model], 'object_id': id, 'deleted': deleted, 'created': now} for id in ids]
+    if not upsert.supported(connection.dialect):
+        for chunk in bulk.chunks(ids, 500):
+            connection.execute(table.delete().where(table.c.object_id.in_(chunk)))
+        connection.execute(table.insert(), rows)
+        return
+    if connection.dialect.name == 'postgresql':
+        # Sequence numbers must reach the consumers in commit order, or a cursor could pass an entry of a
+        # transaction still running. Writers of the feed queue on this lock until they commit or roll back.
+        # SQLite lets one transaction write at a time and needs no lock.
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), key=FEED_LOCK)
+    connection.execute(_upsert(connection.dialect), rows)
+
+
+def _upsert(dialect):
+    # INSERT ... ON CONFLICT (object_id) moving the entry of an object already in the feed to the next sequence
+    # number, in one statement per row
+    if dialect.name == 'postgresql':
+        next_seq = "nextval(pg_get_serial_sequence('feed', 'seq'))"
+    else:
+        next_seq = '(SELECT max(seq) FROM feed) + 1'
+    return text(
+        'INSERT INTO feed (object_type, object_id, deleted, created) '
+        'VALUES (:object_type, :object_id, :deleted, :created) '
+        'ON CONFLICT (object_id) DO UPDATE SET seq = {}, object_type = excluded.object_type, '
+        'deleted = excluded.deleted, created = excluded.created'.format(next_seq)).bindparams(
+        bindparam('deleted', type_=db.Boolean), bindparam('created', type_=db.DateTime))
+
+
+def cursor():
+    # Sequence number of the latest entry, where a consumer starting from a full export picks up the feed
+    return db.session.query(db.func.max(FeedEntry.seq)).scalar() or 0
+
+
+def entries(since=0, types=None, limit=None):
+    # Feed entries after the cursor since, oldest first. Sequence numbers are assigned in commit order (see
+    # record), so no entry can show up later behind the cursor.
+    query = FeedEntry.query.filter(FeedEntry.seq > since).order_by(FeedEntry.seq)
+    if types:
+        query = query.filter(FeedEntry.object_type.in_(types))
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def changes(feed_entries):
+    # Feed items of a batch of entries: the current STIX object, or a tombstone; one query per object type
+    vocabularies = dict(((model, id), name) for model in (IdentityClass, IdentityRole)
+                        for id, name in reference_data.entries(model))
+    objects = {}
+    for type_name, model in MODELS.items():
+        ids = [entry.object_id for entry in feed_entries if entry.object_type == type_name and not entry.deleted]
+        if ids:
+            rows = db.session.query(*model.__table__.columns).filter(model.id.in_(ids))
+            objects.update((row.id, to_stix(model, row, vocabularies)) for row in rows)
+    for entry in feed_entries:
+        item = {'seq': entry.seq, 'type': entry.object_type, 'id': entry.object_id, 'deleted': entry.deleted}
+        if not entry.deleted:
+            item['object'] = objects.get(entry.object_id)
+        yield item
+
+
+def rebuild():
+    # Put every stored object in the feed, for databases that had objects before the feed existed
+    connection = db.session.connection()
+    count = 0
+    for model in FEED_MODELS:
+        ids = [id for id, in db.session.query(model.id).order_by(model.id)]
+        for chunk in bulk.chunks(ids, 1000):
+            record(connection, model, chunk)
+        count += len(ids)
+    db.session.commit()
+    return count
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    changed, deleted = {}, {}
+    dirty = [instance for instance in session.dirty if session.is_modified(instance)]
+    for instances, ids in ((list(session.new) + dirty, changed), (session.deleted, deleted)):
+        for instance in instances:
+            if type(instance) in FEED_MODELS:
+                ids.setdefault(type(instance), []).append(instance.id)
+    if changed or deleted:
+        connection = session.connection()
+        for model, ids in changed.items():
+            record(connection, model, ids)
+        for model, ids in deleted.items():
+            record(connection, model, ids, deleted=True)
+
+
+def _after_bulk_update(model, ids, values):
+    if model in FEED_MODELS:
+        record(db.session.connection(), model, ids)
+
+
+def _after_bulk_delete(model, ids):
+    if model in FEED_MODELS:
+        record(db.session.connection(), model, ids, deleted=True)
+
+
+bulk.after_bulk_update.append(_after_bulk_update)
+bulk.after_bulk_delete.append(_after_bulk_delete)
@@ -1,10 +1,9 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, DateField, BooleanField, SubmitField
-from wtforms.ext.sqlalchemy.fields import QuerySelectField
+from wtforms import StringField, DateField, BooleanField, SelectField, SubmitField
 from wtforms.validators import DataRequired, ValidationError
 
-from ..models import UserAccount, Identity, ThreatActor, ThreatActorSophistication, ThreatActorRole, ThreatActorType, \
-    AttackResourceLevel, AttackMotivation, IdentityClass, IdentityRole
+from .. import reference_data
+from ..models import UserAccount, Identity, IdentityClass, IdentityRole, names_in_use
 
 
 class UserAccountForm(FlaskForm):
@@ -18,7 +17,7 @@ class UserAccountForm(FlaskForm):
     submit = SubmitField('Submit')
 
     def validate_name(self, field):
-        if UserAccount.query.filter_by(name=field.data).first():
+        if names_in_use(UserAccount, [field.data]):
             raise ValidationError('Name is already in use!')
 
 
@@ -40,37 +39,17 @@ class IdentityForm(FlaskForm):
     description = StringField('Description')
     contact_information = StringField('Contact information')
     location = StringField('Location')
-    identity_role = QuerySelectField(query_factory=lambda: IdentityRole.query.all(), get_label='name')
-    identity_class = QuerySelectField(query_factory=lambda: IdentityClass.query.all(), get_label='name')
+    identity_role = SelectField('Identity role', coerce=int)
+    identity_class = SelectField('Identity class', coerce=int)
     submit = SubmitField('Submit')
 
-    def validate_name(self, field):
-        if Identity.query.filter_by(name=field.data).first():
-            raise ValidationError('Name is already in use!')
-
-
-class ThreatActorForm(FlaskForm):
-    # Form to create a new threat actor
-
-    name = StringField('Name', validators=[DataRequired()])
-    description = StringField('Description')
-    contact_information = StringField('Contact information')
-    aliases = StringField('Aliases')
-    first_seen = DateField('First seen')
-    last_seen = DateField('Last seen')
-    goals = StringField('Goals')
-    threat_actor_type = QuerySelectField(query_factory=lambda: ThreatActorType.query.all(), get_label='name')
-    threat_actor_role = QuerySelectField(query_factory=lambda: ThreatActorRole.query.all(), get_label='name')
-    threat_actor_sophistication = QuerySelectField(query_factory=lambda: ThreatActorSophistication.query.all(),
-                                                   get_label='name')
-    resource_level = QuerySelectField(query_factory=lambda: AttackResourceLevel.query.all(), get_label='name')
-    primary_motivation = QuerySelectField(query_factory=lambda: AttackMotivation.query.all(), get_label='name')
-    secondary_motivation = QuerySelectField(query_factory=lambda: AttackMotivation.query.all(), get_label='name')
-    personal_motivations = StringField('Personal motivations')
-    submit = SubmitField('Submit')
+    def __init__(self, *args, **kwargs):
+        super(IdentityForm, self).__init__(*args, **kwargs)
+        self.identity_role.choices = reference_data.choices(IdentityRole)
+        self.identity_class.choices = reference_data.choices(IdentityClass)
 
     def validate_name(self, field):
-        if ThreatActor.query.filter_by(name=field.data).first():
+        if names_in_use(Identity, [field.data]):
             raise ValidationError('Name is already in use!')
 
 
@@ -0,0 +1,223 @@
+import time
+
+from flask import current_app
+
+from . import upsert
+from .bundle import iter_bundle_objects, from_stix, ref_links
+from .feed import FEED_MODELS, record
+from .search import index_rows
+from .. import audit_log, bulk, data_versions, db, statistics
+from ..models import Identity, IdentityClass, IdentityRole, Relationship, UserAccount, names_in_use, normalize_name
+
+
+class ImportResult(object):
+    # Counters of a bundle import
+
+    max_errors = 100
+
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        # objects whose stored version is as new or newer
+        self.skipped = 0
+        self.invalid = 0
+        self.ignored = 0
+        self.errors = []
+        self.elapsed = 0.0
+
+    @property
+    def objects(self):
+        return self.inserted + self.updated + self.skipped + self.invalid + self.ignored
+
+    @property
+    def objects_per_second(self):
+        return self.objects / self.elapsed if self.elapsed else 0.0
+
+    def error(self, obj, reason):
+        self.invalid += 1
+        if len(self.errors) < self.max_errors:
+            stix_id = obj.get('id') if isinstance(obj, dict) else None
+            self.errors.append({'id': stix_id, 'error': str(reason)})
+
+    def to_dict(self):
+        return {
+            'objects': self.objects,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'skipped': self.skipped,
+            'invalid': self.invalid,
+            'ignored': self.ignored,
+            'errors': self.errors,
+            'elapsed': round(self.elapsed, 3),
+            'objects_per_second': round(self.objects_per_second, 1),
+        }
+
+
+def _vocabulary_ids(model, names, cache):
+    # Resolve open vocabulary names to ids, creating the entries that do not exist yet
+    missing = set(name for name in names if name and name not in cache)
+    if missing:
+        for row in db.session.query(model.id, model.name).filter(model.name.in_(missing)):
+            cache[row.name] = row.id
+        new = [model(name=name) for name in missing if name not in cache]
+        if new:
+            db.session.add_all(new)
+            db.session.flush()
+            cache.update((entry.name, entry.id) for entry in new)
+    return cache
+
+
+def _check_names(model, rows, objects, result):
+    # Reject rows whose name is held by another object, in the database or earlier in the batch,
+    # with one query for the whole batch instead of a failing insert
+    in_use = names_in_use(model, [row['name'] for row in rows.values()])
+    for stix_id, row in list(rows.items()):
+        key = normalize_name(row['name'])
+        if key is None:
+            continue
+        if in_use.setdefault(key, stix_id) != stix_id:
+            result.error(objects[stix_id], 'Name {!r} is already in use'.format(row['name']))
+            del rows[stix_id]
+
+
+def _write(model, rows, result):
+    # Upsert rows by id, newest modified wins, and return the rows written
+    connection = db.session.connection()
+    history = current_app.config['STIX_VERSION_HISTORY']
+    inserts, updates, skipped, replaced = upsert.plan(connection, model, rows, history=history)
+    # the dashboard counters, before the values they replace are overwritten
+    statistics.bulk_write(connection, model, inserts, updates)
+    upsert.write(connection, model, inserts, updates, current_app.config['STIX_UPSERT_BATCH_SIZE'])
+    rows = dict((row['id'], row) for row in inserts + updates)
+    # rows a concurrent import replaced with a newer version since the plan were not written: they are skipped,
+    # their side effects left to that import, and the counters counted from the plan are recounted. They are
+    # found by reading back the stored versions, the row counts of an executemany are not reliable (psycopg2 in
+    # values mode reports none). A planned insert racing with another insert of the same id counts as inserted.
+    lost = upsert.lost(connection, model, rows) if rows else set()
+    if lost:
+        inserts = [row for row in inserts if row['id'] not in lost]
+        updates = [row for row in updates if row['id'] not in lost]
+        replaced = [row for row in replaced if row.id not in lost]
+        skipped.extend(rows[stix_id] for stix_id in lost)
+        rows = dict((row['id'], row) for row in inserts + updates)
+        names = [name for name, _ in statistics.of(model.__tablename__)]
+        if statistics.enabled and names:
+            statistics.recount(connection, names)
+    upsert.keep_versions(connection, replaced)
+    # bulk writes skip the flush events that keep the search index in step
+    if current_app.config['SEARCH_ENABLED'] and rows:
+        index_rows(connection, model, rows.values())
+    # the change feed
+    if model in FEED_MODELS:
+        record(connection, model, rows)
+    # and the audit log; the rows are recorded without diffs
+    for action, written_rows in (('insert', inserts), ('update', updates)):
+        for row in written_rows:
+            audit_log.add(db.session, model.__tablename__, row['id'], action)
+    result.inserted += len(inserts)
+    result.updated += len(updates)
+    result.skipped += len(skipped)
+    return rows
+
+
+def _write_links(objects):
+    # Replace the links held by the *_ref properties of the objects written, and put the links added and removed
+    # in the change feed and the audit log. Links already stored as relationship objects of the same id are left
+    # alone, and so are the derived links still held (their ids follow from the source, property and target).
+    table = Relationship.__table__
+    connection = db.session.connection()
+    links = dict((row['id'], row) for obj in objects for row in ref_links(obj))
+    stored = set()
+    for chunk in bulk.chunks([obj['id'] for obj in objects], 500):
+        stored.update(row.id for row in connection.execute(
+            db.select([table.c.id]).where(table.c.derived & table.c.source_ref.in_(chunk))))
+    removed = sorted(stored - set(links))
+    for chunk in bulk.chunks(removed, 500):
+        connection.execute(table.delete().where(table.c.id.in_(chunk)))
+    for chunk in bulk.chunks(list(links), 500):
+        for row in connection.execute(db.select([table.c.id]).where(table.c.id.in_(chunk))):
+            del links[row.id]
+    if links:
+        connection.execute(table.insert(), list(links.values()))
+    record(connection, Relationship, removed, deleted=True)
+    record(connection, Relationship, links)
+    for action, ids in (('delete', removed), ('insert', links)):
+        for id in ids:
+            audit_log.add(db.session, Relationship.__tablename__, id, action)
+
+
+def import_batch(objects, result, vocabularies=None):
+    # Validate a batch of STIX objects and upsert it by id in one transaction
+    vocabularies = vocabularies if vocabularies is not None else {}
+    batches = {}
+    originals = {}
+    for obj in objects:
+        try:
+            model, row = from_stix(obj)
+        except KeyError:
+            result.ignored += 1
+            continue
+        except ValueError as e:
+            result.error(obj, e)
+            continue
+        # of several versions of an object in the batch the newest wins, the first of equally new ones
+        rows = batches.setdefault(model, {})
+        if row['id'] in rows:
+            result.skipped += 1
+            if row['modified'] <= rows[row['id']]['modified']:
+                continue
+        rows[row['id']] = row
+        originals[row['id']] = obj
+
+    try:
+        identities = batches.get(Identity, {}).values()
+        if identities:
+            classes = _vocabulary_ids(IdentityClass, [row['identity_class'] for row in identities],
+                                      vocabularies.setdefault(IdentityClass, {}))
+            roles = _vocabulary_ids(IdentityRole, [row['identity_role'] for row in identities],
+                                    vocabularies.setdefault(IdentityRole, {}))
+            for row in identities:
+                row['identity_class'] = classes.get(row['identity_class'])
+                row['identity_role'] = roles.get(row['identity_role'])
+
+        objects = []
+        for model, rows in batches.items():
+            if model in (UserAccount, Identity):
+                _check_names(model, rows, originals, result)
+            written = _write(model, rows, result)
+            if model is not Relationship:
+                objects.extend(originals[stix_id] for stix_id in written)
+        if objects:
+            _write_links(objects)
+        # bulk writes do not flush, so the commit does not see the tables they wrote
+        tables = set(model.__tablename__ for model in batches)
+        if objects:
+            tables.add(Relationship.__tablename__)
+        data_versions.bump(*tables)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def import_bundle(stream, batch_size=None, progress=None):
+    # Stream a STIX bundle into the database in chunked transactions of batch_size objects;
+    # progress is called with the result so far after every transaction
+    batch_size = batch_size or current_app.config['STIX_IMPORT_BATCH_SIZE']
+    result = ImportResult()
+    vocabularies = {}
+    start = time.time()
+
+    batch = []
+    for obj in iter_bundle_objects(stream):
+        batch.append(obj)
+        if len(batch) >= batch_size:
+            import_batch(batch, result, vocabularies)
+            batch = []
+            if progress is not None:
+                progress(result)
+    if batch:
+        import_batch(batch, result, vocabularies)
+
+    result.elapsed = time.time() - start
+    return result
@@ -0,0 +1,237 @@
+import hashlib
+import re
+import weakref
+
+from flask import current_app
+from sqlalchemy import bindparam, event, exc, or_, text
+
+from .. import bulk, db
+from ..models import UserAccount, Identity, Post
+from ..replicas import RoutingSession
+
+# STIX type, title fields and body fields indexed per model; title matches rank higher
+SEARCH_FIELDS = {
+    UserAccount: ('user-account', ('name',), ('description', 'account_type')),
+    Identity: ('identity', ('name',), ('description', 'location', 'contact_information')),
+    Post: ('post', ('text',), ('description',)),
+}
+MODELS = dict((fields[0], model) for model, fields in SEARCH_FIELDS.items())
+
+
+def document(model, values):
+    # Search document of a row, values is a model instance or a mapping of column values
+    type_name, title, body = SEARCH_FIELDS[model]
+    get = values.get if isinstance(values, dict) else lambda key: getattr(values, key, None)
+    return {
+        'object_id': get('id'),
+        'object_type': type_name,
+        'title': ' '.join(str(get(key)) for key in title if get(key)),
+        'body': ' '.join(str(get(key)) for key in body if get(key)),
+    }
+
+
+def _terms(query):
+    return re.findall(r'\w+', query or '', re.UNICODE)
+
+
+class SQLiteIndex(object):
+    # FTS5 table ranked with bm25; rows are addressed by a hash of the STIX id so updates do not scan
+
+    def create(self, connection):
+        connection.execute(text(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5('
+            'object_id UNINDEXED, object_type UNINDEXED, title, body, tokenize="unicode61 remove_diacritics 2")'))
+
+    def drop(self, connection):
+        connection.execute(text('DROP TABLE IF EXISTS search_index'))
+
+    @staticmethod
+    def rowid(object_id):
+        return int.from_bytes(hashlib.sha1(object_id.encode('utf-8')).digest()[:8], 'big') >> 1
+
+    def delete(self, connection, ids):
+        if ids:
+            connection.execute(text('DELETE FROM search_index WHERE rowid = :rowid'),
+                               [{'rowid': self.rowid(object_id)} for object_id in ids])
+
+    def upsert(self, connection, documents):
+        if documents:
+            self.delete(connection, [doc['object_id'] for doc in documents])
+            connection.execute(text(
+                'INSERT INTO search_index (rowid, object_id, object_type, title, body) '
+                'VALUES (:rowid, :object_id, :object_type, :title, :body)'),
+                [dict(doc, rowid=self.rowid(doc['object_id'])) for doc in documents])
+
+    def search(self, connection, query, types, limit, offset):
+        terms = _terms(query)
+        if not terms:
+            return []
+        # every term must match, the last one as a prefix so results show up while typing
+        match = ' '.join('"{}"'.format(term) for term in terms) + '*'
+        sql = ('SELECT object_type, object_id, -bm25(search_index, 0, 0, 10.0, 1.0) AS rank '
+               'FROM search_index WHERE search_index MATCH :match {} ORDER BY rank DESC LIMIT :limit OFFSET :offset')
+        return self._run(connection, sql, types, match=match, limit=limit, offset=offset)
+
+    @staticmethod
+    def _run(connection, sql, types, **params):
+        statement = text(sql.format('AND object_type IN :types' if types else ''))
+        if types:
+            statement = statement.bindparams(bindparam('types', expanding=True))
+            params['types'] = list(types)
+        return [tuple(row) for row in connection.execute(statement, params)]
+
+
+class PostgresIndex(SQLiteIndex):
+    # tsvector documents with a GIN index, ranked with ts_rank
+
+    def create(self, connection):
+        connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS search_documents (object_id VARCHAR(64) PRIMARY KEY, '
+            'object_type VARCHAR(64) NOT NULL, document TSVECTOR NOT NULL)'))
+        connection.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_search_documents_document ON search_documents USING GIN (document)'))
+
+    def drop(self, connection):
+        connection.execute(text('DROP TABLE IF EXISTS search_documents'))
+
+    def delete(self, connection, ids):
+        if ids:
+            connection.execute(text('DELETE FROM search_documents WHERE object_id IN :ids').bindparams(
+                bindparam('ids', expanding=True)), {'ids': list(ids)})
+
+    def upsert(self, connection, documents):
+        if documents:
+            connection.execute(text(
+                "INSERT INTO search_documents (object_id, object_type, document) VALUES (:object_id, :object_type, "
+                "setweight(to_tsvector('simple', :title), 'A') || setweight(to_tsvector('simple', :body), 'B')) "
+                "ON CONFLICT (object_id) DO UPDATE SET object_type = excluded.object_type, "
+                "document = excluded.document"), documents)
+
+    def search(self, connection, query, types, limit, offset):
+        terms = _terms(query)
+        if not terms:
+            return []
+        sql = ("SELECT object_type, object_id, ts_rank(document, query) AS rank "
+               "FROM search_documents, to_tsquery('simple', :query) query WHERE document @@ query {} "
+               "ORDER BY rank DESC, object_id LIMIT :limit OFFSET :offset")
+        query = ' & '.join(terms) + ':*'
+        return self._run(connection, sql, types, query=query, limit=limit, offset=offset)
+
+
+_indexes = {'sqlite': SQLiteIndex(), 'postgresql': PostgresIndex()}
+_created = weakref.WeakKeyDictionary()
+
+
+def get_index(connection):
+    # Index of the database behind connection, created on first use; None if the backend has no full-text search
+    index = _indexes.get(connection.engine.dialect.name)
+    if index is None:
+        return None
+    if connection.engine not in _created:
+        try:
+            index.create(connection)
+            _created[connection.engine] = True
+        except exc.OperationalError:
+            # SQLite built without FTS5
+            _created[connection.engine] = False
+    return index if _created[connection.engine] else None
+
+
+def index_rows(connection, model, rows):
+    # Add or refresh rows written without the ORM unit of work (bulk imports)
+    index = get_index(connection)
+    if index is not None and model in SEARCH_FIELDS:
+        index.upsert(connection, [document(model, row) for row in rows])
+
+
+def reindex(batch_size=1000):
+    # Rebuild the whole index from the tables
+    connection = db.session.connection()
+    index = get_index(connection)
+    if index is None:
+        return 0
+    index.drop(connection)
+    index.create(connection)
+    count = 0
+    for model in SEARCH_FIELDS:
+        batch = []
+        for row in db.session.query(*model.__table__.columns).yield_per(batch_size):
+            batch.append(document(model, row))
+            if len(batch) >= batch_size:
+                index.upsert(connection, batch)
+                count, batch = count + len(batch), []
+        index.upsert(connection, batch)
+        count += len(batch)
+    db.session.commit()
+    return count
+
+
+def scan(query, types, limit, offset):
+    # Naive LIKE scan over the text columns, for backends without full-text search (and as a benchmark baseline)
+    results = []
+    for type_name, model in sorted(MODELS.items()):
+        if types and type_name not in types:
+            continue
+        _, title, body = SEARCH_FIELDS[model]
+        columns = [getattr(model, key) for key in title + body]
+        conditions = [or_(*[column.ilike('%{}%'.format(term)) for column in columns]) for term in _terms(query)]
+        if conditions:
+            results.extend((type_name, row.id, 0.0) for row in
+                           db.session.query(model.id).filter(*conditions).order_by(model.id))
+    return results[offset:offset + limit]
+
+
+def search(query, types=None, limit=20, offset=0):
+    # Ranked (object type, STIX id, rank) matches of query
+    connection = db.session.connection()
+    index = get_index(connection) if current_app.config['SEARCH_ENABLED'] else None
+    if index is None:
+        return scan(query, types, limit, offset)
+    return index.search(connection, query, types, limit, offset)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    # Keep the index in step with the tables in the same transaction
+    if not session.app.config['SEARCH_ENABLED']:
+        return
+    changed = [obj for obj in session.new | session.dirty if type(obj) in SEARCH_FIELDS]
+    deleted = [obj.id for obj in session.deleted if type(obj) in SEARCH_FIELDS]
+    if not changed and not deleted:
+        return
+    connection = session.connection()
+    index = get_index(connection)
+    if index is not None:
+        index.delete(connection, deleted)
+        index.upsert(connection, [document(type(obj), obj) for obj in changed])
+
+
+def _after_bulk_update(model, ids, values):
+    if model in SEARCH_FIELDS and current_app.config['SEARCH_ENABLED']:
+        rows = db.session.query(*model.__table__.columns).filter(model.id.in_(ids))
+        index_rows(db.session.connection(), model, rows)
+
+
+def _after_bulk_delete(model, ids):
+    if model in SEARCH_FIELDS and current_app.config['SEARCH_ENABLED']:
+        connection = db.session.connection()
+        index = get_index(connection)
+        if index is not None:
+            index.delete(connection, ids)
+
+
+bulk.after_bulk_update.append(_after_bulk_update)
+bulk.after_bulk_delete.append(_after_bulk_delete)
+
+
+@event.listens_for(db.Model.metadata, 'after_create')
+def _after_create(metadata, connection, **kwargs):
+    get_index(connection)
+
+
+@event.listens_for(db.Model.metadata, 'before_drop')
+def _before_drop(metadata, connection, **kwargs):
+    index = _indexes.get(connection.engine.dialect.name)
+    if index is not None:
+        index.drop(connection)
+        _created.pop(connection.engine, None)
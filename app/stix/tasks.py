@@ -0,0 +1,78 @@
+import os
+import uuid
+
+from werkzeug.security import safe_join
+
+from .bundle import MODELS
+from .feed import cursor, rebuild
+from .search import reindex
+from .. import db, jobs
+from ..jobs import JobCancelled, JobFailed
+
+
+def job_file(folder, name):
+    # Path of a file of the job folder; names come from job arguments and may not leave the folder
+    path = safe_join(folder, name)
+    if path is None:
+        raise ValueError('Invalid file name: {!r}'.format(name))
+    return path
+
+
+def save_upload(stream, chunk_size=65536):
+    # Store an uploaded bundle in the job folder for an import job and return its file name
+    name = 'upload-{}.json'.format(uuid.uuid4())
+    with open(os.path.join(jobs.folder(), name), 'wb') as upload:
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            upload.write(chunk)
+    return name
+
+
+@jobs.task('stix.import')
+def import_task(job, upload, batch_size=None):
+    # Import an uploaded bundle, progress in bytes read. A malformed bundle fails the job without retries; the
+    # upload is removed once the job will not run again.
+    from .importer import import_bundle
+    path = job_file(job.folder, upload)
+    final = job.last_attempt
+    try:
+        with open(path, 'rb') as bundle:
+            total = os.fstat(bundle.fileno()).st_size
+            result = import_bundle(bundle, batch_size=batch_size,
+                                   progress=lambda result: job.progress(bundle.tell(), total))
+        final = True
+    except ValueError as e:
+        final = True
+        raise JobFailed('Invalid bundle: {}'.format(e))
+    except JobCancelled:
+        final = True
+        raise
+    finally:
+        if final and os.path.exists(path):
+            os.remove(path)
+    job.progress(total, total)
+    return result.to_dict()
+
+
+@jobs.task('stix.export')
+def export_task(job, types=None, batch_size=None):
+    # Write the stored objects to a bundle file of the job folder, progress in objects
+    from .exporter import iter_bundle
+    total = sum(db.session.query(db.func.count(model.id)).scalar()
+                for type_name, model in MODELS.items() if not types or type_name in types)
+    feed_cursor = cursor()
+    name = 'export-{}.json'.format(job.id)
+    with open(job_file(job.folder, name), 'w', encoding='utf-8') as output:
+        for chunk in iter_bundle(types, batch_size=batch_size, progress=lambda count: job.progress(count, total)):
+            output.write(chunk)
+    job.progress(total, total)
+    return {'file': name, 'objects': total, 'cursor': feed_cursor}
+
+
+@jobs.task('stix.reindex')
+def reindex_task(job, batch_size=1000):
+    return {'indexed': reindex(batch_size)}
+
+
+@jobs.task('stix.feed-rebuild')
+def feed_rebuild_task(job):
+    return {'objects': rebuild()}
@@ -0,0 +1,118 @@
+import datetime
+import json
+
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.dml import Insert
+
+from .. import bulk, db
+from ..models import ObjectVersion
+
+
+class Upsert(Insert):
+    # INSERT ... ON CONFLICT (id) DO UPDATE of the given columns, where the stored row is older than the
+    # inserted one by its modified column; rows already as new or newer are left alone
+
+    def __init__(self, table, columns):
+        super(Upsert, self).__init__(table)
+        self.update_columns = columns
+
+
+@compiles(Upsert, 'sqlite')
+@compiles(Upsert, 'postgresql')
+def _compile_upsert(element, compiler, **kw):
+    preparer = compiler.preparer
+    table = preparer.format_table(element.table)
+    modified = preparer.quote('modified')
+    return '{} ON CONFLICT ({}) DO UPDATE SET {} WHERE {table}.{modified} IS NULL OR {table}.{modified} < ' \
+           'excluded.{modified}'.format(
+               compiler.visit_insert(element, **kw), preparer.quote('id'),
+               ', '.join('{0} = excluded.{0}'.format(preparer.quote(name)) for name in element.update_columns),
+               table=table, modified=modified)
+
+
+def supported(dialect):
+    # Whether the database has INSERT ... ON CONFLICT: PostgreSQL 9.5 and SQLite 3.24 onwards
+    if dialect.name == 'sqlite':
+        return dialect.dbapi.sqlite_version_info >= (3, 24, 0)
+    return dialect.name == 'postgresql'
+
+
+def plan(connection, model, rows, history=False):
+    # Split rows {id: values} into (inserts, updates, skipped) lists by the modified timestamp stored for their
+    # ids: newer versions update, older and identical ones are skipped. With history, also return the stored
+    # rows the updates replace.
+    table = model.__table__
+    stored = {}
+    columns = list(table.c) if history else [table.c.id, table.c.modified]
+    for chunk in bulk.chunks(list(rows), 500):
+        for row in connection.execute(db.select(columns).where(table.c.id.in_(chunk))):
+            stored[row.id] = row
+    inserts, updates, skipped, replaced = [], [], [], []
+    for stix_id, row in rows.items():
+        old = stored.get(stix_id)
+        if old is None:
+            inserts.append(row)
+        elif old.modified is None or (row['modified'] is not None and row['modified'] > old.modified):
+            updates.append(row)
+            replaced.append(old)
+        else:
+            skipped.append(row)
+    return inserts, updates, skipped, (replaced if history else [])
+
+
+def lost(connection, model, rows):
+    # Ids of written rows {id: values} whose stored version is not the one written: a concurrent import stored
+    # a newer version between the plan and the write
+    table = model.__table__
+    stored = set()
+    for chunk in bulk.chunks(list(rows), 500):
+        for row in connection.execute(db.select([table.c.id, table.c.modified]).where(table.c.id.in_(chunk))):
+            if row.modified == rows[row.id]['modified']:
+                stored.add(row.id)
+    return set(rows) - stored
+
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, datetime.date) else value
+
+
+def keep_versions(connection, replaced):
+    # Copy stored rows about to be replaced to the object_versions table
+    if not replaced:
+        return
+    now = datetime.datetime.utcnow()
+    connection.execute(ObjectVersion.__table__.insert(), [
+        {'object_type': row.type, 'object_id': row.id, 'modified': row.modified, 'created': now,
+         'data': json.dumps(dict((key, _json_value(row[key])) for key in row.keys()), sort_keys=True)}
+        for row in replaced])
+
+
+def write(connection, model, inserts, updates, batch_size=5000):
+    # Write planned rows (lists of column values) with one upsert statement per batch of rows, compiled once and
+    # executed for every row of the batch, and return how many were written: rows a concurrent import replaced
+    # with a newer version in the meantime are not, where the driver counts the rows of an executemany. Callers
+    # that must know which rows were lost ask lost(), the count is all of the rows where the driver does not.
+    # Databases without ON CONFLICT get a bulk insert and a bulk update instead.
+    # psycopg2 (executemany_mode 'values') sends the batch as pages of multi-row VALUES, SQLite steps the one
+    # prepared statement in process. A statement built with insert().values(batch) instead is compiled anew for
+    # every batch, with a bound parameter per value, and made the writes 2 to 2.5 times slower in
+    # benchmarks.upsert on SQLite.
+    table = model.__table__
+    if not supported(connection.dialect):
+        if inserts:
+            connection.execute(table.insert(), inserts)
+        if updates:
+            connection.execute(table.update().where(table.c.id == db.bindparam('_id')),
+                               [dict(row, _id=row['id']) for row in updates])
+        return len(inserts) + len(updates)
+    rows = inserts + updates
+    if not rows:
+        return 0
+    names = sorted(set(name for row in rows for name in row))
+    rows = [dict((name, row.get(name)) for name in names) for row in rows]
+    statement = Upsert(table, [name for name in names if name != 'id'])
+    written = 0
+    for batch in bulk.chunks(rows, batch_size):
+        count = connection.execute(statement, batch).rowcount
+        written += count if connection.dialect.supports_sane_multi_rowcount and count >= 0 else len(batch)
+    return written
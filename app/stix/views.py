@@ -1,10 +1,24 @@
-from flask import abort, flash, redirect, render_template, url_for
+import uuid
+
+from flask import abort, current_app, flash, jsonify, redirect, render_template, request, stream_with_context, url_for, \
+    Response
 from flask_login import current_user, login_required
+from sqlalchemy.exc import IntegrityError
+
+from .forms import UserAccountForm, UserAccountEditForm, IdentityRoleForm
+from .. import db, fragment_cache, jobs
+from ..bulk import bulk_view
+from ..pagination import paginate
+from .bundle import MODELS
+from .exporter import iter_bundle, gzip_chunks
+from .feed import cursor as feed_cursor
+from .importer import import_bundle
+from .search import MODELS as SEARCH_MODELS, SEARCH_FIELDS, search
+from .tasks import save_upload
+from ..models import UserAccount, Identity, IdentityRole, count_by, names_in_use, normalize_name
 
-from . import stix
-from .forms import UserAccountForm, UserAccountEditForm, IdentityForm, ThreatActorForm, PostForm, ThreatActorSophisticationForm, AttackResourceLevelForm, AttackMotivationForm, ThreatActorTypeForm, ThreatActorRoleForm, IdentityClassForm, IdentityRoleForm
-from .. import db
-from ..models import UserAccount, Identity, ThreatActor, Post, ThreatActorSophistication, AttackResourceLevel, AttackMotivation, ThreatActorType, ThreatActorRole, IdentityClass, IdentityRole
+# STIX types whose names are unique, case insensitively
+NAMED_MODELS = {'user-account': UserAccount, 'identity': Identity}
 
 
 def check_user():
@@ -14,15 +28,17 @@ def check_user():
 
 
 # User views
-@stix.route('/user-accounts')
 @login_required
+@fragment_cache.page('user_accounts')
 def list_user_accounts():
-    # List all users
-    user_accounts = UserAccount.query.all()
-    return render_template('admin/users/users.html', users=user_accounts, title='User Accounts')
+    # List user accounts one page at a time, newest first
+    user_accounts = paginate(UserAccount.query, UserAccount, sort_columns=('created', 'id'), default_sort='-created',
+                             filter_columns=('account_type', 'account_is_disabled'),
+                             load_columns=('id', 'name', 'created'))
+    return render_template('admin/users/users.html', users=user_accounts.items, page=user_accounts,
+                           title='User Accounts')
 
 
-@stix.route('/user-accounts/add', methods=['GET', 'POST'])
 @login_required
 def add_user_account():
     # Handle requests to add user url
@@ -33,21 +49,39 @@ def add_user_account():
 
     form = UserAccountForm()
     if form.validate_on_submit():
-        user_account = UserAccount(name=form.name.data,
+        user_account = UserAccount(id='user-account--{}'.format(uuid.uuid4()), name=form.name.data,
                     description=form.description.data, account_type=form.account_type.data, account_created=form.account_created.data, account_is_disabled=form.account_is_disabled.data)
         # add user to database
         db.session.add(user_account)
-        db.session.commit()
-        flash('The user account have been created successfully!')
-
-        # redirect to list accounts
-        return redirect(url_for('stix.list_user_accounts'))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if not names_in_use(UserAccount, [form.name.data]):
+                raise
+            # another request took the name after the form was validated
+            form.name.errors.append('Name is already in use!')
+        else:
+            flash('The user account have been created successfully!')
+
+            # redirect to list accounts
+            return redirect(url_for('stix.list_user_accounts'))
 
     # load registration template
     return render_template('admin/users/user.html', add_user=add_user, form=form, title='Add user')
 
 
-@stix.route('/users/edit/<int:id>', methods=['GET', 'POST'])
+@login_required
+def bulk_user_accounts():
+    # Update or delete many user accounts at once, picked by id or by a filter
+    check_user()
+
+    response, ids = bulk_view(UserAccount, fields=('id', 'name', 'account_type', 'account_is_disabled',
+                                                   'account_created', 'created', 'modified'),
+                              writable=('description', 'account_type', 'account_is_disabled'))
+    return response
+
+
 @login_required
 def edit_user(id):
     # Edit a user
@@ -80,15 +114,17 @@ def edit_user(id):
 
 
 # Role views
-@stix.route('/roles')
 @login_required
+@fragment_cache.page('identityroles', 'identities')
 def list_roles():
-    # List all roles
-    roles = IdentityRole.query.all()
-    return render_template('admin/roles/roles.html', roles=roles, title='Roles')
+    # List identity roles one page at a time
+    roles = paginate(IdentityRole.query, IdentityRole, sort_columns=('id', 'name'), default_sort='id',
+                     load_columns=('id', 'name', 'description'))
+    identity_counts = count_by(Identity.identity_role, [role.id for role in roles])
+    return render_template('admin/roles/roles.html', roles=roles.items, page=roles, user_counts=identity_counts,
+                           title='Roles')
 
 
-@stix.route('/roles/add', methods=['GET', 'POST'])
 @login_required
 def add_role():
     # Create a new role
@@ -116,7 +152,6 @@ def add_role():
     return render_template('admin/roles/role.html', add_role=add_role, form=form, title='Add role')
 
 
-@stix.route('/roles/edit/<int:id>', methods=['GET', 'POST'])
 @login_required
 def edit_role(id):
     # Edit a role
@@ -141,7 +176,6 @@ def edit_role(id):
     return render_template('admin/roles/role.html', add_role=add_role, form=form, title='Edit role')
 
 
-@stix.route('/roles/delete/<int:id>', methods=['GET', 'POST'])
 @login_required
 def delete_role(id):
     # Delete a role
@@ -156,3 +190,117 @@ def delete_role(id):
     return redirect(url_for('admin.list_roles'))
 
     return render_template(title='Delete role')
+
+
+@login_required
+def bulk_roles():
+    # Update or delete many identity roles at once; identities of deleted roles are left without a role
+    check_user()
+
+    response, ids = bulk_view(IdentityRole, fields=('id', 'name'), writable=('description',))
+    return response
+
+
+# Bundle views
+def job_accepted(id):
+    # 202 pointing to the status of a queued job
+    response = jsonify(job=id, status='queued')
+    response.status_code = 202
+    response.headers['Location'] = url_for('api.get_job', id=id)
+    return response
+
+
+@login_required
+def import_bundle_view():
+    # Import a STIX bundle posted as the request body or as a "bundle" file upload; with async=1 the bundle is
+    # stored and imported by a background job
+    check_user()
+
+    upload = request.files.get('bundle')
+    stream = upload.stream if upload else request.stream
+    batch_size = request.args.get('batch_size', type=int)
+    if request.args.get('async'):
+        id = jobs.enqueue('stix.import', {'upload': save_upload(stream), 'batch_size': batch_size})
+        return job_accepted(id)
+    try:
+        result = import_bundle(stream, batch_size=batch_size)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    return jsonify(result.to_dict())
+
+
+@login_required
+def export_bundle_view():
+    # Stream the stored objects as a STIX bundle, gzip compressed when the client accepts it
+    check_user()
+
+    types = request.args.getlist('type')
+    if any(type_name not in MODELS for type_name in types):
+        abort(400)
+    if request.args.get('async'):
+        # written to a file by a background job, downloaded from the job once it succeeded
+        return job_accepted(jobs.enqueue('stix.export', {
+            'types': types, 'batch_size': request.args.get('batch_size', type=int)}))
+
+    chunks = iter_bundle(types, batch_size=request.args.get('batch_size', type=int))
+    # consumers of the change feed continue from the export with this cursor
+    headers = {'Content-Disposition': 'attachment; filename=bundle.json', 'X-Feed-Cursor': str(feed_cursor()),
+               'Vary': 'Accept-Encoding'}
+    if 'gzip' in request.accept_encodings:
+        chunks = gzip_chunks(chunks, sync=True)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(chunks), mimetype='application/stix+json', headers=headers)
+
+
+@login_required
+def validate_names_view():
+    # Check a batch of candidate names of a STIX type before a bulk ingestion:
+    # {"type": "identity", "names": [...]} gives the names already in use and the names repeated in the batch
+    check_user()
+
+    data = request.get_json(silent=True) or {}
+    model = NAMED_MODELS.get(data.get('type'))
+    names = data.get('names')
+    if model is None or not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        abort(400)
+
+    in_use = names_in_use(model, names)
+    seen, duplicates = set(), []
+    for name in names:
+        key = normalize_name(name)
+        if key in seen:
+            duplicates.append(name)
+        seen.add(key)
+    return jsonify(in_use={name: in_use[normalize_name(name)] for name in names if normalize_name(name) in in_use},
+                   duplicates=duplicates)
+
+
+# Search views
+@login_required
+def search_view():
+    # Ranked full-text search over user accounts, identities and posts
+    check_user()
+
+    query = request.args.get('q', '')
+    types = request.args.getlist('type')
+    if any(type_name not in SEARCH_MODELS for type_name in types):
+        abort(400)
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = max(1, min(request.args.get('per_page', current_app.config['PAGE_SIZE'], type=int),
+                          current_app.config['MAX_PAGE_SIZE']))
+
+    matches = search(query, types, limit=per_page + 1, offset=(page - 1) * per_page)
+    has_next, matches = len(matches) > per_page, matches[:per_page]
+
+    # one query per object type for the titles of the page
+    titles = {}
+    for type_name, model in SEARCH_MODELS.items():
+        ids = [object_id for match_type, object_id, rank in matches if match_type == type_name]
+        if ids:
+            column = getattr(model, SEARCH_FIELDS[model][1][0])
+            titles.update(db.session.query(model.id, column).filter(model.id.in_(ids)))
+
+    results = [{'type': type_name, 'id': object_id, 'title': titles.get(object_id), 'rank': rank}
+               for type_name, object_id, rank in matches]
+    return jsonify(query=query, page=page, per_page=per_page, has_next=has_next, results=results)
@@ -0,0 +1,103 @@
+# Multi-hop traversal of the relationships table: one query per node against the batched hops, cold and with
+# the adjacency cache warm.
+#
+#   python -m benchmarks.graph [--edges 1000000] [--degree 10] [--depth 3] [--limit 1000] [--traversals 20]
+#
+# Runs against a SQLite database in a temporary file filled with a generated graph whose targets are skewed
+# towards a few hub nodes, like identities shared by many accounts and posts.
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from app import create_app, db, relationship_graph
+from app.models import Relationship
+
+TYPES = ('belongs-to', 'authored-by', 'related-to')
+
+
+def node(i):
+    return 'identity--{}'.format(i)
+
+
+def populate(edges, nodes, batch_size=50000):
+    rng = random.Random(0)
+    table = Relationship.__table__
+    for start in range(0, edges, batch_size):
+        db.session.execute(table.insert(), [
+            {'id': 'relationship--{}'.format(i), 'type': 'relationship', 'relationship_type': rng.choice(TYPES),
+             'source_ref': node(rng.randrange(nodes)), 'target_ref': node(int(nodes * rng.random() ** 3)),
+             'derived': False}
+            for i in range(start, min(start + batch_size, edges))])
+    db.session.commit()
+
+
+def per_node(start, depth, limit):
+    # Baseline: the same breadth first expansion with one adjacency query per node
+    table = Relationship.__table__
+    nodes, frontier = {start: 0}, [start]
+    for hop in range(1, depth + 1):
+        reached = []
+        for current in frontier:
+            rows = db.session.execute(db.select([table.c.source_ref, table.c.target_ref]).where(
+                db.or_(table.c.source_ref == current, table.c.target_ref == current)))
+            for source, target in rows:
+                neighbor = target if source == current else source
+                if neighbor not in nodes and len(nodes) < limit:
+                    nodes[neighbor] = hop
+                    reached.append(neighbor)
+        frontier = reached
+    return nodes
+
+
+def timed(function, starts):
+    start = time.time()
+    for node_id in starts:
+        function(node_id)
+    return (time.time() - start) / len(starts)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--edges', type=int, default=1000000)
+    parser.add_argument('--degree', type=int, default=10)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--limit', type=int, default=1000)
+    parser.add_argument('--traversals', type=int, default=20)
+    args = parser.parse_args()
+
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    app = create_app('testing')
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + path, GRAPH_MAX_NODES=args.limit)
+    try:
+        with app.app_context():
+            db.create_all()
+            nodes = max(1, args.edges * 2 // args.degree)
+            start = time.time()
+            populate(args.edges, nodes)
+            print('{} edges between {} nodes inserted in {:.1f}s'.format(args.edges, nodes, time.time() - start))
+
+            rng = random.Random(1)
+            starts = [node(rng.randrange(nodes)) for _ in range(args.traversals)]
+            reached = sum(len(relationship_graph.traverse([n], args.depth).nodes) for n in starts) / len(starts)
+            print('depth {}, {:.0f} nodes reached on average (limit {})'.format(args.depth, reached, args.limit))
+
+            def batched(node_id):
+                relationship_graph.traverse([node_id], args.depth)
+
+            print('{:>10} {:>16}'.format('', 'ms/traversal'))
+            print('{:>10} {:>16.2f}'.format('per node', timed(lambda n: per_node(n, args.depth, args.limit),
+                                                              starts) * 1000))
+            app.config['GRAPH_CACHE_ENABLED'] = False
+            print('{:>10} {:>16.2f}'.format('batched', timed(batched, starts) * 1000))
+            app.config['GRAPH_CACHE_ENABLED'] = True
+            timed(batched, starts)
+            print('{:>10} {:>16.2f}'.format('cached', timed(batched, starts) * 1000))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+# Storage of the STIX ids: the String(64) columns holding "type--uuid" text against the StixId columns holding
+# 16 byte uuids (17 with the type code of relationship refs), and the created/modified indexes.
+#
+#   python -m benchmarks.ids [--objects 200000] [--edges 500000] [--lookups 20000]
+#
+# Builds the identities and relationships tables in both layouts in temporary SQLite files and prints the size
+# of their tables and indexes (dbstat) and the time of id lookups, adjacency lookups and recent changes.
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+import uuid
+
+import sqlalchemy as sa
+
+from app.models import Identity, IdentityClass, IdentityRole, Relationship, StixId
+
+# tables copied into both layouts, with the vocabularies referenced by identities
+TABLES = (IdentityClass.__table__, IdentityRole.__table__, Identity.__table__, Relationship.__table__)
+
+
+def string_layout():
+    # The tables as they were before: ids in String(64) columns, created and modified not indexed
+    metadata = sa.MetaData()
+    for table in TABLES:
+        copy = table.tometadata(metadata)
+        for column in copy.columns:
+            if isinstance(column.type, StixId):
+                column.type = sa.String(64)
+                # the comparator memoized while copying the indexes was made for the StixId type
+                column.__dict__.pop('comparator', None)
+        for index in list(copy.indexes):
+            if index.name.endswith(('_created', '_modified')):
+                copy.indexes.discard(index)
+    return metadata
+
+
+def compact_layout():
+    metadata = sa.MetaData()
+    for table in TABLES:
+        table.tometadata(metadata)
+    return metadata
+
+
+def populate(engine, metadata, objects, edges, batch_size=50000):
+    rng = random.Random(0)
+    ids = ['identity--{}'.format(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(objects)]
+    start = datetime.datetime(2020, 1, 1)
+    identities, relationships = metadata.tables['identities'], metadata.tables['relationships']
+    with engine.begin() as connection:
+        for first in range(0, objects, batch_size):
+            connection.execute(identities.insert(), [
+                {'id': ids[i], 'name': 'identity {}'.format(i), 'type': 'identity',
+                 'created': start + datetime.timedelta(minutes=i), 'modified': start + datetime.timedelta(minutes=i)}
+                for i in range(first, min(first + batch_size, objects))])
+        for first in range(0, edges, batch_size):
+            connection.execute(relationships.insert(), [
+                {'id': 'relationship--{}'.format(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                 'type': 'relationship', 'relationship_type': 'related-to', 'source_ref': rng.choice(ids),
+                 'target_ref': rng.choice(ids), 'derived': False,
+                 'created': start + datetime.timedelta(minutes=i), 'modified': start + datetime.timedelta(minutes=i)}
+                for i in range(first, min(first + batch_size, edges))])
+    return ids, start + datetime.timedelta(minutes=objects)
+
+
+def sizes(engine):
+    # Bytes of every table and index
+    with engine.connect() as connection:
+        return dict(connection.execute(sa.text('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name')).fetchall())
+
+
+def timed(engine, statement, values):
+    # Milliseconds per statement
+    with engine.connect() as connection:
+        start = time.time()
+        for value in values:
+            connection.execute(statement, value).fetchall()
+        return (time.time() - start) * 1000 / len(values)
+
+
+def measure(metadata, args):
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    engine = sa.create_engine('sqlite:///' + path)
+    try:
+        metadata.create_all(engine)
+        ids, end = populate(engine, metadata, args.objects, args.edges)
+        rng = random.Random(1)
+        picked = [rng.choice(ids) for _ in range(args.lookups)]
+        identities, relationships = metadata.tables['identities'], metadata.tables['relationships']
+        results = {'sizes': sizes(engine), 'file': os.path.getsize(path)}
+        results['id lookup'] = timed(engine, sa.select([identities.c.name]).where(
+            identities.c.id == sa.bindparam('id')), [{'id': id} for id in picked])
+        results['adjacency'] = timed(engine, sa.select([relationships.c.target_ref]).where(
+            relationships.c.source_ref == sa.bindparam('ref')), [{'ref': id} for id in picked])
+        # the objects modified in the last day, as read by the change feed and the dashboard
+        results['modified since'] = timed(engine, sa.select([identities.c.id]).where(
+            identities.c.modified > sa.bindparam('since')),
+            [{'since': end - datetime.timedelta(days=1)}] * max(1, args.lookups // 1000))
+        return results
+    finally:
+        engine.dispose()
+        os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, default=200000)
+    parser.add_argument('--edges', type=int, default=500000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    args = parser.parse_args()
+
+    before, after = measure(string_layout(), args), measure(compact_layout(), args)
+    print('{} identities, {} relationships'.format(args.objects, args.edges))
+    print('{:>36} {:>12} {:>12}'.format('KiB', 'String(64)', 'StixId'))
+    for name in sorted(set(before['sizes']) | set(after['sizes'])):
+        if name.startswith(('identities', 'relationships', 'ix_', 'sqlite_autoindex')):
+            print('{:>36} {:>12} {:>12}'.format(name, *[
+                '{:.0f}'.format(results['sizes'][name] / 1024) if name in results['sizes'] else '-'
+                for results in (before, after)]))
+    print('{:>36} {:>12.0f} {:>12.0f}'.format('database file', before['file'] / 1024, after['file'] / 1024))
+    print('{:>36} {:>12} {:>12}'.format('ms/query', '', ''))
+    for name in ('id lookup', 'adjacency', 'modified since'):
+        print('{:>36} {:>12.3f} {:>12.3f}'.format(name, before[name], after[name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# Requests per second of the production server as workers are added.
+#
+#   python -m benchmarks.load [--path /] [--clients 16] [--seconds 10] [--threads 4]
+#
+# Starts gunicorn (gunicorn.conf.py) on a SQLite file database for 1, 2, 4, ... workers up to the number of
+# cores, and drives it from client processes holding keep-alive connections.
+import argparse
+import http.client
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+PORT = 8765
+
+
+def client(path, seconds, results):
+    # one client: requests back to back on a keep-alive connection
+    connection = http.client.HTTPConnection('127.0.0.1', PORT)
+    count, errors, deadline = 0, 0, time.time() + seconds
+    while time.time() < deadline:
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 500:
+                errors += 1
+            count += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', PORT)
+    results.put((count, errors))
+
+
+def wait_ready(timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', PORT, timeout=1)
+            connection.request('GET', '/health')
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('the server did not start')
+
+
+def run(workers, threads, path, clients, seconds, env):
+    server = subprocess.Popen(
+        [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()', '-c', 'gunicorn.conf.py', '--workers', str(workers),
+         '--threads', str(threads), '--bind', '127.0.0.1:{}'.format(PORT), '--access-logfile', '/dev/null',
+         'wsgi:app'], env=env, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=client, args=(path, seconds, results)) for _ in range(clients)]
+        for process in processes:
+            process.start()
+        totals = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+    return sum(count for count, _ in totals) / seconds, sum(errors for _, errors in totals)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default='/')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    env = dict(os.environ, FLASK_CONFIG='production', SECRET_KEY='load-test',
+               SQLALCHEMY_DATABASE_URI='sqlite:///' + path)
+    os.environ.update(env)
+    from app import create_app, db
+    app = create_app('production')
+    with app.app_context():
+        db.create_all()
+
+    print('{:>8} {:>8} {:>12} {:>8}'.format('workers', 'threads', 'requests/s', 'errors'))
+    cores = os.cpu_count() or 1
+    for workers in [n for n in (1, 2, 4, 8, 16, 32) if n <= cores] or [1]:
+        rate, errors = run(workers, args.threads, args.path, args.clients, args.seconds, env)
+        print('{:>8} {:>8} {:>12.1f} {:>8}'.format(workers, args.threads, rate, errors))
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Render time of the cached pages with and without the fragment cache.
+#
+#   python -m benchmarks.pages [--users 200] [--requests 200]
+#
+# Logs in as an admin on an in-memory SQLite database and requests each page repeatedly.
+import argparse
+import time
+
+from flask import url_for
+
+from app import create_app, db
+from app.models import Role, User
+
+PAGES = ('home.homepage', 'home.admin_dashboard', 'admin.list_users', 'admin.list_roles')
+
+
+def populate(users):
+    db.session.add(User(username='admin', email='admin@example.com', password='admin', is_admin=True))
+    roles = [Role(name='role{}'.format(i), description='role') for i in range(10)]
+    db.session.add_all(roles)
+    db.session.add_all([User(username='user{}'.format(i), email='user{}@example.com'.format(i),
+                             name='User {}'.format(i), role=roles[i % 10]) for i in range(users)])
+    db.session.commit()
+
+
+def timed(client, url, requests):
+    client.get(url)
+    start = time.time()
+    for _ in range(requests):
+        client.get(url)
+    return (time.time() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    app = create_app('testing')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    with app.app_context():
+        db.create_all()
+        populate(args.users)
+        client = app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': 'admin'})
+
+        print('{:>22} {:>12} {:>12}'.format('', 'uncached ms', 'cached ms'))
+        for endpoint in PAGES:
+            with app.test_request_context():
+                url = url_for(endpoint)
+            app.config['FRAGMENT_CACHE_ENABLED'] = False
+            uncached = timed(client, url, args.requests)
+            app.config['FRAGMENT_CACHE_ENABLED'] = True
+            cached = timed(client, url, args.requests)
+            print('{:>22} {:>12.2f} {:>12.2f}'.format(endpoint, uncached * 1000, cached * 1000))
+
+
+if __name__ == '__main__':
+    main()
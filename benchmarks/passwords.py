@@ -0,0 +1,44 @@
+# Logins per second and per core of the password hashing pool.
+#
+#   python -m benchmarks.passwords [--logins 200] [--method pbkdf2:sha256:150000]
+#
+# Each login is one hash check, submitted from twice as many threads as there are workers, like
+# request threads of a server waiting on the pool.
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash
+
+from app.passwords import PasswordHasher
+
+
+def run(workers, logins, method):
+    hasher = PasswordHasher()
+    hasher.configure(method, workers=workers, queue_size=max(1, workers))
+    pwhash = generate_password_hash('password', method)
+    hasher.verify(pwhash, 'password')  # start the pool outside the measurement
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, workers) * 2) as threads:
+        list(threads.map(lambda _: hasher.verify(pwhash, 'password'), range(logins)))
+    elapsed = time.time() - start
+    hasher.shutdown()
+    return logins / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--method', default='pbkdf2:sha256:150000')
+    args = parser.parse_args()
+
+    print('{:>8} {:>12} {:>14}'.format('workers', 'logins/s', 'logins/s/core'))
+    for workers in [0] + [n for n in (1, 2, 4, 8, 16) if n <= (os.cpu_count() or 1)]:
+        rate = run(workers, args.logins, args.method)
+        print('{:>8} {:>12.1f} {:>14.1f}'.format(workers or 'inline', rate, rate / max(1, workers)))
+
+
+if __name__ == '__main__':
+    main()
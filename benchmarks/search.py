@@ -0,0 +1,65 @@
+# Search latency of the full-text index against a LIKE scan over the text columns.
+#
+#   python -m benchmarks.search [--objects 20000] [--queries 50]
+#
+# Runs against an in-memory SQLite database filled with generated posts and identities.
+import argparse
+import random
+import time
+
+from app import create_app, db
+from app.models import Identity, Post
+from app.stix.search import reindex, scan, search
+
+WORDS = ('malware phishing botnet ransomware exploit campaign actor report indicator payload domain '
+         'credential beacon loader dropper backdoor implant sample network traffic').split()
+
+
+def sentence(rng, length):
+    return ' '.join(rng.choice(WORDS) + str(rng.randint(0, 999)) for _ in range(length))
+
+
+def populate(count):
+    rng = random.Random(0)
+    db.session.bulk_insert_mappings(Post, [
+        {'id': 'post--{}'.format(i), 'text': sentence(rng, 3), 'description': sentence(rng, 30)}
+        for i in range(count)])
+    db.session.bulk_insert_mappings(Identity, [
+        {'id': 'identity--{}'.format(i), 'name': sentence(rng, 2), 'description': sentence(rng, 30)}
+        for i in range(count // 10)])
+    db.session.commit()
+
+
+def timed(function, queries):
+    start = time.time()
+    for query in queries:
+        function(query, None, 20, 0)
+    return (time.time() - start) / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=50)
+    args = parser.parse_args()
+
+    app = create_app('testing')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    with app.app_context():
+        db.create_all()
+        start = time.time()
+        populate(args.objects)
+        indexed = reindex()
+        print('indexed {} objects in {:.2f}s'.format(indexed, time.time() - start))
+
+        rng = random.Random(1)
+        queries = ['{}{}'.format(rng.choice(WORDS), rng.randint(0, 999)) for _ in range(args.queries)]
+        index_time = timed(search, queries)
+        scan_time = timed(scan, queries)
+        print('{:>8} {:>12}'.format('', 'ms/query'))
+        print('{:>8} {:>12.2f}'.format('index', index_time * 1000))
+        print('{:>8} {:>12.2f}'.format('scan', scan_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Cold start time of the app and where it goes.
+#
+#   python -m benchmarks.startup [--runs 5] [--profile]
+#
+# Each run is a fresh interpreter importing the app and calling create_app, like a new worker or a short
+# flask cli command. --profile prints the slowest imports and create_app calls of one more run.
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+STARTUP = '''
+import json, time
+start = time.time()
+from app import create_app
+imported = time.time()
+create_app('testing')
+print(json.dumps({'import': imported - start, 'create_app': time.time() - imported}))
+'''
+
+PROFILE = '''
+import cProfile, pstats
+profile = cProfile.Profile()
+profile.enable()
+from app import create_app
+create_app('testing')
+profile.disable()
+pstats.Stats(profile).sort_stats('cumulative').print_stats(25)
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--profile', action='store_true')
+    args = parser.parse_args()
+
+    runs = [json.loads(subprocess.check_output([sys.executable, '-c', STARTUP], stderr=subprocess.DEVNULL))
+            for _ in range(args.runs)]
+    for phase in ('import', 'create_app'):
+        times = [run[phase] * 1000 for run in runs]
+        print('{:>12} median {:7.1f} ms  min {:7.1f} ms'.format(phase, statistics.median(times), min(times)))
+
+    if args.profile:
+        # imports slower than 10ms, with their dependencies
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP], stderr=subprocess.PIPE,
+                                stdout=subprocess.DEVNULL, universal_newlines=True).stderr
+        imports = []
+        for line in output.splitlines()[1:]:
+            _, cumulative, name = line.split('|')
+            if int(cumulative) >= 10000:
+                imports.append((int(cumulative), name.rstrip()))
+        for cumulative, name in imports:
+            print('{:>10.1f} ms {}'.format(cumulative / 1000, name))
+        subprocess.run([sys.executable, '-c', PROFILE])
+
+
+if __name__ == '__main__':
+    main()
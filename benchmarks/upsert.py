@@ -0,0 +1,86 @@
+# Writes of imported STIX objects: the ON CONFLICT upsert engine against the bulk insert and update mappings
+# it replaced, for new objects, newer versions of stored objects and versions already stored.
+#
+#   python -m benchmarks.upsert [--objects 100000] [--batch-size 1000]
+#
+# Runs against a SQLite database in a temporary file; times the writes of the import batches alone, without
+# parsing, the search index or the change feed.
+import argparse
+import datetime
+import os
+import tempfile
+import time
+import uuid
+
+from app import create_app, db
+from app.models import Post
+from app.stix import upsert
+from app.stix.bundle import from_stix
+
+
+def versions(count, day):
+    # Rows of count posts in the version modified on the given day
+    modified = '2020-01-{:02d}T00:00:00.000Z'.format(day)
+    return [from_stix({'type': 'post', 'id': 'post--{}'.format(uuid.UUID(int=i, version=4)),
+                       'text': 'post {}'.format(i), 'created': '2020-01-01T00:00:00.000Z',
+                       'modified': modified})[1] for i in range(count)]
+
+
+def mappings(rows):
+    # Baseline: ids already stored read in one query, then bulk insert and update mappings
+    ids = list(rows)
+    existing = set(row.id for row in db.session.query(Post.id).filter(Post.id.in_(ids)))
+    inserts = [row for stix_id, row in rows.items() if stix_id not in existing]
+    updates = [row for stix_id, row in rows.items() if stix_id in existing]
+    if inserts:
+        db.session.bulk_insert_mappings(Post, inserts)
+    if updates:
+        db.session.bulk_update_mappings(Post, updates)
+    return len(rows)
+
+
+def engine(rows):
+    connection = db.session.connection()
+    inserts, updates, skipped, _ = upsert.plan(connection, Post, rows)
+    return upsert.write(connection, Post, inserts, updates)
+
+
+def timed(write, rows, batch_size):
+    start = time.time()
+    for first in range(0, len(rows), batch_size):
+        batch = rows[first:first + batch_size]
+        write(dict((row['id'], row) for row in batch))
+        db.session.commit()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    app = create_app('testing')
+    rounds = (('insert', 1), ('newer', 2), ('same', 2))
+    print('{} posts, {} per transaction'.format(args.objects, args.batch_size))
+    print('{:>10} {:>12} {:>12}'.format('objects/s', 'mappings', 'upsert'))
+    results = {}
+    for name, write in (('mappings', mappings), ('upsert', engine)):
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+        try:
+            with app.app_context():
+                db.create_all()
+                for label, day in rounds:
+                    results[name, label] = args.objects / timed(write, versions(args.objects, day), args.batch_size)
+                db.session.remove()
+                db.get_engine(app).dispose()
+        finally:
+            os.remove(path)
+    for label, _ in rounds:
+        print('{:>10} {:>12.0f} {:>12.0f}'.format(label, results['mappings', label], results['upsert', label]))
+
+
+if __name__ == '__main__':
+    main()
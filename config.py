@@ -1,3 +1,7 @@
+import multiprocessing
+import os
+
+
 class Config(object):
     """
     Common configurations
@@ -5,6 +9,126 @@ class Config(object):
 
     DEBUG = True
 
+    # Database connection pool (ignored for SQLite): connections kept open, extra connections allowed under
+    # load, seconds to wait for a connection, seconds before a connection is replaced, whether connections are
+    # tested before use and how many are opened at startup; statement timeout in milliseconds
+    DATABASE_POOL_SIZE = 5
+    DATABASE_POOL_MAX_OVERFLOW = 10
+    DATABASE_POOL_TIMEOUT = 30
+    DATABASE_POOL_RECYCLE = 1800
+    DATABASE_POOL_PRE_PING = True
+    DATABASE_POOL_WARM_UP = 0
+    DATABASE_STATEMENT_TIMEOUT = None
+
+    # Read replicas: database uris, views reading from them by blueprint (a list of view names, or True for
+    # every GET view), replication lag tolerated in seconds, how often lag is checked and how long a client
+    # keeps reading from the primary after it wrote
+    DATABASE_REPLICAS = []
+    DATABASE_REPLICA_ROUTES = {
+        'admin': ['list_users', 'list_roles'],
+        'stix': ['list_user_accounts', 'list_roles'],
+        'home': ['dashboard', 'admin_dashboard'],
+    }
+    DATABASE_REPLICA_MAX_LAG = 5
+    DATABASE_REPLICA_CHECK_INTERVAL = 5
+    DATABASE_REPLICA_STICKY_SECONDS = 10
+
+    # Shared cache server (redis url, or 'local' for an in-process stand-in), in-process caches if unset
+    CACHE_REDIS_URL = None
+    # Web server processes (gunicorn workers). Without a shared cache each keeps its own copies of users, pages
+    # and lookup tables, which then expire after CACHE_UNSHARED_TTL seconds to pick up the writes of the others.
+    WEB_CONCURRENCY = 1
+    CACHE_UNSHARED_TTL = 5
+    # Snapshots of logged in users, saves a query per request
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 300
+    # Lookup tables (roles, vocabularies), keyed on the data version of their table
+    REFERENCE_CACHE_SIZE = 256
+    REFERENCE_CACHE_TTL = 3600
+    # Rendered pages and template fragments, keyed on the data versions of the tables they show
+    FRAGMENT_CACHE_ENABLED = True
+    FRAGMENT_CACHE_SIZE = 4096
+    FRAGMENT_CACHE_TTL = 300
+
+    # Password hashing: werkzeug method and salt length, worker processes (0 hashes in the request thread),
+    # hashes allowed to wait for a worker and how long a login waits for a slot before it is turned away
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:150000'
+    PASSWORD_HASH_SALT_LENGTH = 16
+    PASSWORD_HASH_WORKERS = 0
+    PASSWORD_HASH_QUEUE_SIZE = 32
+    PASSWORD_HASH_QUEUE_TIMEOUT = 5
+
+    # Request metrics: queries slower than this many seconds are logged, a SELECT repeated this many times
+    # in one request is reported as a possible N+1 pattern
+    METRICS_SLOW_QUERY_SECONDS = 0.5
+    METRICS_N_PLUS_ONE_THRESHOLD = 10
+    # Client networks allowed to read /metrics and /health, others get a 404. Behind a reverse proxy the client
+    # address has to be restored (werkzeug ProxyFix).
+    MONITORING_NETWORKS = ('127.0.0.0/8', '::1/128', '10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16', 'fc00::/7')
+
+    # Strategy eager loading relationships in list views: joined, selectin or subquery
+    EAGER_LOADING = 'joined'
+
+    # Change history: records are buffered and appended in batches by a background thread per process
+    AUDIT_ENABLED = True
+    AUDIT_ASYNC = True
+    AUDIT_BATCH_SIZE = 500
+    AUDIT_FLUSH_INTERVAL = 1.0
+    AUDIT_QUEUE_SIZE = 10000
+
+    # Rows written per transaction by the bulk update and delete endpoints
+    BULK_CHUNK_SIZE = 1000
+
+    # Full-text search index over STIX objects (FTS5 on SQLite, tsvector on Postgres), kept in step on writes
+    SEARCH_ENABLED = True
+
+    # Relationship graph traversal: hops and nodes a traversal may reach at most, node ids per adjacency query,
+    # and the cache of the adjacency lists of visited nodes
+    GRAPH_MAX_DEPTH = 3
+    GRAPH_MAX_NODES = 1000
+    GRAPH_BATCH_SIZE = 500
+    GRAPH_CACHE_ENABLED = True
+    GRAPH_CACHE_SIZE = 100000
+    GRAPH_CACHE_TTL = 300
+
+    # Counters of the admin dashboard, maintained on every write; reading them queues a recount job when the
+    # last one is older than this many seconds
+    STATISTICS_ENABLED = True
+    STATISTICS_RECONCILE_INTERVAL = 3600
+
+    # Background jobs: folder of uploaded bundles and exports (instance/jobs if unset), attempts per job and
+    # seconds before the first retry, doubled with every attempt; processes of `flask jobs worker`, seconds
+    # between polls of the queue, and seconds without a heartbeat after which the job of a worker counts as lost
+    JOBS_FOLDER = None
+    JOBS_MAX_ATTEMPTS = 3
+    JOBS_RETRY_DELAY = 10
+    JOBS_WORKER_PROCESSES = 2
+    JOBS_POLL_INTERVAL = 1.0
+    JOBS_TIMEOUT = 300
+
+    # Login attempts allowed per client address and per username: a burst, then a steady rate per minute.
+    # Behind a reverse proxy the client address has to be restored (werkzeug ProxyFix).
+    LOGIN_RATE_LIMIT_ENABLED = True
+    LOGIN_IP_BURST = 20
+    LOGIN_IP_PER_MINUTE = 10
+    LOGIN_USERNAME_BURST = 10
+    LOGIN_USERNAME_PER_MINUTE = 3
+    RATELIMIT_CACHE_SIZE = 100000
+    RATELIMIT_CACHE_TTL = 3600
+
+    # Keyset pagination of the list views
+    PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 500
+
+    # Objects written per transaction by STIX bundle imports
+    STIX_IMPORT_BATCH_SIZE = 1000
+    # Rows per INSERT ... ON CONFLICT statement of the imports (fewer when the database limits bound parameters),
+    # and whether the versions replaced by newer ones are kept in the object_versions table
+    STIX_UPSERT_BATCH_SIZE = 5000
+    STIX_VERSION_HISTORY = False
+    # Rows fetched per database round trip by STIX bundle exports
+    STIX_EXPORT_BATCH_SIZE = 1000
+
 
 class DevelopmentConfig(Config):
     """
@@ -21,6 +145,20 @@ class ProductionConfig(Config):
 
     DEBUG = False
 
+    DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', 10))
+    DATABASE_POOL_MAX_OVERFLOW = int(os.getenv('DATABASE_POOL_MAX_OVERFLOW', 20))
+    DATABASE_POOL_TIMEOUT = int(os.getenv('DATABASE_POOL_TIMEOUT', 10))
+    DATABASE_POOL_RECYCLE = int(os.getenv('DATABASE_POOL_RECYCLE', 1800))
+    DATABASE_POOL_WARM_UP = int(os.getenv('DATABASE_POOL_WARM_UP', 2))
+    DATABASE_STATEMENT_TIMEOUT = int(os.getenv('DATABASE_STATEMENT_TIMEOUT', 30000))
+    DATABASE_REPLICAS = [uri for uri in os.getenv('DATABASE_REPLICAS', '').split() if uri]
+
+    CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL') or None
+    # as gunicorn.conf.py starts them
+    WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+
+    PASSWORD_HASH_WORKERS = 2
+
 
 class TestingConfig(Config):
     """
@@ -28,6 +166,11 @@ class TestingConfig(Config):
     """
 
     TESTING = True
+    WTF_CSRF_ENABLED = False
+    # the in-memory test database is not visible from the audit writer thread
+    AUDIT_ASYNC = False
+    # cheap hashes keep the tests fast
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
 
 
 app_config = {
@@ -0,0 +1,47 @@
+# Production server settings: FLASK_CONFIG=production gunicorn -c gunicorn.conf.py wsgi:app
+#
+# Every setting can be overridden from the environment. Workers are forked from a master that preloads the
+# app, so the code and the data loaded at startup are shared copy-on-write between them.
+#
+# Reloading without dropping requests:
+#   kill -HUP <master pid>    new workers with the current settings (the preloaded code is kept)
+#   kill -USR2 <master pid>   start a new master with new code next to the old one, then
+#   kill -QUIT <old pid>      stop the old master once the new workers answer
+import gc
+import multiprocessing
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+# processes make use of the cores, threads overlap the time requests wait on the database
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+# gthread for threads; gevent or eventlet can be used when installed
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+# recycle workers after a number of requests to bound memory growth, 0 to never recycle
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 0))
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+errorlog = os.getenv('GUNICORN_ERROR_LOG', '-')
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+
+def when_ready(server):
+    # The app is loaded: release its database connections and keep the objects created so far out of the
+    # garbage collector, whose reference count updates would copy the shared pages into every worker
+    if server.cfg.preload_app:
+        from app import before_fork
+        before_fork(server.app.wsgi())
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from app import after_fork
+        after_fork(server.app.wsgi())
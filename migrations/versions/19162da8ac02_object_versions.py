@@ -0,0 +1,36 @@
+"""object versions
+
+Revision ID: 19162da8ac02
+Revises: 61fe08b9e21c
+Create Date: 2026-10-18 17:55:28.201272
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.models import StixId
+
+# revision identifiers, used by Alembic.
+revision = '19162da8ac02'
+down_revision = '61fe08b9e21c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'object_versions',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('object_type', sa.String(length=64), nullable=False),
+        sa.Column('object_id', StixId(), nullable=False),
+        sa.Column('modified', sa.DateTime(), nullable=True),
+        sa.Column('data', sa.Text(), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_object_versions_object', 'object_versions', ['object_id', 'modified'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_object_versions_object', table_name='object_versions')
+    op.drop_table('object_versions')
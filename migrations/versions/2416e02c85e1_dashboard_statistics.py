@@ -0,0 +1,31 @@
+"""dashboard statistics
+
+Revision ID: 2416e02c85e1
+Revises: d497265c3eaf
+Create Date: 2026-10-18 19:12:43.881420
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2416e02c85e1'
+down_revision = 'd497265c3eaf'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Empty counters; the statistics.reconcile job counts the stored rows
+    op.create_table(
+        'statistics',
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('key', sa.String(length=64), nullable=False),
+        sa.Column('value', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name', 'key'),
+    )
+
+
+def downgrade():
+    op.drop_table('statistics')
@@ -0,0 +1,30 @@
+"""data versions
+
+Revision ID: 5c0d8e2a4b17
+Revises: 19162da8ac02
+Create Date: 2026-10-18 21:04:12.518306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c0d8e2a4b17'
+down_revision = '19162da8ac02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Tables without a row are at version 0 until their next write
+    op.create_table(
+        'data_versions',
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name'),
+    )
+
+
+def downgrade():
+    op.drop_table('data_versions')
@@ -0,0 +1,99 @@
+"""compact stix ids and indexed timestamps
+
+Revision ID: 61fe08b9e21c
+Revises: 9e0f819d806b
+Create Date: 2026-10-18 17:46:28.257412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.models import StixId
+
+
+# revision identifiers, used by Alembic.
+revision = '61fe08b9e21c'
+down_revision = '9e0f819d806b'
+branch_labels = None
+depends_on = None
+
+# id columns of the STIX tables and the type of the ids they hold (None for refs of any type)
+ID_COLUMNS = {
+    'user_accounts': [('id', 'user-account')],
+    'identities': [('id', 'identity')],
+    'posts': [('id', 'post')],
+    'relationships': [('id', 'relationship'), ('source_ref', None), ('target_ref', None)],
+}
+# expression indexes, which SQLite does not reflect and would lose when the table is recreated
+NAME_INDEXES = {
+    'user_accounts': 'ix_user_accounts_name_lower',
+    'identities': 'ix_identities_name_lower',
+}
+
+
+def _name_key():
+    # lower(name) folding only ASCII letters, as the app compares names; PostgreSQL needs the "C" collation for it
+    if op.get_bind().dialect.name == 'postgresql':
+        return sa.text('lower(name COLLATE "C")')
+    return sa.text('lower(name)')
+
+
+def _text(value):
+    # Id read without type conversion: text before the upgrade on SQLite, bytes on the other databases
+    return value if isinstance(value, str) else bytes(value).decode('utf-8')
+
+
+def _rewrite(table, columns, convert, batch_size=1000):
+    # Replace every id by convert(id, type_name), a batch of rows per statement
+    bind = op.get_bind()
+    names = [name for name, _ in columns]
+    rows = sa.table(table, *[sa.column(name) for name in names])
+    statement = rows.update().where(rows.c.id == sa.bindparam('old_id')).values(
+        **dict((name, sa.bindparam('new_' + name)) for name in names))
+    values = []
+    for row in bind.execute(sa.select([rows.c[name] for name in names])):
+        value = {'old_id': row[0]}
+        for (name, type_name), old in zip(columns, row):
+            value['new_' + name] = convert(old, type_name)
+        values.append(value)
+        if len(values) == batch_size:
+            bind.execute(statement, values)
+            values = []
+    if values:
+        bind.execute(statement, values)
+
+
+def upgrade():
+    for table, columns in ID_COLUMNS.items():
+        if table in NAME_INDEXES:
+            op.drop_index(NAME_INDEXES[table], table_name=table)
+        with op.batch_alter_table(table) as batch_op:
+            for name, _ in columns:
+                batch_op.alter_column(name, existing_type=sa.String(length=64), type_=sa.LargeBinary(),
+                                      postgresql_using="convert_to({}, 'UTF8')".format(name))
+        _rewrite(table, columns, lambda old, type_name: StixId(type_name).encode(_text(old)))
+        if table in NAME_INDEXES:
+            op.create_index(NAME_INDEXES[table], table, [_name_key()], unique=True)
+        op.create_index(op.f('ix_{}_created'.format(table)), table, ['created'], unique=False)
+        op.create_index(op.f('ix_{}_modified'.format(table)), table, ['modified'], unique=False)
+
+
+def downgrade():
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    for table, columns in ID_COLUMNS.items():
+        op.drop_index(op.f('ix_{}_modified'.format(table)), table_name=table)
+        op.drop_index(op.f('ix_{}_created'.format(table)), table_name=table)
+        if table in NAME_INDEXES:
+            op.drop_index(NAME_INDEXES[table], table_name=table)
+
+        def convert(old, type_name):
+            text = StixId(type_name).decode(old)
+            # SQLite keeps blobs as blobs in a text column, the text has to be written as text
+            return text if sqlite else text.encode('utf-8')
+        _rewrite(table, columns, convert)
+        with op.batch_alter_table(table) as batch_op:
+            for name, _ in columns:
+                batch_op.alter_column(name, existing_type=sa.LargeBinary(), type_=sa.String(length=64),
+                                      postgresql_using="convert_from({}, 'UTF8')".format(name))
+        if table in NAME_INDEXES:
+            op.create_index(NAME_INDEXES[table], table, [_name_key()], unique=True)
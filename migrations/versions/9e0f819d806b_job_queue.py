@@ -0,0 +1,47 @@
+"""job queue
+
+Revision ID: 9e0f819d806b
+Revises: 2416e02c85e1
+Create Date: 2026-10-18 19:14:05.270693
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e0f819d806b'
+down_revision = '2416e02c85e1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('task', sa.String(length=64), nullable=False),
+        sa.Column('arguments', sa.Text(), nullable=True),
+        sa.Column('status', sa.String(length=16), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('max_attempts', sa.Integer(), nullable=False),
+        sa.Column('cancel_requested', sa.Boolean(), nullable=False),
+        sa.Column('progress', sa.Integer(), nullable=False),
+        sa.Column('total', sa.Integer(), nullable=True),
+        sa.Column('result', sa.Text(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('worker', sa.String(length=64), nullable=True),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.Column('run_after', sa.DateTime(), nullable=False),
+        sa.Column('started', sa.DateTime(), nullable=True),
+        sa.Column('heartbeat', sa.DateTime(), nullable=True),
+        sa.Column('finished', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_jobs_queue', 'jobs', ['status', 'run_after'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_jobs_queue', table_name='jobs')
+    op.drop_table('jobs')
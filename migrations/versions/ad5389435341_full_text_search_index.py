@@ -0,0 +1,40 @@
+"""full-text search index
+
+Revision ID: ad5389435341
+Revises: dfbf5627f773
+Create Date: 2026-10-18 19:04:37.915522
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.stix.search import SQLiteIndex, PostgresIndex
+
+
+# revision identifiers, used by Alembic.
+revision = 'ad5389435341'
+down_revision = 'dfbf5627f773'
+branch_labels = None
+depends_on = None
+
+# the index of each backend with full-text search; the others search with LIKE scans
+INDEXES = {'sqlite': SQLiteIndex(), 'postgresql': PostgresIndex()}
+
+
+def upgrade():
+    # Empty index; `flask stix reindex` fills it from the tables
+    bind = op.get_bind()
+    index = INDEXES.get(bind.dialect.name)
+    if index is not None:
+        try:
+            index.create(bind)
+        except sa.exc.OperationalError:
+            # SQLite built without FTS5
+            pass
+
+
+def downgrade():
+    bind = op.get_bind()
+    index = INDEXES.get(bind.dialect.name)
+    if index is not None:
+        index.drop(bind)
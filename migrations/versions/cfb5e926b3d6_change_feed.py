@@ -0,0 +1,34 @@
+"""change feed
+
+Revision ID: cfb5e926b3d6
+Revises: d3ec1b6c6b92
+Create Date: 2026-10-18 19:09:48.302974
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'cfb5e926b3d6'
+down_revision = 'd3ec1b6c6b92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Empty feed; the stix.feed-rebuild job puts the stored objects in it
+    op.create_table(
+        'feed',
+        sa.Column('seq', sa.Integer(), nullable=False),
+        sa.Column('object_type', sa.String(length=64), nullable=False),
+        sa.Column('object_id', sa.String(length=64), nullable=False),
+        sa.Column('deleted', sa.Boolean(), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('seq'),
+        sa.UniqueConstraint('object_id'),
+    )
+
+
+def downgrade():
+    op.drop_table('feed')
@@ -0,0 +1,34 @@
+"""case insensitive unique names
+
+Revision ID: d1c49051d400
+Revises: ad5389435341
+Create Date: 2026-10-18 19:06:52.107846
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd1c49051d400'
+down_revision = 'ad5389435341'
+branch_labels = None
+depends_on = None
+
+
+def _name_key():
+    # lower(name) folding only ASCII letters, as the app compares names; PostgreSQL needs the "C" collation for it
+    if op.get_bind().dialect.name == 'postgresql':
+        return sa.text('lower(name COLLATE "C")')
+    return sa.text('lower(name)')
+
+
+def upgrade():
+    # Fails on names that differ only in case; rename the duplicates first
+    op.create_index('ix_user_accounts_name_lower', 'user_accounts', [_name_key()], unique=True)
+    op.create_index('ix_identities_name_lower', 'identities', [_name_key()], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_identities_name_lower', table_name='identities')
+    op.drop_index('ix_user_accounts_name_lower', table_name='user_accounts')
@@ -0,0 +1,38 @@
+"""change history
+
+Revision ID: d3ec1b6c6b92
+Revises: d1c49051d400
+Create Date: 2026-10-18 19:08:15.640271
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3ec1b6c6b92'
+down_revision = 'd1c49051d400'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'changes',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('object_type', sa.String(length=64), nullable=False),
+        sa.Column('object_id', sa.String(length=64), nullable=False),
+        sa.Column('action', sa.String(length=16), nullable=False),
+        sa.Column('changes', sa.Text(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_changes_object', 'changes', ['object_id', 'created'], unique=False)
+    op.create_index('ix_changes_created', 'changes', ['created'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_changes_created', table_name='changes')
+    op.drop_index('ix_changes_object', table_name='changes')
+    op.drop_table('changes')
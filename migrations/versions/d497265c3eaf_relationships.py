@@ -0,0 +1,42 @@
+"""relationships
+
+Revision ID: d497265c3eaf
+Revises: cfb5e926b3d6
+Create Date: 2026-10-18 19:11:20.558137
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd497265c3eaf'
+down_revision = 'cfb5e926b3d6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'relationships',
+        sa.Column('id', sa.String(length=64), nullable=False),
+        sa.Column('type', sa.String(length=64), nullable=True),
+        sa.Column('relationship_type', sa.String(length=64), nullable=False),
+        sa.Column('source_ref', sa.String(length=64), nullable=False),
+        sa.Column('target_ref', sa.String(length=64), nullable=False),
+        sa.Column('description', sa.Text(), nullable=True),
+        sa.Column('derived', sa.Boolean(), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=True),
+        sa.Column('modified', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_relationships_source', 'relationships', ['source_ref', 'relationship_type', 'target_ref'],
+                    unique=False)
+    op.create_index('ix_relationships_target', 'relationships', ['target_ref', 'relationship_type', 'source_ref'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_relationships_target', table_name='relationships')
+    op.drop_index('ix_relationships_source', table_name='relationships')
+    op.drop_table('relationships')
@@ -0,0 +1,110 @@
+"""baseline schema
+
+Revision ID: dfbf5627f773
+Revises:
+Create Date: 2026-10-18 19:02:11.420318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'dfbf5627f773'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'roles',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=60), nullable=True),
+        sa.Column('description', sa.String(length=200), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('name'),
+    )
+    op.create_table(
+        'identityclasses',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=64), nullable=True),
+        sa.Column('description', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_table(
+        'identityroles',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=64), nullable=True),
+        sa.Column('description', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('email', sa.String(length=60), nullable=True),
+        sa.Column('username', sa.String(length=60), nullable=True),
+        sa.Column('name', sa.String(length=120), nullable=True),
+        sa.Column('password_hash', sa.String(length=128), nullable=True),
+        sa.Column('role_id', sa.Integer(), nullable=True),
+        sa.Column('is_admin', sa.Boolean(), nullable=True),
+        sa.ForeignKeyConstraint(['role_id'], ['roles.id']),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(op.f('ix_users_email'), 'users', ['email'], unique=True)
+    op.create_index(op.f('ix_users_name'), 'users', ['name'], unique=False)
+    op.create_index(op.f('ix_users_username'), 'users', ['username'], unique=True)
+    op.create_table(
+        'user_accounts',
+        sa.Column('id', sa.String(length=64), nullable=False),
+        sa.Column('name', sa.String(length=64), nullable=True),
+        sa.Column('description', sa.Text(), nullable=True),
+        sa.Column('type', sa.String(length=64), nullable=True),
+        sa.Column('created', sa.DateTime(), nullable=True),
+        sa.Column('modified', sa.DateTime(), nullable=True),
+        sa.Column('account_type', sa.String(length=32), nullable=True),
+        sa.Column('account_created', sa.DateTime(), nullable=True),
+        sa.Column('account_is_disabled', sa.Boolean(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_table(
+        'identities',
+        sa.Column('id', sa.String(length=64), nullable=False),
+        sa.Column('name', sa.String(length=64), nullable=True),
+        sa.Column('description', sa.Text(), nullable=True),
+        sa.Column('type', sa.String(length=64), nullable=True),
+        sa.Column('created', sa.DateTime(), nullable=True),
+        sa.Column('modified', sa.DateTime(), nullable=True),
+        sa.Column('identity_role', sa.Integer(), nullable=True),
+        sa.Column('identity_class', sa.Integer(), nullable=True),
+        sa.Column('contact_information', sa.String(length=128), nullable=True),
+        sa.Column('location', sa.String(length=128), nullable=True),
+        sa.ForeignKeyConstraint(['identity_class'], ['identityclasses.id'], ondelete='SET NULL'),
+        sa.ForeignKeyConstraint(['identity_role'], ['identityroles.id'], ondelete='SET NULL'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_table(
+        'posts',
+        sa.Column('id', sa.String(length=64), nullable=False),
+        sa.Column('text', sa.String(length=64), nullable=True),
+        sa.Column('description', sa.Text(), nullable=True),
+        sa.Column('type', sa.String(length=64), nullable=True),
+        sa.Column('created', sa.DateTime(), nullable=True),
+        sa.Column('modified', sa.DateTime(), nullable=True),
+        sa.Column('post_type', sa.String(length=64), nullable=True),
+        sa.Column('post_url', sa.String(length=64), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+
+def downgrade():
+    op.drop_table('posts')
+    op.drop_table('identities')
+    op.drop_table('user_accounts')
+    op.drop_index(op.f('ix_users_username'), table_name='users')
+    op.drop_index(op.f('ix_users_name'), table_name='users')
+    op.drop_index(op.f('ix_users_email'), table_name='users')
+    op.drop_table('users')
+    op.drop_table('identityroles')
+    op.drop_table('identityclasses')
+    op.drop_table('roles')
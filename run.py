@@ -6,4 +6,5 @@ config_name = os.getenv('FLASK_CONFIG')
 app = create_app(config_name)
 
 if __name__ == '__main__':
+    # development server, production runs under gunicorn: gunicorn -c gunicorn.conf.py wsgi:app
     app.run()
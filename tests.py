@@ -1,10 +1,37 @@
+import datetime
+import gzip
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+import warnings
+import zlib
+from unittest import mock
 
-from flask import abort, url_for
+from flask import abort, render_template_string, url_for
 from flask_testing import TestCase
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
 
-from app import create_app, db
-from app.models import User, Role
+from app import after_fork, audit_log, before_fork, create_app, db, jobs, metrics, password_hasher, \
+    relationship_graph, statistics, user_cache
+from app.cache import Cache, MemoryCache, SharedCache, LocalClient
+from app.database import MeteredQueuePool, engine_options, pool_stats
+from app.models import User, Role, UserAccount, Identity, IdentityClass, Post, Relationship, Change, Job, \
+    DataVersion, FeedEntry, ObjectVersion, Statistic, StixId, load_user, names_in_use
+from app.passwords import HashingBusy, PasswordHasher
+from app.ratelimit import RateLimiter
+from app.pagination import keyset_paginate
+from app.stix.bundle import iter_bundle_objects
+from app.stix.exporter import gzip_chunks
+from app.stix.importer import import_bundle
+from app.stix import feed, upsert
+from app.stix.search import search
 
 
 class TestBase(TestCase):
@@ -37,6 +64,10 @@ class TestBase(TestCase):
         db.session.remove()
         db.drop_all()
 
+    def login(self, username='admin', password='admin'):
+        # log a test user in through the login view
+        return self.client.post(url_for('auth.login'), data=dict(username=username, password=password))
+
 
 class TestModels(TestBase):
 
@@ -138,5 +169,1741 @@ class TestErrorPages(TestBase):
         self.assertTrue(bytes("500 Error", encoding='utf-8') in response.data)
 
 
+class TestPagination(TestBase):
+
+    def test_pages_cover_every_row_once(self):
+        # Walk all pages of roles and check every row is seen exactly once, in order
+        for i in range(5):
+            db.session.add(Role(name='role{}'.format(i), description='test role'))
+        db.session.commit()
+
+        names, after = [], None
+        while True:
+            page = keyset_paginate(Role.query, [Role.id], 2, after=after)
+            names.extend(role.name for role in page.items)
+            if not page.has_next:
+                break
+            after = page.next_cursor
+
+        self.assertEqual(names, ['role{}'.format(i) for i in range(5)])
+
+    def test_previous_page_with_ties(self):
+        # Accounts created at the same time are ordered by id and the previous page can be reached
+        created = datetime.datetime(2020, 1, 1)
+        for i in range(4):
+            db.session.add(UserAccount(id='user-account--{}'.format(i), name='account {}'.format(i), created=created))
+        db.session.commit()
+
+        keys = [UserAccount.created, UserAccount.id]
+        first = keyset_paginate(UserAccount.query, keys, 2, descending=True)
+        second = keyset_paginate(UserAccount.query, keys, 2, after=first.next_cursor, descending=True)
+        back = keyset_paginate(UserAccount.query, keys, 2, before=second.prev_cursor, descending=True)
+
+        self.assertEqual([a.id for a in second.items], ['user-account--1', 'user-account--0'])
+        self.assertFalse(second.has_next)
+        self.assertEqual([a.id for a in back.items], [a.id for a in first.items])
+        self.assertFalse(back.has_prev)
+
+    def test_users_view_is_paginated(self):
+        # Test if the users list shows one page and a link to the next one
+        self.login()
+        response = self.client.get(url_for('admin.list_users', per_page=1))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Next', response.data)
+
+    def test_invalid_cursor(self):
+        # Test if a malformed cursor is rejected
+        self.login()
+        response = self.client.get(url_for('admin.list_users', after='not-a-cursor'))
+        self.assertEqual(response.status_code, 400)
+
+
+def make_bundle(objects):
+    # build a STIX bundle document from a list of objects
+    return json.dumps({'type': 'bundle', 'id': 'bundle--1', 'objects': objects}).encode('utf-8')
+
+
+class TestBundleImport(TestBase):
+
+    objects = [
+        {'type': 'user-account', 'id': 'user-account--1', 'account_login': 'jdoe', 'account_type': 'unix',
+         'is_disabled': True},
+        {'type': 'identity', 'id': 'identity--1', 'name': 'ACME', 'identity_class': 'organization',
+         'roles': ['vendor'], 'created': '2020-01-01T00:00:00.000Z'},
+        {'type': 'post', 'id': 'post--1', 'text': 'hello', 'post_url': 'https://example.com/1'},
+        {'type': 'malware', 'id': 'malware--1', 'name': 'ignored'},
+        {'type': 'identity', 'id': 'bad-id', 'name': 'invalid'},
+    ]
+
+    def test_streaming_parser(self):
+        # Objects are parsed from a stream read in chunks much smaller than one object
+        objects = list(iter_bundle_objects(io.BytesIO(make_bundle(self.objects)), chunk_size=7))
+        self.assertEqual(objects, self.objects)
+
+    def test_import_bundle(self):
+        # Test if supported objects are inserted in batches and re-imports update them by id
+        result = import_bundle(io.BytesIO(make_bundle(self.objects)), batch_size=2)
+        self.assertEqual((result.inserted, result.updated, result.invalid, result.ignored), (3, 0, 1, 1))
+        self.assertTrue(UserAccount.query.get('user-account--1').account_is_disabled)
+        identity = Identity.query.get('identity--1')
+        self.assertEqual(IdentityClass.query.get(identity.identity_class).name, 'organization')
+        self.assertEqual(identity.created, datetime.datetime(2020, 1, 1))
+
+        updated = dict(self.objects[2], text='edited')
+        result = import_bundle(io.BytesIO(make_bundle([updated])))
+        self.assertEqual((result.inserted, result.updated), (0, 1))
+        self.assertEqual(Post.query.get('post--1').text, 'edited')
+
+    def test_malformed_fields(self):
+        # Test if fields of the wrong json type count as invalid objects instead of failing the import
+        objects = [
+            {'type': ['post'], 'id': 'post--2', 'text': 'list type'},
+            {'type': 'identity', 'id': 'identity--2', 'name': 'A', 'identity_class': 5},
+            {'type': 'identity', 'id': 'identity--3', 'name': 'B', 'roles': 'admin'},
+            {'type': 'identity', 'id': 'identity--4', 'name': 'C', 'roles': [['admin']]},
+            {'type': 'post', 'id': 'post--3', 'text': {'not': 'text'}},
+            {'type': 'post', 'id': 'post--4', 'text': 'valid'},
+            {'type': 'user-account', 'id': 'user-account--2', 'account_login': 'x', 'is_disabled': 'false'},
+            {'type': 'user-account', 'id': 'user-account--3', 'account_login': 'y', 'is_disabled': 1},
+        ]
+        result = import_bundle(io.BytesIO(make_bundle(objects)))
+        self.assertEqual((result.inserted, result.invalid), (1, 7))
+        self.assertEqual(Identity.query.count(), 0)
+
+    def test_import_command(self):
+        # Test the flask stix import command
+        handle, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(handle, 'wb') as bundle:
+            bundle.write(make_bundle(self.objects))
+        try:
+            result = self.app.test_cli_runner().invoke(args=['stix', 'import', path])
+        finally:
+            os.remove(path)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('3 inserted', result.output)
+        self.assertEqual(UserAccount.query.count(), 1)
+
+    def test_import_view(self):
+        # Test if admins can post a bundle to the import endpoint
+        self.login()
+        response = self.client.post(url_for('stix.import_bundle_view'), data=make_bundle(self.objects),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['inserted'], 3)
+
+
+class TestBundleExport(TestBase):
+
+    def setUp(self):
+        super(TestBundleExport, self).setUp()
+        import_bundle(io.BytesIO(make_bundle(TestBundleImport.objects)))
+
+    def test_export_view(self):
+        # Test if the exported bundle contains every stored object and can be imported again, where the
+        # versions already stored are skipped
+        self.login()
+        response = self.client.get(url_for('stix.export_bundle_view'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        objects = json.loads(response.data)['objects']
+        self.assertEqual(sorted(obj['id'] for obj in objects), ['identity--1', 'post--1', 'user-account--1'])
+        identity = [obj for obj in objects if obj['type'] == 'identity'][0]
+        self.assertEqual((identity['identity_class'], identity['roles']), ('organization', ['vendor']))
+
+        result = import_bundle(io.BytesIO(response.data))
+        self.assertEqual((result.inserted, result.updated, result.skipped), (0, 0, 3))
+
+    def test_export_view_gzip(self):
+        # Test if the bundle is compressed for clients accepting gzip and can be filtered by type
+        self.login()
+        response = self.client.get(url_for('stix.export_bundle_view', type='post'),
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        objects = json.loads(gzip.decompress(response.data))['objects']
+        self.assertEqual([obj['id'] for obj in objects], ['post--1'])
+        self.assertIn('Accept-Encoding', response.vary)
+
+    def test_gzip_chunks_flushed(self):
+        # Test if every chunk of a synced gzip stream decompresses as soon as it is received
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        for chunk, data in zip(['{"a": 1', ', "b": 2', '}'], gzip_chunks(['{"a": 1', ', "b": 2', '}'], sync=True)):
+            self.assertEqual(decompressor.decompress(data).decode(), chunk)
+
+    def test_export_command(self):
+        # Test the flask stix export command
+        result = self.app.test_cli_runner().invoke(args=['stix', 'export', '--type', 'identity'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual([obj['id'] for obj in json.loads(result.output)['objects']], ['identity--1'])
+
+
+class TestUserCache(TestBase):
+
+    def test_load_user_is_cached(self):
+        # The second load of a user is served from the cache without the users table
+        user = User.query.filter_by(username='test').first()
+        self.assertEqual(load_user(str(user.id)).username, 'test')
+        User.query.filter_by(id=user.id).delete()
+        db.session.commit()
+
+        cached = load_user(str(user.id))
+        self.assertEqual((cached.username, cached.is_admin), ('test', False))
+        self.assertEqual(user_cache.stats()['hits'], 1)
+
+    def test_edit_user_invalidates_cache(self):
+        # Test if editing a user through the admin view refreshes its cached snapshot
+        role = Role(name='analyst', description='analyze data')
+        db.session.add(role)
+        db.session.commit()
+        user = User.query.filter_by(username='test').first()
+        self.assertFalse(load_user(str(user.id)).is_admin)
+
+        self.login()
+        response = self.client.post(url_for('admin.edit_user', id=user.id),
+                                    data=dict(email='test@example.com', username='test', name='Test',
+                                              role_id=role.id, is_admin='y'))
+        self.assertEqual(response.status_code, 302)
+        cached = load_user(str(user.id))
+        self.assertEqual((cached.is_admin, cached.role_name), (True, 'analyst'))
+
+    def test_memory_cache_eviction(self):
+        # Least recently used entries are evicted and expired entries are not returned
+        cache = MemoryCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        cache.set('d', 4, ttl=-1)
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual((cache.hits, cache.misses), (3, 2))
+
+    def test_unshared_ttl(self):
+        # In-process caches of database data keep entries briefly when several workers run, rate limits do not
+        self.app.config.update(WEB_CONCURRENCY=3, CACHE_UNSHARED_TTL=5)
+        users, limits = Cache('test-users'), Cache('test-limits', follows_writes=False)
+        users.init_app(self.app)
+        limits.init_app(self.app)
+        self.assertEqual((users.backend.max_ttl, limits.backend.max_ttl), (5, None))
+        users.set('a', 1, ttl=3600)
+        self.assertLessEqual(users.backend._entries['a'][0], time.time() + 5)
+
+    def test_shared_cache(self):
+        # The shared backend stores pickled values under its prefix in the key-value client
+        client = LocalClient()
+        cache = SharedCache(client, prefix='user')
+        cache.set('1', {'username': 'test'})
+        self.assertEqual(cache.get('1'), {'username': 'test'})
+        self.assertEqual(list(client.scan_iter()), ['user:1'])
+        cache.clear()
+        self.assertIsNone(cache.get('1'))
+
+
+class TestPasswordHashing(TestBase):
+
+    def test_rehash_on_login(self):
+        # Test if a hash made with outdated parameters is upgraded when the user logs in
+        user = User.query.filter_by(username='test').first()
+        user.password_hash = PasswordHasher().hash('test')
+        db.session.commit()
+        self.assertTrue(user.password_needs_rehash())
+
+        response = self.login('test', 'test')
+        self.assertEqual(response.status_code, 302)
+        user = User.query.filter_by(username='test').first()
+        self.assertFalse(user.password_needs_rehash())
+        self.assertTrue(user.verify_password('test'))
+
+    def test_worker_pool(self):
+        # Hashes computed by the worker processes can be checked in the request thread and back
+        hasher = PasswordHasher()
+        hasher.configure('pbkdf2:sha256:1000', workers=1)
+        try:
+            pwhash = hasher.hash('secret')
+            self.assertTrue(password_hasher.verify(pwhash, 'secret'))
+            self.assertTrue(hasher.verify(password_hasher.hash('secret'), 'secret'))
+        finally:
+            hasher.shutdown()
+
+    def test_busy_login(self):
+        # Test if logins are turned away while every hashing slot is taken
+        password_hasher.configure('pbkdf2:sha256:1000', queue_size=0, timeout=0.01)
+        self.assertTrue(password_hasher._slots.acquire())
+        try:
+            self.assertRaises(HashingBusy, password_hasher.hash, 'secret')
+            response = self.login()
+        finally:
+            password_hasher._slots.release()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(password_hasher.stats()['rejected'], 2)
+
+
+    def test_busy_registration(self):
+        # Test if sign ups and users added by an admin are turned away, not failed, while hashing is busy
+        role = Role(name='analyst', description='reads')
+        db.session.add(role)
+        db.session.commit()
+        self.login()
+        password_hasher.configure('pbkdf2:sha256:1000', queue_size=0, timeout=0.01)
+        user = dict(email='new@example.com', username='new', name='New', password='secret',
+                    confirm_password='secret')
+        self.assertTrue(password_hasher._slots.acquire())
+        try:
+            registered = self.client.post(url_for('auth.register'), data=user)
+            added = self.client.post(url_for('admin.add_user'), data=dict(user, role_id=role.id))
+        finally:
+            password_hasher._slots.release()
+        self.assertEqual((registered.status_code, added.status_code), (503, 503))
+        self.assertIsNone(User.query.filter_by(username='new').first())
+
+    def test_salt_length_change(self):
+        # Test if a hash with a salt of another length than the configured one needs a rehash
+        hasher = PasswordHasher()
+        hasher.configure('pbkdf2:sha256:1000', salt_length=16)
+        pwhash = hasher.hash('secret')
+        self.assertFalse(hasher.needs_rehash(pwhash))
+        hasher.configure('pbkdf2:sha256:1000', salt_length=8)
+        self.assertTrue(hasher.needs_rehash(pwhash))
+
+
+class TestDatabasePool(TestBase):
+
+    def test_engine_options(self):
+        # Pool settings and the statement timeout are applied to server databases but not to SQLite
+        self.app.config['DATABASE_STATEMENT_TIMEOUT'] = 5000
+        options = engine_options(self.app.config, make_url('postgresql://db/app'))
+        self.assertIs(options['poolclass'], MeteredQueuePool)
+        self.assertEqual(options['pool_size'], self.app.config['DATABASE_POOL_SIZE'])
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=5000'})
+        self.assertEqual(options['executemany_mode'], 'values')
+        self.assertEqual(engine_options(self.app.config, make_url('sqlite://')), {})
+
+    def test_connections_of_parent_process(self):
+        # Test if a connection opened by another process (before a fork) is replaced, not closed, at checkout
+        engine = db.create_engine(make_url('sqlite://'), {'poolclass': QueuePool, 'pool_size': 1})
+        connection = engine.connect()
+        inherited = connection.connection.connection
+        connection.connection.info['pid'] = os.getpid() + 1
+        connection.close()
+        with engine.connect() as connection:
+            self.assertIsNot(connection.connection.connection, inherited)
+        self.assertEqual(inherited.execute('SELECT 1').fetchone(), (1,))
+
+    def test_pool_metrics(self):
+        # Checkouts that time out waiting for a connection are counted
+        engine = create_engine('sqlite://', poolclass=MeteredQueuePool, pool_size=1, max_overflow=0,
+                               pool_timeout=0.01)
+        connection = engine.connect()
+        self.assertRaises(exc.TimeoutError, engine.connect)
+        stats = pool_stats(engine)
+        self.assertEqual((stats['checked_out'], stats['checkouts'], stats['timeouts']), (1, 2, 1))
+        connection.close()
+
+    def test_health_view(self):
+        # Test if the health check pings the database without logging in
+        response = self.client.get(url_for('health.check'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json['database']['ok'])
+        self.assertIn('class', response.json['pool'])
+
+    def test_fork_hooks(self):
+        # Connections of a preloading server are closed before forking and each worker opens its own
+        disposed, connected = [], []
+        event.listen(db.engine, 'engine_disposed', disposed.append)
+        event.listen(db.engine, 'connect', lambda *args: connected.append(args))
+        before_fork(self.app)
+        self.assertEqual(disposed, [db.engine])
+        self.app.config['DATABASE_POOL_WARM_UP'] = 1
+        after_fork(self.app)
+        self.assertEqual(len(connected), 1)
+
+
+class TestReadReplicas(TestBase):
+
+    def create_app(self):
+        # a second SQLite file stands in for a read replica
+        app = super(TestReadReplicas, self).create_app()
+        handle, self.replica_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        app.config['DATABASE_REPLICAS'] = ['sqlite:///' + self.replica_path]
+        return app
+
+    def setUp(self):
+        super(TestReadReplicas, self).setUp()
+        # the replica has the users but not the latest roles
+        self.replica = create_engine('sqlite:///' + self.replica_path)
+        db.Model.metadata.create_all(self.replica)
+        users = [dict(row) for row in db.session.execute(User.__table__.select())]
+        self.replica.execute(User.__table__.insert(), users)
+        self.replica.execute(Role.__table__.insert(), name='replica role', description='on the replica')
+
+    def tearDown(self):
+        super(TestReadReplicas, self).tearDown()
+        self.replica.dispose()
+        os.remove(self.replica_path)
+
+    def test_list_reads_from_replica(self):
+        # Test if a replica-routed list view reads from the replica
+        self.login()
+        response = self.client.get(url_for('admin.list_roles'))
+        self.assertIn(b'replica role', response.data)
+
+    def test_read_your_writes(self):
+        # Test if a client reads from the primary right after it wrote
+        self.login()
+        self.client.post(url_for('admin.add_role'), data=dict(name='primary role', description='new'))
+        response = self.client.get(url_for('admin.list_roles'))
+        self.assertIn(b'primary role', response.data)
+        self.assertNotIn(b'replica role', response.data)
+
+    def test_reference_data_from_primary(self):
+        # Test if lookup tables read during a replica-routed request are cached from the primary
+        self.login()
+        self.client.get(url_for('home.admin_dashboard'))
+        response = self.client.get(url_for('admin.add_user'))
+        self.assertNotIn(b'replica role', response.data)
+
+    def test_statistics_from_primary(self):
+        # Test if the dashboard counters read during a replica-routed request are cached from the primary
+        self.replica.execute(Statistic.__table__.insert(), name='users_per_role', key='99', value=5)
+        self.login()
+        self.client.get(url_for('home.admin_dashboard'))
+        self.assertNotIn('99', statistics.counts()['users_per_role'])
+
+    def test_lagging_replica_is_skipped(self):
+        # Test if reads fall back to the primary when the replica lags too much
+        self.app.config['DATABASE_REPLICA_MAX_LAG'] = -1
+        self.login()
+        response = self.client.get(url_for('admin.list_roles'))
+        self.assertNotIn(b'replica role', response.data)
+
+
+class TestMetrics(TestBase):
+
+    def test_metrics_view(self):
+        # Test if request latency, SQL and resource metrics are exposed in the Prometheus text format
+        self.client.get(url_for('home.homepage'))
+        response = self.client.get(url_for('health.prometheus_metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'http_request_duration_seconds_count{endpoint="home.homepage"} 1.0', response.data)
+        self.assertIn(b'template_render_seconds_bucket{endpoint="home.homepage",le="+Inf"} 1.0', response.data)
+        self.assertIn(b'cache_hits_total{cache="user"}', response.data)
+
+    def test_monitoring_networks(self):
+        # Test if /metrics and /health only answer clients of MONITORING_NETWORKS
+        outside = {'REMOTE_ADDR': '203.0.113.5'}
+        for endpoint in ('health.prometheus_metrics', 'health.check'):
+            self.assertEqual(self.client.get(url_for(endpoint), environ_base=outside).status_code, 404)
+            self.assertEqual(self.client.get(url_for(endpoint)).status_code, 200)
+        self.app.config['MONITORING_NETWORKS'] = ('203.0.113.0/24',)
+        self.assertEqual(self.client.get(url_for('health.check'), environ_base=outside).status_code, 200)
+
+    def test_n_plus_one_and_slow_queries(self):
+        # A SELECT repeated per row is reported as N+1 and every query counts as slow with a zero threshold
+        self.app.config.update(METRICS_N_PLUS_ONE_THRESHOLD=2, METRICS_SLOW_QUERY_SECONDS=0)
+
+        @self.app.route('/n-plus-one')
+        def n_plus_one():
+            users = User.query.all()
+            return ','.join(str(User.query.get(user.id + 100)) for user in users)
+
+        self.client.get('/n-plus-one')
+        self.assertEqual(metrics.n_plus_one['n_plus_one'], 1)
+        self.assertEqual(metrics.slow_queries['n_plus_one'], 3)
+        self.assertEqual(metrics.query_count['n_plus_one'].sum, 3)
+
+
+class TestEagerLoading(TestBase):
+
+    def add_users(self, count):
+        # add users with a role each
+        for i in range(count):
+            role = Role(name='role{}'.format(Role.query.count()), description='test role')
+            db.session.add(User(username='user{}'.format(User.query.count()), role=role))
+        db.session.commit()
+
+    def count_queries(self, endpoint):
+        # number of queries run by a request to endpoint
+        queries = []
+        listener = lambda *args: queries.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = self.client.get(url_for(endpoint))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def check_constant(self, endpoint):
+        # measure the rendering itself, not the page cache
+        self.app.config['FRAGMENT_CACHE_ENABLED'] = False
+        self.login()
+        self.add_users(2)
+        self.count_queries(endpoint)
+        few = self.count_queries(endpoint)
+        self.add_users(10)
+        self.assertEqual(self.count_queries(endpoint), few)
+
+    def test_list_users_joined(self):
+        # Test if listing users costs the same number of queries however many users have roles
+        self.check_constant('admin.list_users')
+
+    def test_list_users_selectin(self):
+        self.app.config['EAGER_LOADING'] = 'selectin'
+        self.check_constant('admin.list_users')
+
+    def test_list_roles(self):
+        # Test if user counts of roles are computed in one query
+        self.check_constant('admin.list_roles')
+
+
+class TestReferenceData(TestBase):
+
+    def test_form_choices_are_cached(self):
+        # Test if rendering the add user form a second time runs no query but the read of the data versions
+        db.session.add(Role(name='analyst', description='analyze data'))
+        db.session.commit()
+        self.login()
+        self.client.get(url_for('admin.add_user'))
+
+        queries = []
+        listener = lambda *args: queries.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = self.client.get(url_for('admin.add_user'))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertIn(b'analyst', response.data)
+        self.assertEqual([query for query in queries if 'FROM data_versions' not in query], [])
+
+    def test_commit_invalidates_choices(self):
+        # Test if a role added through the role views shows up in the user form
+        self.login()
+        self.client.get(url_for('admin.add_user'))
+        self.client.post(url_for('admin.add_role'), data=dict(name='auditor', description='audit'))
+        response = self.client.get(url_for('admin.add_user'))
+        self.assertIn(b'auditor', response.data)
+
+
+class TestSearch(TestBase):
+
+    def test_index_follows_writes(self):
+        # Test if inserted, updated and deleted objects are found or dropped right after the flush
+        post = Post(id='post--1', text='quarterly report', description='revenue figures')
+        db.session.add(post)
+        db.session.commit()
+        self.assertEqual([match[1] for match in search('revenue')], ['post--1'])
+
+        post.description = 'expense figures'
+        db.session.commit()
+        self.assertEqual(search('revenue'), [])
+        self.assertEqual([match[1] for match in search('expense')], ['post--1'])
+
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(search('expense'), [])
+
+    def test_title_matches_rank_first(self):
+        # Test if a match in the name ranks above a match in the description, and prefix matching
+        db.session.add_all([
+            Identity(id='identity--1', name='Globex', description='supplier of phishing kits'),
+            Identity(id='identity--2', name='Phishing Watch', description='tracks campaigns'),
+            Post(id='post--1', text='unrelated', description='nothing'),
+        ])
+        db.session.commit()
+        self.assertEqual([match[1] for match in search('phish')], ['identity--2', 'identity--1'])
+        self.assertEqual(search('phish', types=['post']), [])
+
+    def test_search_view(self):
+        # Test if the search endpoint pages through the results with titles
+        db.session.add_all([Post(id='post--{}'.format(i), text='malware note {}'.format(i)) for i in range(5)])
+        db.session.commit()
+        self.login()
+        response = self.client.get(url_for('stix.search_view', q='malware', per_page=2, page=3))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json['has_next'])
+        self.assertEqual(len(response.json['results']), 1)
+        self.assertTrue(response.json['results'][0]['title'].startswith('malware note'))
+        self.assertTrue(self.client.get(url_for('stix.search_view', q='malware', per_page=2)).json['has_next'])
+        self.assertEqual(self.client.get(url_for('stix.search_view', q='x', type='bogus')).status_code, 400)
+
+    def test_imported_objects_are_indexed(self):
+        # Test if objects written by the bulk importer are searchable
+        import_bundle(io.BytesIO(make_bundle(TestBundleImport.objects)))
+        self.assertEqual([match[1] for match in search('ACME')], ['identity--1'])
+
+
+class TestUniqueNames(TestBase):
+
+    def test_case_insensitive_unique_index(self):
+        # Test if the database rejects a name differing only in case
+        db.session.add(Identity(id='identity--1', name='ACME'))
+        db.session.commit()
+        db.session.add(Identity(id='identity--2', name='acme'))
+        self.assertRaises(exc.IntegrityError, db.session.commit)
+        db.session.rollback()
+
+    def test_name_lookup_uses_index(self):
+        # Test if checking names searches the index instead of scanning the table
+        plan = db.session.execute("EXPLAIN QUERY PLAN SELECT id FROM user_accounts WHERE lower(name) IN ('a', 'b')")
+        self.assertIn('ix_user_accounts_name_lower', ' '.join(str(row[-1]) for row in plan))
+
+    def test_batch_check(self):
+        # Test if one query reports the taken names of a batch, and the endpoint the duplicates in it
+        db.session.add_all([Identity(id='identity--1', name='ACME'), Identity(id='identity--2', name='Globex')])
+        db.session.commit()
+        names = ['name {}'.format(i) for i in range(2000)] + ['acme', 'GLOBEX']
+        self.assertEqual(names_in_use(Identity, names), {'acme': 'identity--1', 'globex': 'identity--2'})
+
+        self.login()
+        response = self.client.post(url_for('stix.validate_names_view'),
+                                    json={'type': 'identity', 'names': ['Acme', 'Initech', 'initech']})
+        self.assertEqual(response.json, {'in_use': {'Acme': 'identity--1'}, 'duplicates': ['initech']})
+        response = self.client.post(url_for('stix.validate_names_view'), json={'type': 'post', 'names': []})
+        self.assertEqual(response.status_code, 400)
+
+    def test_admin_only(self):
+        # Test if non admin users cannot check names or search
+        self.login('test', 'test')
+        response = self.client.post(url_for('stix.validate_names_view'), json={'type': 'identity', 'names': []})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.client.get(url_for('stix.search_view', q='x')).status_code, 403)
+
+    def test_add_form_creates_account(self):
+        # Test if the add user account form stores a new account under a generated STIX id
+        self.login()
+        response = self.client.post(url_for('stix.add_user_account'), data=dict(name='jdoe', account_type='unix'))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith(url_for('stix.list_user_accounts')))
+        account = UserAccount.query.filter_by(name='jdoe').one()
+        self.assertTrue(account.id.startswith('user-account--'))
+        self.assertEqual(account.account_type, 'unix')
+
+    def test_add_form_rejects_taken_name(self):
+        # Test if the add user account form reports a name taken in another case
+        db.session.add(UserAccount(id='user-account--1', name='jdoe'))
+        db.session.commit()
+        self.login()
+        response = self.client.post(url_for('stix.add_user_account'), data=dict(name='JDoe'))
+        self.assertIn(b'Name is already in use!', response.data)
+        self.assertEqual(UserAccount.query.count(), 1)
+
+    def test_import_rejects_taken_names(self):
+        # Test if the importer reports name conflicts as invalid objects instead of failing the batch
+        db.session.add(Identity(id='identity--1', name='ACME'))
+        db.session.commit()
+        result = import_bundle(io.BytesIO(make_bundle([
+            {'type': 'identity', 'id': 'identity--1', 'name': 'ACME', 'description': 'updated'},
+            {'type': 'identity', 'id': 'identity--2', 'name': 'acme'},
+            {'type': 'identity', 'id': 'identity--3', 'name': 'Initech'},
+            {'type': 'identity', 'id': 'identity--4', 'name': 'INITECH'},
+        ])))
+        self.assertEqual((result.inserted, result.updated, result.invalid), (1, 1, 2))
+        self.assertEqual(sorted(error['id'] for error in result.errors), ['identity--2', 'identity--4'])
+
+    def test_non_ascii_names(self):
+        # Test if names are folded like the index folds them, ASCII letters only, so checks and inserts agree
+        result = import_bundle(io.BytesIO(make_bundle([
+            {'type': 'identity', 'id': 'identity--1', 'name': '\u00c9cole'},
+            {'type': 'identity', 'id': 'identity--2', 'name': '\u00e9cole'},
+            {'type': 'identity', 'id': 'identity--3', 'name': '\u00c9COLE'},
+        ])))
+        self.assertEqual((result.inserted, result.invalid), (2, 1))
+        self.assertEqual([error['id'] for error in result.errors], ['identity--3'])
+        self.assertEqual(names_in_use(Identity, ['\u00c9COLE']), {'\u00c9cole': 'identity--1'})
+
+
+class TestApi(TestBase):
+
+    def setUp(self):
+        super(TestApi, self).setUp()
+        db.session.add(Identity(id='identity--1', name='ACME', description='vendor',
+                                modified=datetime.datetime(2020, 1, 1)))
+        db.session.commit()
+        self.login()
+
+    def queries(self, url, **headers):
+        # GET url and return the response with the SQL statements it ran
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = self.client.get(url, headers=headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return response, statements
+
+    def test_conditional_get(self):
+        # Test if a revalidation answers 304 from the modified column alone
+        url = url_for('api.get_object', collection='identities', id='identity--1')
+        response = self.client.get(url)
+        self.assertEqual(response.json['data']['name'], 'ACME')
+        etag = response.headers['ETag']
+
+        response, statements = self.queries(url, **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('description', statements[0])
+
+        response = self.client.get(url, headers={'If-Modified-Since': 'Wed, 01 Jan 2020 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, headers={'If-Modified-Since': 'Tue, 31 Dec 2019 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_versions_follow_other_processes(self):
+        # Test if the ETags and cached pages follow the data versions stored in the database, which the writes of
+        # every process (another web worker, a job, the cli) increment in their transaction
+        version = lambda: db.session.query(DataVersion.version).filter_by(name='identities').scalar()
+        before = version()
+        import_bundle(io.BytesIO(make_bundle([{'type': 'identity', 'id': 'identity--9', 'name': 'Initech'}])))
+        self.assertEqual(version(), before + 1)
+
+        url = url_for('api.list_objects', collection='identities')
+        etag = self.client.get(url).headers['ETag']
+        self.assertNotIn(b'tester', self.client.get(url_for('admin.list_users')).data)
+        # commits of another process: rows and versions, without this process seeing the session events
+        with db.engine.begin() as connection:
+            connection.execute(Identity.__table__.update().values(description='written elsewhere'))
+            connection.execute(User.__table__.update().where(User.username == 'test').values(username='tester'))
+            connection.execute(DataVersion.__table__.update().where(DataVersion.name.in_(['identities', 'users']))
+                               .values(version=DataVersion.version + 1))
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 200)
+        self.assertIn(b'tester', self.client.get(url_for('admin.list_users')).data)
+
+    def test_list_revalidation_reads_versions_only(self):
+        # Test if an unchanged collection is revalidated with the one read of the data versions, and a write
+        # changes its ETag
+        url = url_for('api.list_objects', collection='identities')
+        etag = self.client.get(url).headers['ETag']
+        response, statements = self.queries(url, **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(statements), 1)
+        self.assertIn('FROM data_versions', statements[0])
+
+        self.client.patch(url_for('api.update_object', collection='identities', id='identity--1'),
+                          json={'description': 'changed'})
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_sparse_fieldsets(self):
+        # Test if only the requested fields (and the id) are returned
+        response = self.client.get(url_for('api.list_objects', collection='identities', fields='name'))
+        self.assertEqual(response.json['data'], [{'id': 'identity--1', 'name': 'ACME'}])
+        response = self.client.get(url_for('api.list_objects', collection='identities', fields='nope'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_create_update_delete(self):
+        # Test the write methods, name conflicts and If-Match preconditions
+        response = self.client.post(url_for('api.create_object', collection='posts'), json={'text': 'hello'})
+        self.assertEqual(response.status_code, 201)
+        post_id = response.json['data']['id']
+        self.assertTrue(post_id.startswith('post--'))
+        self.assertTrue(response.headers['Location'].endswith(post_id))
+
+        response = self.client.post(url_for('api.create_object', collection='identities'), json={'name': 'acme'})
+        self.assertEqual(response.status_code, 409)
+
+        url = url_for('api.update_object', collection='posts', id=post_id)
+        etag = self.client.get(url).headers['ETag']
+        response = self.client.patch(url, json={'text': 'edited'}, headers={'If-Match': etag})
+        self.assertEqual(response.json['data']['text'], 'edited')
+        response = self.client.delete(url, headers={'If-Match': etag})
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_vocabulary_tables(self):
+        # Test if vocabulary entries are served with ETags from the data version of their table
+        response = self.client.post(url_for('api.create_object', collection='identity-classes'),
+                                    json={'name': 'organization'})
+        url = response.headers['Location']
+        etag = self.client.get(url).headers['ETag']
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+        self.client.put(url, json={'name': 'group'})
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).json['data']['name'], 'group')
+        self.assertEqual(self.client.get(url_for('api.get_object', collection='identity-classes', id='x')).status_code,
+                         404)
+
+
+class TestBulkOperations(TestBase):
+
+    def test_bulk_update_by_filter_in_chunks(self):
+        # Test if a filter update runs in one transaction per chunk and reports the count
+        self.app.config['BULK_CHUNK_SIZE'] = 3
+        db.session.add_all([UserAccount(id='user-account--{}'.format(i), name='account {}'.format(i),
+                                        account_type='unix' if i % 2 else 'windows') for i in range(10)])
+        db.session.commit()
+        commits = []
+        listener = lambda session: commits.append(session)
+        event.listen(db.session, 'after_commit', listener)
+        self.login()
+        try:
+            response = self.client.post(url_for('stix.bulk_user_accounts'), json={
+                'action': 'update', 'filter': {'account_type': 'unix'}, 'values': {'account_is_disabled': True}})
+        finally:
+            event.remove(db.session, 'after_commit', listener)
+        self.assertEqual(response.json, {'action': 'update', 'matched': 5, 'updated': 5})
+        self.assertEqual(len(commits), 2)
+        self.assertEqual(UserAccount.query.filter_by(account_is_disabled=True).count(), 5)
+
+        response = self.client.post(url_for('stix.bulk_user_accounts'), json={
+            'action': 'update', 'ids': ['user-account--0'], 'values': {'name': 'renamed'}})
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_filter_values(self):
+        # Test if filter times with an offset compare in UTC and values of the wrong json type are refused
+        db.session.add_all([UserAccount(id='user-account--{}'.format(i), name='account {}'.format(i),
+                                        created=datetime.datetime(2020, 1, 1, i)) for i in range(4)])
+        db.session.commit()
+        self.login()
+        url = url_for('stix.bulk_user_accounts')
+        response = self.client.post(url, json={'action': 'update', 'values': {'account_type': 'unix'},
+                                               'filter': {'created__lt': '2020-01-01T03:00:00+02:00'}})
+        self.assertEqual(response.json['updated'], 1)
+        response = self.client.post(url, json={'action': 'update', 'values': {'account_type': 'ldap'},
+                                               'filter': {'created__lt': '2020-01-01T02:00:00Z'}})
+        self.assertEqual(response.json['updated'], 2)
+        for body in ({'action': 'delete', 'filter': {'created__lt': 20200101}},
+                     {'action': 'delete', 'filter': {'account_is_disabled': 'no'}},
+                     {'action': 'update', 'ids': ['user-account--0'], 'values': {'account_type': ['unix']}},
+                     {'action': 'delete', 'ids': [{'id': 'user-account--0'}]}):
+            self.assertEqual(self.client.post(url, json=body).status_code, 400)
+        self.assertEqual(UserAccount.query.count(), 4)
+
+    def test_bulk_delete_by_ids(self):
+        # Test if deleted user accounts also leave the search index
+        db.session.add_all([UserAccount(id='user-account--{}'.format(i), name='stale {}'.format(i))
+                            for i in range(5)])
+        db.session.commit()
+        self.login()
+        response = self.client.post(url_for('stix.bulk_user_accounts'), json={
+            'action': 'delete', 'ids': ['user-account--1', 'user-account--2', 'user-account--9']})
+        self.assertEqual(response.json, {'action': 'delete', 'matched': 2, 'deleted': 2})
+        self.assertEqual(UserAccount.query.count(), 3)
+        self.assertEqual(len(search('stale')), 3)
+
+    def test_bulk_delete_dependents(self):
+        # Test if users of deleted roles are kept without a role, or the delete refused when asked to
+        role = Role(name='stale', description='old')
+        db.session.add(role)
+        db.session.commit()
+        db.session.add(User(username='jdoe', email='jdoe@example.com', password='secret', role_id=role.id))
+        db.session.commit()
+        self.login()
+
+        response = self.client.post(url_for('admin.bulk_roles'), json={
+            'action': 'delete', 'filter': {'name': 'stale'}, 'dependents': 'restrict'})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json['dependents'], {'users.role_id': 1})
+
+        response = self.client.post(url_for('admin.bulk_roles'), json={'action': 'delete', 'filter': {'name': 'stale'}})
+        self.assertEqual(response.json['deleted'], 1)
+        self.assertIsNone(User.query.filter_by(username='jdoe').one().role_id)
+
+    def test_bulk_requires_admin(self):
+        # Test if non admin users cannot run bulk operations
+        db.session.add(User(username='jdoe', email='jdoe@example.com', password='secret'))
+        db.session.commit()
+        self.login('jdoe', 'secret')
+        response = self.client.post(url_for('admin.bulk_users'), json={'action': 'delete', 'ids': [1]})
+        self.assertEqual(response.status_code, 403)
+
+
+class TestFragmentCache(TestBase):
+
+    def get(self, url):
+        # GET url and return the response with the number of SQL statements it ran
+        queries = []
+        listener = lambda *args: queries.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = self.client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return response, len(queries)
+
+    def test_page_cached_until_tables_change(self):
+        # Test if a list page is served from the cache until one of its tables is written
+        self.login()
+        first, queries = self.get(url_for('admin.list_users'))
+        self.assertGreater(queries, 0)
+        second, queries = self.get(url_for('admin.list_users'))
+        # only the data versions are read
+        self.assertEqual(queries, 1)
+        self.assertEqual(second.data, first.data)
+
+        db.session.add(Role(name='auditor', description='audit'))
+        db.session.add(User(username='jdoe', email='jdoe@example.com', password='secret'))
+        db.session.commit()
+        third, queries = self.get(url_for('admin.list_users'))
+        self.assertGreater(queries, 0)
+        self.assertIn(b'jdoe', third.data)
+
+    def test_per_user_variation(self):
+        # Test if users do not see the pages cached for each other
+        db.session.add(User(username='jdoe', email='jdoe@example.com', password='secret'))
+        db.session.commit()
+        self.login()
+        self.assertIn(b'Hi, admin!', self.client.get(url_for('home.dashboard')).data)
+        self.client.get(url_for('auth.logout'))
+        self.login('jdoe', 'secret')
+        response = self.client.get(url_for('home.dashboard'))
+        self.assertIn(b'Hi, jdoe!', response.data)
+        self.assertNotIn(b'Hi, admin!', response.data)
+
+    def test_navbar_follows_user_changes(self):
+        # Test if the cached navbar is rendered again when the user it greets changes
+        self.login()
+        self.assertIn(b'Hi, admin!', self.client.get(url_for('home.homepage')).data)
+        user = User.query.filter_by(username='admin').one()
+        user.username = 'root'
+        db.session.commit()
+        user_cache.delete(user.id)
+        self.assertIn(b'Hi, root!', self.client.get(url_for('home.homepage')).data)
+
+    def test_fragment_and_saved_time(self):
+        # Test if a fragment renders once per variation and cache hits count the render time saved
+        self.login()
+        template = "{% call cache_fragment('box', 'roles') %}{{ calls.append(1) or '' }}box{% endcall %}"
+        calls = []
+        with self.app.test_request_context():
+            for _ in range(3):
+                self.assertEqual(render_template_string(template, calls=calls), 'box')
+        self.assertEqual(len(calls), 1)
+        self.client.get(url_for('home.homepage'))
+        self.client.get(url_for('home.homepage'))
+        self.assertIn('fragment_cache_saved_seconds_total', self.client.get(url_for('health.prometheus_metrics'))
+                      .data.decode())
+
+
+class TestAuditLog(TestBase):
+
+    def test_view_changes_are_recorded(self):
+        # Test if adding and editing a role through the views records who changed which columns
+        self.login()
+        self.client.post(url_for('admin.add_role'), data=dict(name='auditor', description='audit'))
+        role = Role.query.filter_by(name='auditor').one()
+        self.client.post(url_for('admin.edit_role', id=role.id), data=dict(name='auditor', description='read'))
+
+        response = self.client.get(url_for('api.history', object_type='roles'))
+        changes = response.json['data']
+        self.assertEqual([change['action'] for change in changes], ['update', 'insert'])
+        self.assertEqual(changes[0]['changes'], {'description': ['audit', 'read']})
+        self.assertEqual(changes[1]['changes']['name'], [None, 'auditor'])
+        admin = User.query.filter_by(username='admin').one()
+        self.assertEqual(set(change['user_id'] for change in changes), {admin.id})
+
+    def test_object_history_and_redaction(self):
+        # Test if the history of one object is served by id and passwords are never copied
+        user = User(username='jdoe', email='jdoe@example.com', password='secret')
+        db.session.add(user)
+        db.session.commit()
+        db.session.delete(user)
+        db.session.commit()
+        self.login()
+        response = self.client.get(url_for('api.history', object_id=str(user.id), object_type='users'))
+        changes = response.json['data']
+        self.assertEqual([change['action'] for change in changes], ['delete', 'insert'])
+        self.assertEqual(changes[1]['changes']['password_hash'], [None, '***'])
+
+        self.client.post(url_for('api.create_object', collection='posts'), json={'text': 'hello'})
+        post = Post.query.one()
+        response = self.client.get(url_for('api.object_history', collection='posts', id=post.id))
+        self.assertEqual(len(response.json['data']), 1)
+
+    def test_modified_is_updated(self):
+        # Test if editing a STIX object moves its modified time
+        post = Post(id='post--1', text='hello', modified=datetime.datetime(2020, 1, 1))
+        db.session.add(post)
+        db.session.commit()
+        post.text = 'edited'
+        db.session.commit()
+        self.assertGreater(post.modified, datetime.datetime(2020, 1, 1))
+
+    def test_bulk_writes_are_recorded(self):
+        # Test if bulk deletes and imports leave one record per row
+        import_bundle(io.BytesIO(make_bundle(TestBundleImport.objects)))
+        self.login()
+        self.client.post(url_for('stix.bulk_user_accounts'), json={'action': 'delete', 'ids': ['user-account--1']})
+        actions = [(change.object_id, change.action) for change in Change.query.order_by(Change.id)]
+        self.assertIn(('identity--1', 'insert'), actions)
+        self.assertEqual(actions[-1], ('user-account--1', 'delete'))
+
+
+class TestAuditLogWriter(TestBase):
+
+    def create_app(self):
+        # the writer thread needs a database file it can open on its own connection
+        app = super(TestAuditLogWriter, self).create_app()
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + self.path, AUDIT_ASYNC=True,
+                          AUDIT_FLUSH_INTERVAL=0.05)
+        return app
+
+    def tearDown(self):
+        super(TestAuditLogWriter, self).tearDown()
+        db.get_engine(self.app).dispose()
+        os.remove(self.path)
+
+    def test_records_written_in_background(self):
+        # Test if committed changes reach the changes table without a flush from the request
+        db.session.add(Role(name='auditor', description='audit'))
+        db.session.commit()
+        # the writer counter is shared with the records of earlier tests, wait for the row itself
+        for _ in range(250):
+            count = Change.query.filter_by(object_type='roles').count()
+            db.session.rollback()
+            if count:
+                break
+            time.sleep(0.02)
+        self.assertEqual(count, 1)
+
+
+class TestChangeFeed(TestBase):
+
+    def setUp(self):
+        super(TestChangeFeed, self).setUp()
+        db.session.add_all([Post(id='post--{}'.format(i), text='post {}'.format(i)) for i in range(5)])
+        db.session.commit()
+        self.login()
+
+    def test_deltas_since_cursor(self):
+        # Test if a consumer gets only what changed after its cursor, deletes as tombstones
+        first = self.client.get(url_for('api.change_feed', limit=3)).json
+        self.assertEqual([item['id'] for item in first['data']], ['post--0', 'post--1', 'post--2'])
+        self.assertTrue(first['has_more'])
+        cursor = self.client.get(url_for('api.change_feed', since=first['cursor'])).json['cursor']
+
+        post = Post.query.get('post--1')
+        post.text = 'edited'
+        db.session.delete(Post.query.get('post--3'))
+        db.session.commit()
+
+        delta = self.client.get(url_for('api.change_feed', since=cursor)).json
+        self.assertEqual([(item['id'], item['deleted']) for item in delta['data']],
+                         [('post--1', False), ('post--3', True)])
+        self.assertEqual(delta['data'][0]['object']['text'], 'edited')
+        self.assertNotIn('object', delta['data'][1])
+        self.assertFalse(delta['has_more'])
+        self.assertEqual(self.client.get(url_for('api.change_feed', since=delta['cursor'])).json['data'], [])
+
+    def test_stream(self):
+        # Test if the streamed feed sends every change as one json line
+        response = self.client.get(url_for('api.change_feed', stream=1, limit=2))
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual([item['id'] for item in lines], ['post--{}'.format(i) for i in range(5)])
+        seqs = [item['seq'] for item in lines]
+        self.assertEqual(seqs, sorted(seqs))
+
+    def test_moves_entries_with_one_upsert(self):
+        # Test if writing objects already in the feed moves their entries past the cursor in one statement
+        cursor = feed.cursor()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            feed.record(db.session.connection(), Post, ['post--3', 'post--1', 'post--9'])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        db.session.commit()
+        self.assertEqual(len(statements), 1)
+        self.assertIn('ON CONFLICT', statements[0])
+        entries = feed.entries(since=cursor).all()
+        self.assertEqual(sorted(entry.object_id for entry in entries), ['post--1', 'post--3', 'post--9'])
+        self.assertEqual(len(set(entry.seq for entry in entries)), 3)
+        self.assertEqual(FeedEntry.query.count(), 6)
+
+    def test_bulk_writes_and_export_cursor(self):
+        # Test if imports and bulk deletes reach the feed and an export tells where to continue from
+        cursor = int(self.client.get(url_for('stix.export_bundle_view')).headers['X-Feed-Cursor'])
+        import_bundle(io.BytesIO(make_bundle(TestBundleImport.objects)))
+        self.client.post(url_for('stix.bulk_user_accounts'), json={'action': 'delete', 'ids': ['user-account--1']})
+        delta = self.client.get(url_for('api.change_feed', since=cursor)).json['data']
+        self.assertEqual(sorted((item['id'], item['deleted']) for item in delta),
+                         [('identity--1', False), ('post--1', False), ('user-account--1', True)])
+        self.assertEqual(self.client.get(url_for('api.change_feed', type='bogus')).status_code, 400)
+
+
+class TestLoginRateLimit(TestBase):
+
+    def test_username_limit_rejects_before_queries(self):
+        # Test if attempts over the username burst are turned away without a query or a password hash
+        self.app.config.update(LOGIN_USERNAME_BURST=3, LOGIN_USERNAME_PER_MINUTE=1)
+        for _ in range(3):
+            self.assertEqual(self.login(password='wrong').status_code, 200)
+
+        queries = []
+        listener = lambda *args: queries.append(args[2])
+        hashed = password_hasher.stats()['hashed']
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            response = self.login()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response.headers['Retry-After']), 0)
+        # the page is rendered with the data versions of the navbar, nothing else is read
+        self.assertEqual([query for query in queries if 'FROM data_versions' not in query], [])
+        self.assertEqual(password_hasher.stats()['hashed'], hashed)
+        self.assertIn('login_rate_limited_total{limit="username"} 1.0',
+                      self.client.get(url_for('health.prometheus_metrics')).data.decode())
+
+    def test_successful_login_resets_username_limit(self):
+        # Test if a successful login gives the username its full burst of attempts back
+        self.app.config.update(LOGIN_USERNAME_BURST=3, LOGIN_USERNAME_PER_MINUTE=1)
+        self.login(password='wrong')
+        self.login(password='wrong')
+        self.assertEqual(self.login().status_code, 302)
+        self.client.get(url_for('auth.logout'))
+        statuses = [self.login(password='wrong').status_code for _ in range(4)]
+        self.assertEqual(statuses, [200] * 3 + [429])
+
+    def test_rates_checked_at_startup(self):
+        # Test if a limit without a positive rate is refused when the app starts
+        self.app.config['LOGIN_IP_PER_MINUTE'] = 0
+        limiter = RateLimiter('test-limits', rates=('LOGIN_IP_PER_MINUTE', 'LOGIN_USERNAME_PER_MINUTE'))
+        with self.assertRaises(ValueError):
+            limiter.init_app(self.app)
+
+    def test_ip_limit_across_usernames(self):
+        # Test if one client trying many usernames runs out of attempts
+        self.app.config.update(LOGIN_IP_BURST=5, LOGIN_IP_PER_MINUTE=1)
+        statuses = [self.login('user{}'.format(i), 'secret').status_code for i in range(6)]
+        self.assertEqual(statuses, [200] * 5 + [429])
+
+    def test_buckets_refill_and_share(self):
+        # Test if a bucket refills over time, and if limiters on the shared backend see the same buckets
+        self.app.config['CACHE_REDIS_URL'] = 'local'
+        first, second = RateLimiter('test-limits'), RateLimiter('test-limits')
+        first.init_app(self.app)
+        second.init_app(self.app)
+        first.cache.clear()
+        self.assertEqual(first.take('ip', '10.0.0.1', rate=50, burst=1), 0)
+        self.assertGreater(second.take('ip', '10.0.0.1', rate=50, burst=1), 0)
+        time.sleep(0.05)
+        self.assertEqual(second.take('ip', '10.0.0.1', rate=50, burst=1), 0)
+        self.assertEqual(second.stats(), {'ip': 1})
+
+
+class TestRelationshipGraph(TestBase):
+
+    objects = [
+        {'type': 'identity', 'id': 'identity--1', 'name': 'ACME'},
+        {'type': 'user-account', 'id': 'user-account--1', 'account_login': 'jdoe',
+         'created_by_ref': 'identity--1'},
+        {'type': 'post', 'id': 'post--1', 'text': 'hello'},
+        {'type': 'relationship', 'id': 'relationship--1', 'relationship_type': 'authored-by',
+         'source_ref': 'post--1', 'target_ref': 'user-account--1'},
+        {'type': 'relationship', 'id': 'relationship--2', 'relationship_type': 'authored-by',
+         'source_ref': 'post--1', 'target_ref': 'bad'},
+    ]
+
+    def setUp(self):
+        super(TestRelationshipGraph, self).setUp()
+        relationship_graph.cache.clear()
+        # a chain of identities, each with two posts
+        for i in range(4):
+            db.session.add(Identity(id='identity--c{}'.format(i), name='chain {}'.format(i)))
+            db.session.add_all([Relationship(id='relationship--p{}{}'.format(i, j), relationship_type='belongs-to',
+                                             source_ref='post--{}{}'.format(i, j), target_ref='identity--c{}'.format(i))
+                                for j in range(2)])
+            if i:
+                db.session.add(Relationship(id='relationship--c{}'.format(i), relationship_type='part-of',
+                                            source_ref='identity--c{}'.format(i - 1),
+                                            target_ref='identity--c{}'.format(i)))
+        db.session.commit()
+
+    def traverse(self, *args, **kwargs):
+        # traverse and return the subgraph with the SQL statements it ran
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            subgraph = relationship_graph.traverse(*args, **kwargs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return subgraph, [statement for statement in statements if 'relationships' in statement]
+
+    def test_import_relationships_and_refs(self):
+        # Test if relationship objects and *_ref links are stored, and a new version of an object replaces its links
+        result = import_bundle(io.BytesIO(make_bundle(self.objects)))
+        self.assertEqual((result.inserted, result.invalid), (4, 1))
+        self.assertEqual(Relationship.query.get('relationship--1').target_ref, 'user-account--1')
+        link = Relationship.query.filter_by(source_ref='user-account--1').one()
+        self.assertEqual((link.relationship_type, link.target_ref, link.derived), ('created-by', 'identity--1', True))
+
+        import_bundle(io.BytesIO(make_bundle([dict(self.objects[1], created_by_ref='identity--2')])))
+        self.assertEqual([link.target_ref for link in Relationship.query.filter_by(source_ref='user-account--1')],
+                         ['identity--2'])
+        self.assertEqual(relationship_graph.traverse(['identity--2']).nodes, {'identity--2': 0, 'user-account--1': 1})
+
+    def test_derived_links_in_feed_and_audit_log(self):
+        # Test if links added and removed by an import reach the change feed and the audit log, unchanged ones not
+        versions = [dict(obj, modified='2020-01-01T00:00:00.000Z') for obj in self.objects[:2]]
+        import_bundle(io.BytesIO(make_bundle(versions)))
+        old = Relationship.query.filter_by(source_ref='user-account--1').one().id
+        cursor = feed.cursor()
+        import_bundle(io.BytesIO(make_bundle([
+            dict(versions[1], created_by_ref='identity--2', modified='2021-01-01T00:00:00.000Z'),
+            dict(versions[0], modified='2021-01-01T00:00:00.000Z')])))
+        new = Relationship.query.filter_by(source_ref='user-account--1').one().id
+        items = [(entry.object_id, entry.deleted) for entry in feed.entries(since=cursor)
+                 if entry.object_type == 'relationship']
+        self.assertEqual(sorted(items), sorted([(old, True), (new, False)]))
+        audit_log.flush()
+        changes = Change.query.filter_by(object_type='relationships').filter(Change.object_id.in_([old, new]))
+        self.assertEqual([(change.object_id, change.action) for change in changes.order_by(Change.id)],
+                         [(old, 'insert'), (old, 'delete'), (new, 'insert')])
+
+    def test_api_refs(self):
+        # Test if relationships sent to the API need a type and both refs as STIX ids
+        self.login()
+        url = url_for('api.create_object', collection='relationships')
+        link = {'relationship_type': 'uses', 'source_ref': 'identity--c0', 'target_ref': 'post--00'}
+        for invalid in ({'source_ref': 'bad'}, {'target_ref': 5}, {'relationship_type': ''},
+                        {'relationship_type': ['uses']}, {'source_ref': None}):
+            self.assertEqual(self.client.post(url, json=dict(link, **invalid)).status_code, 400)
+        self.assertEqual(self.client.post(url, json={'relationship_type': 'uses', 'source_ref': 'identity--c0'})
+                         .status_code, 400)
+        response = self.client.post(url, json=link)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.client.patch(response.headers['Location'], json={'target_ref': 'x'}).status_code, 400)
+        self.assertRaises(ValueError, StixId().process_bind_param, 5, db.engine.dialect)
+
+    def test_batched_traversal(self):
+        # Test if every hop is one query for the whole frontier, and limits, types and direction are followed
+        self.app.config['GRAPH_CACHE_ENABLED'] = False
+        subgraph, statements = self.traverse(['identity--c0'], depth=3)
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(subgraph.nodes['identity--c3'], 3)
+        self.assertEqual(len(subgraph.nodes), 1 + 3 + 3 + 3)
+        self.assertEqual(len(subgraph.edges), 3 + 3 + 3)
+        self.assertFalse(subgraph.truncated)
+
+        subgraph = relationship_graph.traverse(['identity--c1'], depth=3, types=['part-of'], direction='out')
+        self.assertEqual(subgraph.nodes, {'identity--c1': 0, 'identity--c2': 1, 'identity--c3': 2})
+        subgraph = relationship_graph.traverse(['identity--c1'], depth=1, direction='in')
+        self.assertEqual(sorted(subgraph.nodes), ['identity--c0', 'identity--c1', 'post--10', 'post--11'])
+        subgraph = relationship_graph.traverse(['identity--c0'], depth=3, limit=4)
+        self.assertEqual(len(subgraph.nodes), 4)
+        self.assertTrue(subgraph.truncated)
+
+    def test_adjacency_cache(self):
+        # Test if a repeated traversal runs no query until a relationship is written
+        first, statements = self.traverse(['identity--c0'], depth=2)
+        self.assertEqual(len(statements), 2)
+        second, statements = self.traverse(['identity--c0'], depth=2)
+        self.assertEqual(statements, [])
+        self.assertEqual(second.nodes, first.nodes)
+
+        db.session.add(Relationship(id='relationship--x', relationship_type='part-of', source_ref='identity--c0',
+                                    target_ref='identity--x'))
+        db.session.commit()
+        subgraph, statements = self.traverse(['identity--c0'], depth=2)
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(subgraph.nodes['identity--x'], 1)
+
+    def test_graph_endpoint(self):
+        # Test if the API answers which objects belong to an identity
+        self.login()
+        url = url_for('api.object_graph', collection='identities', id='identity--c1', direction='in',
+                      type='belongs-to')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(node['id'], node['type'], node['depth']) for node in response.json['nodes']],
+                         [('identity--c1', 'identity', 0), ('post--10', 'post', 1), ('post--11', 'post', 1)])
+        self.assertEqual(len(response.json['edges']), 2)
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': response.headers['ETag']}).status_code, 304)
+
+        self.assertEqual(self.client.get(url_for('api.object_graph', collection='identities',
+                                                 id='identity--c1', depth=9)).status_code, 400)
+        self.assertEqual(self.client.get(url_for('api.object_graph', collection='identities',
+                                                 id='identity--none')).status_code, 404)
+
+
+class TestStatistics(TestBase):
+
+    def setUp(self):
+        super(TestStatistics, self).setUp()
+        self.role = Role(name='analyst', description='reads')
+        db.session.add(self.role)
+        db.session.add_all([UserAccount(id='user-account--{}'.format(i), name='account {}'.format(i),
+                                        account_type='unix' if i % 2 else 'windows') for i in range(5)])
+        db.session.add(Post(id='post--1', text='hello', created=datetime.datetime(2020, 1, 1, 12)))
+        db.session.commit()
+        statistics.reconcile()
+
+    def counts(self):
+        # counters, asserting they are read without counting the tables
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            counts = statistics.counts()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertFalse([statement for statement in statements if 'GROUP BY' in statement])
+        return counts
+
+    def assertCountsMatchTables(self):
+        counts = self.counts()
+        statistics.reconcile()
+        self.assertEqual(counts, statistics.counts())
+
+    def test_counters_follow_writes(self):
+        # Test if inserts, updates and deletes through the session move the counters
+        self.assertEqual(self.counts()['accounts_per_type'], {'unix': 2, 'windows': 3})
+        self.assertEqual(self.counts()['posts_per_day'], {'2020-01-01': 1})
+
+        user = User.query.filter_by(username='test').one()
+        user.role = self.role
+        account = UserAccount.query.get('user-account--0')
+        account.account_type, account.account_is_disabled = 'unix', True
+        db.session.delete(UserAccount.query.get('user-account--1'))
+        db.session.add(Post(id='post--2', text='again', created=datetime.datetime(2020, 1, 1, 18)))
+        db.session.commit()
+
+        counts = self.counts()
+        self.assertEqual(counts['users_per_role'], {'': 1, str(self.role.id): 1})
+        self.assertEqual(counts['accounts_per_type'], {'unix': 2, 'windows': 2})
+        self.assertEqual(counts['accounts_per_status'], {'false': 3, 'true': 1})
+        self.assertEqual(counts['posts_per_day'], {'2020-01-01': 2})
+        self.assertCountsMatchTables()
+
+        # a deleted role leaves its users without one
+        db.session.delete(self.role)
+        db.session.commit()
+        self.assertEqual(self.counts()['users_per_role'], {'': 2})
+
+    def test_bulk_writes_and_imports(self):
+        # Test if bulk updates, deletes and bundle imports keep the counters right
+        self.login()
+        self.client.post(url_for('stix.bulk_user_accounts'), json={
+            'action': 'update', 'filter': {'account_type': 'unix'}, 'values': {'account_type': 'windows'}})
+        self.client.post(url_for('stix.bulk_user_accounts'), json={'action': 'delete', 'ids': ['user-account--0']})
+        self.assertEqual(self.counts()['accounts_per_type'], {'windows': 4})
+
+        import_bundle(io.BytesIO(make_bundle(TestBundleImport.objects + [
+            {'type': 'user-account', 'id': 'user-account--2', 'account_login': 'account 2', 'account_type': 'ldap'}])))
+        self.assertEqual(self.counts()['accounts_per_type'], {'windows': 2, 'ldap': 1, 'unix': 1})
+        self.assertCountsMatchTables()
+
+    def test_dashboard_and_json(self):
+        # Test if the dashboard and the API show the counters to admins only
+        self.login()
+        response = self.client.get(url_for('home.admin_dashboard'))
+        self.assertIn(b'windows', response.data)
+        data = self.client.get(url_for('api.dashboard_statistics')).json['data']
+        self.assertEqual(data['accounts_per_type']['total'], 5)
+        self.assertEqual(data['accounts_per_type']['entries'][0], {'key': 'windows', 'label': 'windows', 'count': 3})
+        self.assertEqual(data['users_per_role']['entries'], [{'key': '', 'label': None, 'count': 2}])
+
+        self.client.get(url_for('auth.logout'))
+        self.login('test', 'test')
+        self.assertEqual(self.client.get(url_for('api.dashboard_statistics')).status_code, 403)
+
+    def test_reconcile_when_stale(self):
+        # Test if counters that drifted are recounted by one job queued once the reconciliation interval passed
+        db.session.execute(Post.__table__.insert().values(id='post--x', text='behind the counters',
+                                                          created=datetime.datetime(2020, 1, 2)))
+        db.session.commit()
+        self.assertNotIn('2020-01-02', self.counts()['posts_per_day'])
+        table = statistics.table
+        db.session.execute(table.update().where(table.c.name == 'reconciled').values(value=int(time.time()) - 7200))
+        db.session.add(Post(id='post--y', text='new version'))
+        db.session.commit()
+        self.assertNotIn('2020-01-02', self.counts()['posts_per_day'])
+        statistics.cache.clear()
+        statistics.counts()
+        self.assertEqual(Job.query.filter_by(task='statistics.reconcile').count(), 1)
+        self.assertFalse(statistics.schedule(0))
+
+        jobs.work(processes=0, once=True)
+        self.assertEqual(self.counts()['posts_per_day']['2020-01-02'], 1)
+
+    def test_counters_upserted_in_one_statement(self):
+        # Test if the deltas of a write reach the counters, new ones included, in one statement
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            statistics.apply(db.session.connection(), {('accounts_per_type', 'unix'): 2,
+                                                       ('accounts_per_type', 'ldap'): 1,
+                                                       ('accounts_per_type', 'windows'): 0})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        db.session.commit()
+        self.assertEqual(len(statements), 1)
+        self.assertIn('ON CONFLICT', statements[0])
+        statistics.cache.clear()
+        self.assertEqual(statistics.counts()['accounts_per_type'], {'unix': 4, 'windows': 3, 'ldap': 1})
+
+
+@jobs.task('test.flaky')
+def flaky_task(job, failures):
+    # fails until its job was attempted more than failures times
+    if Job.query.get(job.id).attempts <= failures:
+        raise RuntimeError('attempt failed')
+    return 'done'
+
+
+@jobs.task('test.crash')
+def crash_task(job):
+    # the process running the job dies
+    os._exit(1)
+
+
+@jobs.task('test.cancelled')
+def cancelled_task(job):
+    jobs.cancel(job.id)
+    job.progress(1, 2)
+    return 'not reached'
+
+
+class TestJobs(TestBase):
+
+    def create_app(self):
+        app = super(TestJobs, self).create_app()
+        self.folder = tempfile.mkdtemp()
+        app.config.update(JOBS_FOLDER=self.folder, JOBS_RETRY_DELAY=0)
+        return app
+
+    def tearDown(self):
+        super(TestJobs, self).tearDown()
+        for name in os.listdir(self.folder):
+            os.remove(os.path.join(self.folder, name))
+        os.rmdir(self.folder)
+
+    def job(self, id):
+        db.session.expire_all()
+        return self.client.get(url_for('api.get_job', id=id)).json['data']
+
+    def test_async_import_and_export(self):
+        # Test if imports and exports queued by the bundle views run in the worker with progress
+        self.login()
+        response = self.client.post(url_for('stix.import_bundle_view', **{'async': 1}),
+                                    data=make_bundle(TestBundleImport.objects), content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.client.get(response.headers['Location']).json['data']['status'], 'queued')
+        jobs.work(processes=0, once=True)
+        job = self.job(response.json['job'])
+        self.assertEqual((job['status'], job['result']['inserted']), ('succeeded', 3))
+        self.assertEqual(job['progress'], job['total'])
+        self.assertEqual(os.listdir(self.folder), [])
+
+        response = self.client.get(url_for('stix.export_bundle_view', **{'async': 1}))
+        jobs.work(processes=0, once=True)
+        job = self.job(response.json['job'])
+        self.assertEqual((job['status'], job['progress'], job['total']), ('succeeded', 3, 3))
+        bundle = self.client.get(url_for('api.download_job_file', id=job['id']))
+        self.assertEqual(len(json.loads(bundle.data)['objects']), 3)
+        bundle.close()
+
+    def test_malformed_upload(self):
+        # Test if an import of a malformed bundle fails at once, without retries, and its upload is removed
+        self.login()
+        response = self.client.post(url_for('stix.import_bundle_view', **{'async': 1}),
+                                    data=b'{"objects": [{"type": "post",', content_type='application/json')
+        with self.assertLogs('app.jobs', 'ERROR'):
+            jobs.work(processes=0, once=True)
+        job = self.job(response.json['job'])
+        self.assertEqual((job['status'], job['attempts']), ('failed', 1))
+        self.assertIn('Invalid bundle', job['error'])
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_retries_and_failure(self):
+        # Test if a failing job is retried until max_attempts, and fails with the error of its last attempt
+        self.login()
+        self.assertEqual(self.client.post(url_for('api.create_job'), json={'task': 'bogus'}).status_code, 400)
+        self.assertEqual(self.client.post(url_for('api.create_job'), json={'task': ['stix.reindex']}).status_code,
+                         400)
+        response = self.client.post(url_for('api.create_job'), json={'task': 'test.flaky',
+                                                                     'arguments': {'failures': 2}})
+        self.assertEqual(response.status_code, 202)
+        retried = jobs.enqueue('test.flaky', {'failures': 5}, max_attempts=2)
+        with self.assertLogs('app.jobs', 'ERROR') as logs:
+            jobs.work(processes=0, once=True)
+        self.assertEqual(len(logs.records), 4)
+
+        job = self.job(response.json['data']['id'])
+        self.assertEqual((job['status'], job['attempts'], job['result']), ('succeeded', 3, 'done'))
+        job = self.job(retried)
+        self.assertEqual((job['status'], job['attempts']), ('failed', 2))
+        self.assertIn('attempt failed', job['error'])
+        self.assertEqual(len(self.client.get(url_for('api.list_jobs', status='failed')).json['data']), 1)
+
+    def test_cancel(self):
+        # Test if queued jobs are cancelled at once and running ones at their next progress report
+        self.login()
+        queued = jobs.enqueue('stix.reindex')
+        self.assertEqual(self.client.post(url_for('api.cancel_job', id=queued)).status_code, 202)
+        running = jobs.enqueue('test.cancelled')
+        jobs.work(processes=0, once=True)
+        self.assertEqual(self.job(queued)['status'], 'cancelled')
+        self.assertEqual((self.job(running)['status'], self.job(running)['progress']), ('cancelled', 1))
+        self.assertEqual(self.client.post(url_for('api.cancel_job', id=queued)).status_code, 409)
+
+    def test_lost_worker(self):
+        # Test if the job of a worker that stopped sending heartbeats is queued again
+        id = jobs.enqueue('stix.feed-rebuild')
+        self.assertEqual(jobs.claim('gone'), id)
+        self.assertIsNone(jobs.claim('other'))
+        self.assertEqual(jobs.recover(), 0)
+        self.app.config['JOBS_TIMEOUT'] = -1
+        self.assertEqual(jobs.recover(), 1)
+        self.assertEqual(jobs.claim('other'), id)
+
+
+class TestJobWorkerPool(TestBase):
+
+    def create_app(self):
+        # the worker processes open the database on their own connections
+        app = super(TestJobWorkerPool, self).create_app()
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + self.path)
+        return app
+
+    def tearDown(self):
+        super(TestJobWorkerPool, self).tearDown()
+        db.get_engine(self.app).dispose()
+        os.remove(self.path)
+
+    def test_jobs_run_in_processes(self):
+        # Test if the worker command runs jobs in a process pool
+        db.session.add(Post(id='post--1', text='counted'))
+        db.session.commit()
+        ids = [jobs.enqueue('statistics.reconcile'), jobs.enqueue('stix.reindex')]
+        result = self.app.test_cli_runner().invoke(args=['jobs', 'worker', '--processes', '2', '--once'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        db.session.expire_all()
+        done = [Job.query.get(id) for id in ids]
+        self.assertEqual([job.status for job in done], ['succeeded', 'succeeded'])
+        self.assertEqual(len(set(job.worker for job in done)), 1)
+        self.assertEqual(json.loads(done[1].result), {'indexed': 1})
+
+
+    def test_process_killed(self):
+        # Test if the job of a process that died fails its attempt and the next jobs run in a new pool
+        crashed = jobs.enqueue('test.crash', max_attempts=1)
+        reindexed = jobs.enqueue('stix.reindex')
+        result = self.app.test_cli_runner().invoke(args=['jobs', 'worker', '--processes', '1', '--once'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        db.session.expire_all()
+        self.assertEqual(Job.query.get(crashed).status, 'failed')
+        self.assertIn('BrokenProcessPool', Job.query.get(crashed).error)
+        self.assertEqual(Job.query.get(reindexed).status, 'succeeded')
+
+class TestStixIds(TestBase):
+
+    acme = 'identity--0ad4b2a3-53e4-4f0d-8a33-0a2b1f4c55de'
+    jdoe = 'user-account--00a5bd1c-7f3e-4c2a-9d1e-6b8f2e4a1c3d'
+
+    def stored(self, sql):
+        return [row[0] for row in db.session.execute(sql)]
+
+    def test_compact_storage(self):
+        # Test if uuid ids are stored as 16 bytes, refs of any type as 17 and other ids unchanged as text
+        import_bundle(io.BytesIO(make_bundle([
+            {'type': 'identity', 'id': self.acme, 'name': 'ACME'},
+            {'type': 'identity', 'id': 'identity--1', 'name': 'Legacy'},
+            {'type': 'user-account', 'id': self.jdoe, 'account_login': 'jdoe', 'created_by_ref': self.acme},
+        ])))
+        self.assertEqual(sorted(self.stored('SELECT length(id) FROM identities')), [12, 16])
+        self.assertEqual(self.stored('SELECT length(source_ref) + length(target_ref) FROM relationships'), [34])
+        self.assertEqual(Identity.query.get(self.acme).name, 'ACME')
+        self.assertEqual(Identity.query.get('identity--1').name, 'Legacy')
+        self.assertEqual([identity.id for identity in Identity.query.filter(Identity.id.in_([self.acme, 'identity--1']))
+                          .order_by(Identity.id)], ['identity--1', self.acme])
+        link = Relationship.query.filter_by(source_ref=self.jdoe).one()
+        self.assertEqual(link.target_ref, self.acme)
+        self.assertEqual(relationship_graph.traverse([self.acme]).nodes, {self.acme: 0, self.jdoe: 1})
+
+    def test_round_trip(self):
+        # Test if every id reads back unchanged, including those that cannot be stored compactly
+        for column_type in (StixId('identity'), StixId()):
+            for value in (self.acme, 'identity--00000000-0000-0000-0000-000000000000', self.acme.upper(),
+                          'identity--' + 'x' * 5, 'x--' + self.acme[10:], 'not an id', self.jdoe):
+                self.assertEqual(column_type.decode(column_type.encode(value)), value)
+        self.assertEqual(len(StixId('identity').encode('identity--' + 'x' * 5)), 17)
+        self.assertEqual(StixId().encode(self.jdoe)[1:], StixId('user-account').encode(self.jdoe))
+
+    def test_api(self):
+        # Test if the api reads and writes uuid ids, and ids of another type are not found
+        self.login()
+        response = self.client.post(url_for('api.create_object', collection='posts'), json={'text': 'hello'})
+        post_id = response.json['data']['id']
+        self.assertEqual(self.stored('SELECT length(id) FROM posts'), [16])
+        self.assertEqual(self.client.get(response.headers['Location']).json['data']['id'], post_id)
+        response = self.client.get(url_for('api.get_object', collection='identities', id=post_id))
+        self.assertEqual(response.status_code, 404)
+
+    def test_time_indexes(self):
+        # Test if created and modified are indexed on every STIX table
+        inspector = db.inspect(db.engine)
+        for table in ('user_accounts', 'identities', 'posts', 'relationships'):
+            with warnings.catch_warnings():
+                # SQLite does not reflect the expression indexes on lower(name)
+                warnings.simplefilter('ignore', exc.SAWarning)
+                columns = [index['column_names'] for index in inspector.get_indexes(table)]
+            self.assertIn(['created'], columns)
+            self.assertIn(['modified'], columns)
+
+
+class TestUpsert(TestBase):
+
+    def version(self, day, **values):
+        return dict({'type': 'identity', 'id': 'identity--1', 'name': 'ACME', 'created': '2020-01-01T00:00:00.000Z',
+                     'modified': '2020-01-{:02d}T00:00:00.000Z'.format(day)}, **values)
+
+    def test_newest_version_wins(self):
+        # Test if older and identical versions are skipped, in the database and within a batch
+        import_bundle(io.BytesIO(make_bundle([self.version(10, description='v10')])))
+        result = import_bundle(io.BytesIO(make_bundle([
+            self.version(5, description='v5'),
+            self.version(10, description='again'),
+            self.version(2, id='identity--2', name='Initech'),
+            self.version(1, id='identity--2', name='Initech', description='older'),
+        ])))
+        self.assertEqual((result.inserted, result.updated, result.skipped), (1, 0, 3))
+        self.assertEqual(Identity.query.get('identity--1').description, 'v10')
+        self.assertIsNone(Identity.query.get('identity--2').description)
+
+        result = import_bundle(io.BytesIO(make_bundle([self.version(12, description='v12')])))
+        self.assertEqual((result.inserted, result.updated, result.skipped), (0, 1, 0))
+        self.assertEqual(Identity.query.get('identity--1').description, 'v12')
+        self.assertEqual(result.to_dict()['skipped'], 0)
+
+    def test_local_time_zone(self):
+        # Test if objects saved by the app are stamped in UTC, like the imported ones, on a host outside UTC
+        tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'Asia/Tokyo'
+        time.tzset()
+        try:
+            db.session.add(Identity(id='identity--1', name='ACME'))
+            db.session.commit()
+            stored = Identity.query.get('identity--1').modified
+            self.assertLess(abs(stored - datetime.datetime.utcnow()), datetime.timedelta(minutes=1))
+            newer = (stored + datetime.timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            result = import_bundle(io.BytesIO(make_bundle([
+                self.version(1, modified=newer, description='newer'),
+                {'type': 'identity', 'id': 'identity--2', 'name': 'Initech'}])))
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+        self.assertEqual((result.inserted, result.updated), (1, 1))
+        self.assertEqual(Identity.query.get('identity--1').description, 'newer')
+        created = Identity.query.get('identity--2').created
+        self.assertLess(abs(created - datetime.datetime.utcnow()), datetime.timedelta(minutes=1))
+
+    def test_statements_per_batch(self):
+        # Test if inserts and updates of a batch share one ON CONFLICT statement per STIX_UPSERT_BATCH_SIZE rows
+        self.app.config['STIX_UPSERT_BATCH_SIZE'] = 2
+        import_bundle(io.BytesIO(make_bundle([self.version(1, id='identity--1')])))
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            result = import_bundle(io.BytesIO(make_bundle([
+                self.version(2, id='identity--{}'.format(i), name='name {}'.format(i)) for i in range(1, 6)])))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual((result.inserted, result.updated), (4, 1))
+        self.assertEqual(len([statement for statement in statements if statement.startswith('INSERT INTO identities')
+                              and 'ON CONFLICT' in statement]), 3)
+        self.assertEqual(Identity.query.get('identity--1').name, 'name 1')
+
+    def test_concurrent_newer_version(self):
+        # Test if a row replaced by a newer version after the plan is not overwritten
+        import_bundle(io.BytesIO(make_bundle([self.version(10)])))
+        connection = db.session.connection()
+        rows = {'identity--1': {'id': 'identity--1', 'name': 'stale', 'modified': datetime.datetime(2020, 1, 5)}}
+        self.assertEqual(upsert.write(connection, Identity, [], list(rows.values())), 0)
+        self.assertEqual(Identity.query.get('identity--1').name, 'ACME')
+
+    def test_import_racing_newer_version(self):
+        # Test if rows a concurrent import replaced after the plan count as skipped, without side effects
+        self.check_racing_import()
+
+    def test_import_racing_without_rowcount(self):
+        # Test if the replaced rows are found where the driver does not count the rows of an executemany
+        with mock.patch.object(db.engine.dialect, 'supports_sane_multi_rowcount', False):
+            self.check_racing_import()
+
+    def check_racing_import(self):
+        import_bundle(io.BytesIO(make_bundle([self.version(10)])))
+        write = upsert.write
+
+        def racing_write(connection, model, inserts, updates, *args):
+            connection.execute(model.__table__.update().values(name='Newer', modified=datetime.datetime(2020, 1, 20)))
+            return write(connection, model, inserts, updates, *args)
+        changes, feed_seq = Change.query.count(), FeedEntry.query.filter_by(object_id='identity--1').one().seq
+        with mock.patch.object(upsert, 'write', racing_write):
+            result = import_bundle(io.BytesIO(make_bundle([
+                self.version(15, identity_class='organization'), self.version(15, id='identity--2', name='Initech')])))
+        self.assertEqual((result.inserted, result.updated, result.skipped), (1, 0, 1))
+        self.assertEqual(Identity.query.get('identity--1').name, 'Newer')
+        self.assertEqual([change.object_id for change in Change.query.order_by(Change.id).offset(changes)
+                          if change.object_type == 'identities'], ['identity--2'])
+        self.assertEqual(FeedEntry.query.filter_by(object_id='identity--1').one().seq, feed_seq)
+        counted = statistics.counts()['identities_per_class']
+        statistics.reconcile()
+        self.assertEqual(statistics.counts()['identities_per_class'], counted)
+
+    def test_links_of_skipped_versions(self):
+        # Test if an older version does not replace the links of the stored one
+        account = {'type': 'user-account', 'id': 'user-account--1', 'account_login': 'jdoe',
+                   'created': '2020-01-01T00:00:00.000Z', 'modified': '2020-01-10T00:00:00.000Z',
+                   'created_by_ref': 'identity--1'}
+        import_bundle(io.BytesIO(make_bundle([account])))
+        import_bundle(io.BytesIO(make_bundle([dict(account, modified='2020-01-05T00:00:00.000Z',
+                                                   created_by_ref='identity--2')])))
+        self.assertEqual([link.target_ref for link in Relationship.query.filter_by(source_ref='user-account--1')],
+                         ['identity--1'])
+
+    def test_version_history(self):
+        # Test if replaced versions are kept with STIX_VERSION_HISTORY and listed by the api
+        self.app.config['STIX_VERSION_HISTORY'] = True
+        import_bundle(io.BytesIO(make_bundle([self.version(1, description='v1')])))
+        import_bundle(io.BytesIO(make_bundle([self.version(2, description='v2')])))
+        import_bundle(io.BytesIO(make_bundle([self.version(3, description='v3'), self.version(2)])))
+        versions = ObjectVersion.query.order_by(ObjectVersion.modified).all()
+        self.assertEqual([version.modified.day for version in versions], [1, 2])
+        self.assertEqual(json.loads(versions[0].data)['description'], 'v1')
+        self.assertEqual(versions[0].object_type, 'identity')
+
+        self.login()
+        response = self.client.get(url_for('api.object_versions', collection='identities', id='identity--1'))
+        self.assertEqual([entry['data']['description'] for entry in response.json['data']], ['v2', 'v1'])
+
+
+class TestStartup(unittest.TestCase):
+
+    # seconds a cold start (import and create_app in a fresh interpreter) may take
+    budget = 3.0
+
+    def test_cold_start(self):
+        # Test if the app starts within the budget without loading migrations or the stix views
+        script = ("import json, sys, time; start = time.time(); from app import create_app; create_app('testing'); "
+                  "print(json.dumps([time.time() - start, sorted(sys.modules)]))")
+        seconds, modules = json.loads(subprocess.check_output([sys.executable, '-c', script],
+                                                              stderr=subprocess.DEVNULL))
+        self.assertLess(seconds, self.budget)
+        for module in ('flask_migrate', 'alembic', 'app.stix.views', 'app.stix.importer'):
+            self.assertNotIn(module, modules)
+        self.assertIn('app.stix.search', modules)
+
+    def test_production_settings_from_environment(self):
+        # Test if the production config reads the environment when asked for by name, as wsgi.py does
+        environ = dict(os.environ, SECRET_KEY='from-env', SQLALCHEMY_DATABASE_URI='sqlite://')
+        environ.pop('FLASK_CONFIG', None)
+        with mock.patch.dict(os.environ, environ, clear=True):
+            app = create_app('production')
+        self.assertEqual((app.config['SECRET_KEY'], app.config['SQLALCHEMY_DATABASE_URI']), ('from-env', 'sqlite://'))
+        self.assertFalse(app.debug)
+
+
 if __name__ == '__main__':
     unittest.main()
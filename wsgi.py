@@ -0,0 +1,6 @@
+import os
+
+from app import create_app
+
+# WSGI entry point of the production server, see gunicorn.conf.py
+app = create_app(os.getenv('FLASK_CONFIG', 'production'))